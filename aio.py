@@ -0,0 +1,486 @@
+"""
+The asyncio engine, used when ENGINE = 'asyncio' in config.py
+
+Updates are long polled and each one is handled by its own task on a single event
+loop, so an update waiting on the database or the Bot API holds a coroutine instead
+of a thread. The handlers mirror the ones in spoilerobot.py and share the helpers in
+common.py.
+User and rate_limiter are used unchanged: AsyncBot schedules every Bot API call as a
+task, so the calls they make still go out, and handlers await the calls they depend on.
+"""
+import asyncio
+import logging
+import signal
+from collections import defaultdict
+
+import aiohttp
+import telegram
+
+import bot_api
+import common
+import config
+import live_stats
+import log
+import metrics
+import rate_limiter
+from async_database import AsyncDatabase
+from dedupe import RecentUpdates
+from health import Health
+from user import User
+from util import decode_uuid, get_uuid
+
+logger = logging.getLogger(__name__)
+
+# how long in seconds a getUpdates call waits for new updates
+POLL_TIMEOUT = 30
+# and how long the other calls may take before they time out
+CALL_TIMEOUT = 10
+
+# parameters of the api methods that the library's helpers (ie Message.reply_text) pass positionally
+POSITIONAL_PARAMETERS = {
+    'sendMessage': ('chat_id', 'text'),
+    'answerCallbackQuery': ('callback_query_id', 'text'),
+    'answerInlineQuery': ('inline_query_id', 'results'),
+}
+
+database = None
+
+
+def to_camel_case(name):
+    first, *rest = name.split('_')
+    return first + ''.join(word.title() for word in rest)
+
+
+def serialize(value):
+    if hasattr(value, 'to_dict'):
+        return value.to_dict()
+    if isinstance(value, (list, tuple)):
+        return [serialize(item) for item in value]
+    return value
+
+
+def log_task_error(task):
+    if not task.cancelled() and task.exception():
+        logger.warning(f'Bot API call failed: {task.exception()}')
+
+
+class AsyncBot:
+    """
+    A Bot API client on a pooled aiohttp session
+    Any bot method (send_message, answerCallbackQuery...) can be called like on a
+    telegram.Bot, it returns a task that can be awaited (but doesn't have to be)
+    Calls are timed and go through a circuit breaker like bot_api.InstrumentedRequest.
+    """
+    def __init__(self, token, session, loop):
+        self.token = token
+        self.base_url = f'https://api.telegram.org/bot{token}'
+        self.session = session
+        self.loop = loop
+        self.breaker = bot_api.make_breaker()
+        self.id = None
+        self.username = None
+
+    async def call(self, method, **params):
+        data = {key: serialize(value) for key, value in params.items() if value is not None}
+        polling = method == 'getUpdates'
+        timeout = None if polling else aiohttp.ClientTimeout(total=CALL_TIMEOUT)
+        with bot_api.observe(method, None if polling else self.breaker):
+            try:
+                url = f'{self.base_url}/{method}'
+                async with self.session.post(url, json=data, timeout=timeout) as response:
+                    result = await response.json(content_type=None)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                # the same error the library raises, so that the breaker counts it
+                raise telegram.error.NetworkError(f'{method}: {e!r}') from e
+
+            if not result.get('ok'):
+                if result.get('error_code', 0) >= 500:
+                    raise telegram.error.NetworkError(f'{method}: {result.get("description")}')
+                raise telegram.error.TelegramError(f'{method}: {result.get("description")}')
+        return result['result']
+
+    def schedule(self, coroutine):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # called from another thread, ie the profiler
+            return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+        task = asyncio.ensure_future(coroutine)
+        task.add_done_callback(log_task_error)
+        return task
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        method = to_camel_case(name)
+        positional = POSITIONAL_PARAMETERS.get(method, ())
+
+        def call(*args, **kwargs):
+            kwargs.update(zip(positional, args))
+            return self.schedule(self.call(method, **kwargs))
+        return call
+
+
+def is_banned(bot, update, try_inbox):
+    user_id = update.effective_user.id
+    if try_inbox:
+        rate_limiter.try_inbox(user_id, bot)
+    with metrics.phase('ban_check'):
+        return database.is_user_banned(user_id)
+
+
+async def hit(user_id, bot):
+    with metrics.phase('rate_limit'):
+        ban_expiry = rate_limiter.add_pressure(user_id, bot)
+    database.count_event('hit')
+    if ban_expiry:
+        await database.ban_user(
+            user_id, ban_expiry,
+            on_purged=lambda remove_count: rate_limiter.notify_ban(user_id, bot, ban_expiry, remove_count)
+        )
+        database.count_event('ban')
+
+
+@metrics.instrument('on_inline')
+async def on_inline(bot, update):
+    banned = is_banned(bot, update, try_inbox=False)
+    query = update.inline_query.query
+    database.count_event('inline')
+
+    results = []
+    if banned:
+        switch_pm_text = 'Banned! :('
+    elif len(query) >= config.MAX_INLINE_LENGTH:
+        switch_pm_text = 'Too long! Use an advanced spoiler!'
+    else:
+        spoiler = None
+        if query.startswith('id:'):
+            spoiler = await database.get_spoiler(query[3:].strip())
+        switch_pm_text = 'Advanced spoiler (media etc.)…'
+        results = common.build_inline_results(query, spoiler)
+
+    await bot.call(
+        'answerInlineQuery',
+        inline_query_id=update.inline_query.id,
+        results='[' + ','.join(results) + ']',
+        cache_time=1,
+        is_personal=True,
+        switch_pm_text=switch_pm_text,
+        switch_pm_parameter='inline'
+    )
+
+
+@metrics.instrument('on_inline_chosen')
+async def on_inline_chosen(bot, update):
+    result = update.chosen_inline_result
+    uuid = result.result_id
+    user_id = update.effective_user.id
+
+    if decode_uuid(uuid)['ignore']:
+        return
+
+    description, content = common.query_split(result.query)
+
+    if not await database.insert_spoiler(uuid, 'Text', description, content, user_id):
+        # see spoilerobot.on_inline_chosen
+        return
+    common.log_update(update, 'create', 'Text', 'created Text from inline')
+    database.count_event('create', 'Text')
+    await hit(user_id, bot)
+
+
+@metrics.instrument('on_callback_query')
+async def on_callback_query(bot, update, users):
+    uuid = update.callback_query.data
+    from_id = update.callback_query.from_user.id
+
+    if not users[from_id].record_click(uuid):
+        await update.callback_query.answer(
+            text='Please tap again to see the spoiler' if uuid[1:] != 'yes'
+                else 'Please yes yes to see the yes'
+        )
+        return
+
+    spoiler = await database.get_spoiler(uuid, count_view=True)
+    if not spoiler:
+        await update.callback_query.answer(text='Spoiler not found. Too old?')
+        return
+    is_major = decode_uuid(uuid)['is_major']
+
+    common.log_update(update, 'request', spoiler['type'], 'requested %s major=%s', spoiler['type'], is_major)
+    database.count_event('callback', spoiler['type'])
+    await update.callback_query.answer(**common.get_callback_answer(bot, uuid, spoiler))
+
+
+@metrics.instrument('on_message')
+async def on_message(bot, update, users):
+    if not update.message:
+        return
+
+    user_id = update.message.from_user.id
+    user = users[user_id]
+    if user.handle_conversation(bot, update) == 'END':
+        uuid = get_uuid()
+        spoiler_type = user.spoiler_type
+        description, content = user.spoiler_description, user.spoiler_content
+        # reset before awaiting, so that another message can't finish the same spoiler
+        user.reset_state()
+
+        await database.insert_spoiler(uuid, spoiler_type, description, content, user_id)
+        common.log_update(update, 'create', spoiler_type, 'created %s', spoiler_type)
+        database.count_event('create', spoiler_type)
+        await hit(user_id, bot)
+
+        await common.reply_done(update, uuid)
+
+
+@metrics.instrument('cmd_start')
+async def cmd_start(bot, update, args, users):
+    banned = is_banned(bot, update, try_inbox=True)
+    user = users[update.message.from_user.id]
+    if not args:
+        args = ['']
+
+    if args[0] != 'inline':
+        spoiler = await database.get_spoiler(args[0], increment_stats=False)
+        if spoiler:
+            database.count_event('start', spoiler['type'])
+            await common.send_spoiler(bot, update.message.from_user.id, spoiler)
+            return
+
+    if banned:
+        return
+    user.handle_start(bot, update, args[0] == 'inline')
+
+
+async def cmd_views(bot, update, args):
+    if is_banned(bot, update, try_inbox=True):
+        return
+    views = await database.get_views(common.views_arg(args)) if args else None
+    update.message.reply_text(common.get_views_text(args, views))
+
+
+async def cmd_unban(bot, update, args):
+    if update.effective_user.id != config.ADMIN_ID:
+        return
+    if not args:
+        return
+
+    if await database.remove_banned_user(args[0]):
+        update.message.reply_text('Successfully unbanned user.')
+    else:
+        update.message.reply_text('Failed: user was not banned.')
+
+
+async def job_forget_old_owners():
+    row_count = await database.forget_old_owners(config.SPOILER_OWNER_FORGET_AFTER)
+    if row_count:
+        logger.info(f'forgot owners from {row_count} spoiler(s)')
+
+
+def parse_command(message, username):
+    """Returns (command, args) like CommandHandler would, or (None, None)"""
+    text = message.text or ''
+    if not text.startswith('/'):
+        return None, None
+
+    parts = text[1:].split()
+    # a lone '/' (or '/ text') isn't a command, it's a spoiler title like any other text
+    if not parts or text[1].isspace():
+        return None, None
+    command, *args = parts
+    command, _, mention = command.partition('@')
+    if mention and mention.lower() != username.lower():
+        return None, None
+    return command.lower(), args
+
+
+class Engine:
+    """Polls for updates and runs each of them as a task"""
+    def __init__(self, bot):
+        self.bot = bot
+        self.users = defaultdict(User)
+        self.recent_updates = RecentUpdates(config.DEDUPE_WINDOW)
+        self.tasks = set()
+        self.semaphore = asyncio.Semaphore(config.AIO_MAX_CONCURRENCY)
+
+    def queue_depth(self):
+        # updates received but not picked up by a handler yet
+        return max(0, len(self.tasks) - metrics.in_flight())
+
+    async def route(self, update):
+        bot, users = self.bot, self.users
+        if update.inline_query:
+            await on_inline(bot, update)
+        elif update.chosen_inline_result:
+            await on_inline_chosen(bot, update)
+        elif update.callback_query:
+            await on_callback_query(bot, update, users)
+        elif update.message:
+            command, args = parse_command(update.message, bot.username)
+            if command == 'start':
+                await cmd_start(bot, update, args, users)
+            elif command == 'cancel':
+                common.cmd_cancel(bot, update, users)
+            elif command == 'clear':
+                common.cmd_clear(bot, update)
+            elif command == 'help':
+                common.cmd_help(bot, update)
+            elif command == 'views':
+                await cmd_views(bot, update, args)
+            elif command == 'unban':
+                await cmd_unban(bot, update, args)
+            elif command == 'profile':
+                common.cmd_profile(bot, update, args)
+            elif command == 'stats':
+                common.cmd_stats(bot, update)
+            else:
+                await on_message(bot, update, users)
+
+    async def handle(self, data):
+        async with self.semaphore:
+            update = telegram.Update.de_json(data, self.bot)
+            try:
+                await self.route(update)
+            except Exception as e:
+                common.error(self.bot, update, e)
+
+    def dispatch(self, data):
+        # like spoilerobot.drop_duplicate, before the update is even parsed
+        if self.recent_updates.seen(data['update_id']):
+            database.count_event('duplicate')
+            return
+        task = asyncio.ensure_future(self.handle(data))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def poll(self):
+        offset = 0
+        while True:
+            try:
+                updates = await self.bot.call('getUpdates', offset=offset, timeout=POLL_TIMEOUT)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f'getUpdates failed: {e}')
+                await asyncio.sleep(1)
+                continue
+
+            for data in updates:
+                offset = data['update_id'] + 1
+                self.dispatch(data)
+
+
+async def every(interval, function, first=0):
+    """Runs function (which may be a coroutine function) every interval seconds"""
+    await asyncio.sleep(first)
+    while True:
+        try:
+            result = function()
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception:
+            logger.exception(f'job {function} failed')
+        await asyncio.sleep(interval)
+
+
+async def drain(engine, poller, jobs, health):
+    """The same ordered shutdown as spoilerobot.drain"""
+    logger.info('draining updates before shutting down')
+    health.draining = True
+    poller.cancel()
+
+    if engine.tasks:
+        _, pending = await asyncio.wait(list(engine.tasks), timeout=config.SHUTDOWN_DRAIN_TIMEOUT)
+        if pending:
+            logger.warning(f'gave up waiting on {len(pending)} update(s)')
+
+    for job in jobs:
+        job.cancel()
+    await database.wait_for_purges(config.SHUTDOWN_DRAIN_TIMEOUT)
+    # let any fire and forget Bot API calls finish
+    others = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    if others:
+        await asyncio.wait(others, timeout=5)
+
+    live_stats.STATS.flush(final=True)
+    await database.flush(final=True)
+    await database.close()
+    logger.info('shut down cleanly')
+    log.stop()
+
+
+async def main(start_time):
+    global database
+    if len(config.TENANTS) > 1:
+        raise SystemExit('The asyncio engine only serves a single bot, use the threads engine for tenants')
+    if config.SHARDS != ['main'] or config.PREVIOUS_SHARDS:
+        raise SystemExit('The asyncio engine only uses the main database, use the threads engine for shards')
+
+    startup = metrics.StartupTimer(start_time)
+    startup.mark('imports')
+
+    tenant = config.TENANTS[0]
+    loop = asyncio.get_running_loop()
+    database = AsyncDatabase(tenant['name'], tenant['pepper'])
+    # the shared synchronous helpers (ie check_ban) only use the in-memory parts of the database
+    common.databases[tenant['token']] = database
+    await database.connect()
+    startup.mark('connect')
+
+    session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=config.AIO_HTTP_POOL_SIZE),
+        timeout=aiohttp.ClientTimeout(total=POLL_TIMEOUT + 10)
+    )
+    async with session:
+        bot = AsyncBot(tenant['token'], session, loop)
+        me = await bot.call('getMe')
+        bot.id, bot.username = me['id'], me['username']
+        startup.mark('get_me')
+
+        engine = Engine(bot)
+        health = Health(
+            lambda: asyncio.run_coroutine_threadsafe(database.ping(), loop).result(timeout=5),
+            engine.queue_depth
+        )
+        health.register()
+        common.add_metric_collectors(engine.queue_depth)
+        metrics.serve(config.METRICS_HOST, config.METRICS_PORT)
+        startup.mark('metrics')
+
+        stop = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+            loop.add_signal_handler(signum, stop.set)
+
+        logger.info(f'polling as @{bot.username} with the asyncio engine')
+        poller = asyncio.ensure_future(engine.poll())
+
+        # started after the poller, like spoilerobot.add_jobs
+        jobs = [
+            asyncio.ensure_future(database.warm_up_hot_spoilers()),
+            asyncio.ensure_future(every(5, database.store_request_count, first=5)),
+            asyncio.ensure_future(every(5, live_stats.STATS.flush, first=5)),
+            asyncio.ensure_future(every(5, database.store_view_counts, first=5)),
+            asyncio.ensure_future(every(60, job_forget_old_owners, first=60)),
+            asyncio.ensure_future(every(
+                config.SPOOL_RETRY_INTERVAL, database.replay_spool, first=config.SPOOL_RETRY_INTERVAL
+            )),
+            asyncio.ensure_future(every(5, database.hot_spoilers.update, first=5)),
+            asyncio.ensure_future(every(
+                config.HOT_SPOILERS_SNAPSHOT_INTERVAL, database.hot_spoilers.snapshot,
+                first=config.HOT_SPOILERS_SNAPSHOT_INTERVAL
+            )),
+        ]
+        startup.mark('polling')
+        startup.report()
+
+        await stop.wait()
+        await drain(engine, poller, jobs, health)
+
+
+def run(start_time):
+    """start_time is when the process started, see metrics.StartupTimer"""
+    log.setup()
+    asyncio.run(main(start_time))
@@ -0,0 +1,436 @@
+import asyncio
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import asyncpg
+
+import config
+import live_stats
+import metrics
+from counters import StripedCounter
+from database import (
+    SCHEMA, SCHEMA_VERSION, derive_key, hash_uuid, split_uuid, encode_spoiler, encrypt, decrypt
+)
+from hot_spoilers import HotSpoilers
+from shm_cache import open_shared_cache
+from spool import Spool, to_rows
+from util import tenant_path, timestamp_floor
+
+logger = logging.getLogger(__name__)
+
+# errors that mean the database is down or too slow, rather than something wrong with the query
+UNAVAILABLE_ERRORS = (
+    OSError, asyncio.TimeoutError, asyncpg.PostgresConnectionError, asyncpg.InterfaceError
+)
+
+
+def decrypt_v1(uuid, salt, token):
+    return decrypt(derive_key(uuid, salt), token)
+
+
+class AsyncDatabase:
+    """
+    The same storage as Database, for the asyncio engine (see aio.py)
+    Queries go through an asyncpg pool and encryption runs on a thread pool,
+    so the event loop is never blocked by either.
+    Hashing the uuid stays on the loop, it's cheaper than a trip to the thread pool.
+    """
+    def __init__(self, tenant='', pepper=None):
+        self.tenant = tenant
+        self.pepper = config.HASH_PEPPER if pepper is None else pepper
+        # counts of (event, spoiler type) since the last flush
+        self.event_counts = StripedCounter(keep_totals=True)
+        # views of each spoiler (by hash) since the last flush
+        self.view_counts = StripedCounter()
+        self.hot_spoilers = HotSpoilers(
+            config.HOT_SPOILERS_TRACKED, config.HOT_SPOILERS_CACHED,
+            tenant_path(config.HOT_SPOILERS_FILE, tenant),
+            open_shared_cache(tenant)
+        )
+        self.crypto_executor = ThreadPoolExecutor(
+            max_workers=config.AIO_CRYPTO_WORKERS, thread_name_prefix='crypto'
+        )
+        # spoilers created while the database was unavailable
+        self.spool = Spool(tenant_path(config.SPOOL_FILE, tenant))
+        self.unavailable_until = 0
+        self.retry_interval = config.SPOOL_RETRY_INTERVAL
+        # running purges of banned users' spoilers
+        self.purges = set()
+        self.pool = None
+        self.banned_users = {}
+
+    async def connect(self):
+        self.pool = await asyncpg.create_pool(
+            database=config.DB_NAME,
+            user=config.DB_USERNAME,
+            host=config.DB_HOST,
+            password=config.DB_PASSWORD,
+            min_size=1,
+            max_size=config.AIO_DB_POOL_SIZE,
+            timeout=config.DB_CONNECT_TIMEOUT
+        )
+        # see database.SCHEMA_VERSION
+        await self.pool.execute('CREATE TABLE IF NOT EXISTS schema_version (version TEXT PRIMARY KEY)')
+        if not await self.pool.fetchval('SELECT 1 FROM schema_version WHERE version = $1', SCHEMA_VERSION):
+            for statement in SCHEMA:
+                await self.pool.execute(statement)
+            await self.pool.execute(
+                'INSERT INTO schema_version (version) VALUES ($1) ON CONFLICT DO NOTHING', SCHEMA_VERSION
+            )
+
+        # expired bans are deleted first, like Database.get_banned_users
+        now = int(time.time())
+        await self.pool.execute('DELETE FROM banned_users WHERE tenant = $1 AND expires <= $2', self.tenant, now)
+        # streamed in chunks
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                self.banned_users = {
+                    int(user_id): int(expires)
+                    async for user_id, expires in connection.cursor(
+                        'SELECT user_id, expires FROM banned_users WHERE tenant = $1 AND expires > $2',
+                        self.tenant, now,
+                        prefetch=config.BAN_LOAD_CHUNK_SIZE
+                    )
+                }
+
+    async def close(self):
+        await self.pool.close()
+        self.crypto_executor.shutdown()
+        self.spool.close()
+        if self.hot_spoilers.shared:
+            self.hot_spoilers.shared.close()
+
+    def mark_unavailable(self, error):
+        logger.warning(f'database unavailable, retrying in {self.retry_interval}s: {error!r}')
+        self.unavailable_until = time.time() + self.retry_interval
+        self.retry_interval = min(self.retry_interval * 2, config.SPOOL_MAX_RETRY_INTERVAL)
+
+    async def ping(self):
+        await self.pool.fetchval('SELECT 1')
+
+    async def flush(self, final=False):
+        await self.store_request_count(final=final)
+        await self.store_view_counts(final=final)
+        self.hot_spoilers.snapshot()
+        await self.replay_spool()
+
+    async def fetch(self, method, query, *args):
+        """Runs a query through the pool, attributing the time spent to the db phase"""
+        with metrics.phase('db', query.split(None, 1)[0].lower()):
+            return await getattr(self.pool, method)(query, *args)
+
+    async def run_crypto(self, step, function, *args):
+        with metrics.phase('crypto', step):
+            return await asyncio.get_running_loop().run_in_executor(
+                self.crypto_executor, function, *args
+            )
+
+    async def forget_old_owners(self, forget_time):
+        status = await self.fetch(
+            'execute',
+            'UPDATE spoilers_v2 SET owner = 0 WHERE timestamp <= $1 AND owner > 0 AND tenant = $2',
+            int(time.time() - forget_time), self.tenant
+        )
+        return int(status.split()[-1])
+
+    # banned user management
+    async def ban_user(self, user_id, expires, on_purged=None):
+        self.banned_users[user_id] = expires
+        await self.fetch(
+            'execute',
+            '''
+            INSERT INTO banned_users (tenant, user_id, expires) VALUES ($1, $2, $3)
+            ON CONFLICT (tenant, user_id) DO UPDATE
+            SET expires = $3
+            ''',
+            self.tenant, user_id, int(expires)
+        )
+
+        spooled = await asyncio.get_running_loop().run_in_executor(
+            None, self.spool.remove_owner, user_id
+        )
+        task = asyncio.ensure_future(self.purge(user_id, spooled, on_purged))
+        self.purges.add(task)
+        task.add_done_callback(self.purges.discard)
+
+    async def purge(self, owner, count, on_purged):
+        """The same batched purge as purge.Purger, as a task"""
+        try:
+            while True:
+                rows = await self.fetch(
+                    'fetch',
+                    '''
+                    DELETE FROM spoilers_v2 WHERE hash IN (
+                        SELECT hash FROM spoilers_v2 WHERE owner = $1 AND tenant = $2 LIMIT $3
+                    ) RETURNING hash
+                    ''',
+                    owner, self.tenant, config.PURGE_BATCH_SIZE
+                )
+                for row in rows:
+                    self.hot_spoilers.invalidate(bytes(row['hash']))
+                count += len(rows)
+                if len(rows) < config.PURGE_BATCH_SIZE and not await self.fetch(
+                    'fetchval',
+                    'SELECT 1 FROM spoilers_v2 WHERE owner = $1 AND tenant = $2 LIMIT 1',
+                    owner, self.tenant
+                ):
+                    break
+                await asyncio.sleep(config.PURGE_PAUSE)
+            logger.info(f'purged {count} spoiler(s) of {owner}')
+        except Exception:
+            logger.exception(f'purge of {owner} failed after {count} spoiler(s)')
+
+        if on_purged:
+            on_purged(count)
+
+    async def wait_for_purges(self, timeout):
+        if self.purges:
+            await asyncio.wait(list(self.purges), timeout=timeout)
+
+    def is_user_banned(self, user_id):
+        user_id = int(user_id)
+        if user_id not in self.banned_users:
+            return False
+
+        if time.time() < self.banned_users[user_id]:
+            return True
+
+        # the ban has expired, forget it in the background
+        asyncio.ensure_future(self.remove_banned_user(user_id))
+        return False
+
+    async def remove_banned_user(self, user_id):
+        user_id = int(user_id)
+        if user_id not in self.banned_users:
+            return False
+
+        del self.banned_users[user_id]
+        await self.fetch(
+            'execute', 'DELETE FROM banned_users WHERE user_id = $1 AND tenant = $2', user_id, self.tenant
+        )
+        return True
+
+    # statistics
+    def count_event(self, event, spoiler_type=''):
+        self.event_counts.incr((event, spoiler_type))
+        live_stats.STATS.count(event, spoiler_type)
+
+    async def store_request_count(self, final=False):
+        counts = self.event_counts.collect(final=final)
+        if not counts:
+            return
+
+        timestamp = timestamp_floor(config.REQUEST_COUNT_RESOLUTION)
+        keys = list(counts)
+        # insert all the counts at once and add to them if there's a conflict
+        await self.fetch(
+            'execute',
+            '''
+            INSERT INTO requests (tenant, timestamp, event, type, count)
+            SELECT $1, $2, * FROM unnest($3::text[], $4::text[], $5::integer[])
+            ON CONFLICT (tenant, timestamp, event, type) DO UPDATE
+            SET count = requests.count + EXCLUDED.count
+            ''',
+            self.tenant,
+            timestamp,
+            [event for event, _ in keys],
+            [spoiler_type for _, spoiler_type in keys],
+            [counts[key] for key in keys]
+        )
+
+    async def store_view_counts(self, final=False):
+        counts = self.view_counts.collect(final=final)
+        if not counts:
+            return
+
+        hashes = sorted(counts)
+        await self.fetch(
+            'execute',
+            '''
+            UPDATE spoilers_v2 SET views = spoilers_v2.views + v.count
+            FROM unnest($1::bytea[], $2::integer[]) AS v (hash, count)
+            WHERE spoilers_v2.hash = v.hash
+            ''',
+            hashes,
+            [counts[db_hash] for db_hash in hashes]
+        )
+
+    async def get_views(self, uuid):
+        uuid = uuid[1:]
+        if not uuid or uuid == 'yes':
+            return None
+
+        with metrics.phase('crypto', 'hash'):
+            db_hash, _ = split_uuid(uuid, self.pepper)
+        return await self.fetch('fetchval', 'SELECT views FROM spoilers_v2 WHERE hash = $1', db_hash)
+
+    # hot spoiler caching
+    async def warm_up_hot_spoilers(self):
+        hashes = self.hot_spoilers.load_snapshot()
+        if not hashes:
+            return
+
+        generation = self.hot_spoilers.generation
+        rows = await self.pool.fetch(
+            'SELECT hash, token FROM spoilers_v2 WHERE hash = ANY($1::bytea[])', hashes
+        )
+        self.hot_spoilers.warm_up(((row['hash'], row['token']) for row in rows), generation)
+
+    # spoiler management
+    async def insert_spoiler(self, uuid, content_type, description, content, owner):
+        """Returns False if the spoiler was already stored (see Database.insert_spoiler)"""
+        # Slice away the first character since it stores instance specific data
+        uuid = uuid[1:]
+        if uuid == 'yes':
+            return True
+
+        with metrics.phase('crypto', 'hash'):
+            db_hash, key = split_uuid(uuid, self.pepper)
+        if self.spool.get_token(db_hash):
+            # delivered twice while the database was unavailable, it's still waiting in the spool
+            return False
+        token = await self.run_crypto(
+            'encrypt', encrypt, key, encode_spoiler(content_type, description, content)
+        )
+        if time.time() < self.unavailable_until:
+            await self.append_to_spool(db_hash, token, owner)
+            return True
+
+        try:
+            # cancelling the wait cancels the query too
+            status = await asyncio.wait_for(
+                self.fetch(
+                    'execute',
+                    'INSERT INTO spoilers_v2 (hash, token, owner, tenant) VALUES ($1, $2, $3, $4) '
+                    'ON CONFLICT (hash) DO NOTHING',
+                    db_hash, token, owner, self.tenant
+                ),
+                config.SPOOL_INSERT_TIMEOUT
+            )
+            # the status is 'INSERT 0 <rows>'
+            return status == 'INSERT 0 1'
+        except UNAVAILABLE_ERRORS as e:
+            self.mark_unavailable(e)
+            await self.append_to_spool(db_hash, token, owner)
+            return True
+
+    async def append_to_spool(self, db_hash, token, owner):
+        # the fsync would block the loop
+        await asyncio.get_running_loop().run_in_executor(
+            None, self.spool.append, db_hash, token, owner, int(time.time())
+        )
+
+    async def replay_spool(self):
+        if not len(self.spool) or time.time() < self.unavailable_until:
+            return
+
+        try:
+            while len(self.spool):
+                batch = self.spool.take(config.SPOOL_REPLAY_BATCH)
+                await self.insert_spooled(to_rows(batch))
+                self.spool.forget(batch)
+        except UNAVAILABLE_ERRORS as e:
+            self.mark_unavailable(e)
+            return
+        finally:
+            # rewriting the file would block the loop
+            await asyncio.get_running_loop().run_in_executor(None, self.spool.compact)
+
+        self.retry_interval = config.SPOOL_RETRY_INTERVAL
+        logger.info('replayed the spool into the database')
+
+    async def insert_spooled(self, rows):
+        await self.fetch(
+            'executemany',
+            '''
+            INSERT INTO spoilers_v2 (hash, timestamp, token, owner, tenant) VALUES ($1, $2, $3, $4, $5)
+            ON CONFLICT (hash) DO NOTHING
+            ''',
+            [row + (self.tenant,) for row in rows]
+        )
+
+    async def get_spoiler_v1(self, uuid, increment_stats=True):
+        if self.tenant:
+            # the v1 schema predates tenants
+            return None
+
+        with metrics.phase('crypto', 'hash'):
+            db_hash = hash_uuid(uuid)
+        spoiler = await self.fetch(
+            'fetchrow', 'SELECT timestamp, salt, token FROM spoilers WHERE hash = $1', db_hash
+        )
+        if not spoiler:
+            return None
+
+        data = await self.run_crypto(
+            'decrypt', decrypt_v1, uuid, bytes(spoiler['salt']), bytes(spoiler['token'])
+        )
+        if data is None:
+            return None
+
+        # move it to the new schema
+        with metrics.phase('crypto', 'hash'):
+            new_hash, key = split_uuid(uuid, self.pepper)
+        token = await self.run_crypto('encrypt', encrypt, key, data)
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                await connection.execute(
+                    'INSERT INTO spoilers_v2 (timestamp, hash, token, owner) VALUES ($1, $2, $3, 0)',
+                    spoiler['timestamp'], new_hash, token
+                )
+                await connection.execute('DELETE FROM spoilers WHERE hash = $1', db_hash)
+
+        spoiler = json.loads(data)
+        if increment_stats:
+            self.count_event('request', spoiler['type'])
+        return spoiler
+
+    async def get_spoiler(self, uuid, increment_stats=True, count_view=False):
+        uuid = uuid[1:]
+        if not uuid:
+            return None
+
+        if uuid == 'yes':
+            return {
+                'type': 'Text',
+                'description': '',
+                'content': 'Yes',
+            }
+
+        with metrics.phase('crypto', 'hash'):
+            db_hash, key = split_uuid(uuid, self.pepper)
+
+        self.hot_spoilers.record(db_hash)
+        token = self.hot_spoilers.get_token(db_hash)
+        if token:
+            self.count_event('cache_hit')
+        else:
+            self.count_event('cache_miss')
+            token = self.spool.get_token(db_hash)
+
+        if not token:
+            generation = self.hot_spoilers.generation
+            token = await self.fetch(
+                'fetchval', 'SELECT token FROM spoilers_v2 WHERE hash = $1', db_hash
+            )
+            if token is None:
+                spoiler = await self.get_spoiler_v1(uuid, increment_stats)
+                if spoiler and count_view:
+                    self.view_counts.incr(db_hash)
+                return spoiler
+
+            token = bytes(token)
+            self.hot_spoilers.offer_token(db_hash, token, generation)
+
+        data = await self.run_crypto('decrypt', decrypt, key, token)
+        if data is None:
+            return None
+
+        spoiler = json.loads(data)
+        if increment_stats:
+            self.count_event('request', spoiler['type'])
+        if count_view:
+            self.view_counts.incr(db_hash)
+        return spoiler
@@ -0,0 +1,179 @@
+"""
+Micro-benchmarks for the code that runs on every inline query and tap
+
+    python benchmark.py --save        # record benchmark_baseline.json
+    python benchmark.py               # compare against it, exits with 1 on a regression
+
+Each benchmark is timed with gc disabled over several repeats and the fastest
+repeat is used, which is the most stable figure on a noisy machine.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import timeit
+
+# the benchmarks never talk to telegram or the database, but config insists on these
+for variable in ('tg_bot_spoilero', 'tg_bot_spoilero_db_pwd', 'tg_spoilero_pepper'):
+    os.environ.setdefault(variable, 'benchmark')
+os.environ.setdefault('tg_bot_spoilero_admin', '0')
+
+from cryptography.fernet import Fernet
+from telegram import (
+    InlineQueryResultArticle, InputTextMessageContent,
+    InlineKeyboardMarkup, InlineKeyboardButton
+)
+
+import util
+from database import split_uuid, hash_uuid, derive_key
+from common import query_split, get_inline_results
+
+BASELINE_FILE = 'benchmark_baseline.json'
+
+# payloads for the size sweeps: short inline text up to a long formatted message
+PAYLOADS = {
+    'short': json.dumps({'type': 'Text', 'description': '', 'content': 'he dies at the end'}).encode(),
+    'medium': json.dumps({'type': 'Text', 'description': 'ending', 'content': 'spoiler ' * 32}).encode(),
+    'large_html': json.dumps({
+        'type': 'HTML',
+        'description': 'the whole plot',
+        'content': '<b>chapter</b> <i>one</i> <a href="https://example.com">link</a>\n' * 60
+    }).encode(),
+}
+
+
+# the fields of the two articles of an inline answer, fed to both serializers
+ANSWER_ARTICLES = (
+    ('Major Spoiler', 'https://i.imgur.com/6oSoT16.png', 'Text, custom title, double tap',
+     '<b>Major Spoiler!</b> <pre>a custom title</pre>', 'Double tap to show spoiler'),
+    ('Minor Spoiler', 'https://i.imgur.com/qrViKOz.png', 'Text, custom title, single tap',
+     '<i>Minor Spoiler</i> <pre>a custom title</pre>', 'Show spoiler'),
+)
+
+
+def build_answer_objects(uuid):
+    """How answers were built before ArticleTemplate, kept for comparison"""
+    results = [
+        InlineQueryResultArticle(
+            id=uuid,
+            title=title,
+            description=description,
+            thumb_url=thumb_url,
+            thumb_width=512,
+            thumb_height=512,
+            input_message_content=InputTextMessageContent(
+                message_text=text,
+                parse_mode='HTML'
+            ),
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(
+                text=button,
+                callback_data=uuid
+            )]])
+        )
+        for title, thumb_url, description, text, button in ANSWER_ARTICLES
+    ]
+    return json.dumps({'inline_query_id': '1', 'results': [result.to_dict() for result in results]})
+
+
+def build_answer_template(templates, uuid):
+    """The same answer as build_answer_objects, serialized with ArticleTemplate"""
+    results = [
+        template.render(uuid, description, text, util.get_button_json(button, callback_data=uuid))
+        for template, (_, _, description, text, button) in zip(templates, ANSWER_ARTICLES)
+    ]
+    return json.dumps({'inline_query_id': '1', 'results': '[' + ','.join(results) + ']'})
+
+
+def get_benchmarks():
+    """Returns a dict of name -> zero argument callable"""
+    uuid = util.get_uuid(is_major=True)
+    _, key = split_uuid(uuid[1:])
+    fernet = Fernet(key)
+    salt = os.urandom(16)
+    templates = [util.ArticleTemplate(title, thumb_url) for title, thumb_url, *_ in ANSWER_ARTICLES]
+
+    benchmarks = {
+        'gen_uuid': util.gen_uuid,
+        'get_uuid': lambda: util.get_uuid(is_major=True),
+        'decode_uuid': lambda: util.decode_uuid(uuid),
+        'split_uuid': lambda: split_uuid(uuid),
+        'hash_uuid': lambda: hash_uuid(uuid),
+        'derive_key': lambda: derive_key(uuid, salt),
+        'fernet_key': lambda: Fernet(key),
+        'query_split': lambda: query_split('a custom title:::and the spoiler itself'),
+        'query_split_plain': lambda: query_split('just the spoiler itself'),
+        'inline_results': lambda: get_inline_results('a custom title:::and the spoiler itself'),
+        'inline_results_plain': lambda: get_inline_results('just the spoiler itself'),
+        # the same answer body, serialized as before and after ArticleTemplate
+        'inline_answer_objects': lambda: build_answer_objects(uuid),
+        'inline_answer_template': lambda: build_answer_template(templates, uuid),
+    }
+    for size, payload in PAYLOADS.items():
+        token = fernet.encrypt(payload)
+        benchmarks[f'encrypt_{size}'] = lambda payload=payload: fernet.encrypt(payload)
+        benchmarks[f'decrypt_{size}'] = lambda token=token: fernet.decrypt(token)
+        benchmarks[f'decrypt_decode_{size}'] = lambda token=token: json.loads(fernet.decrypt(token))
+    return benchmarks
+
+
+def measure(function, repeat, min_time):
+    """Returns (fastest, median) seconds per call"""
+    timer = timeit.Timer(function)
+    # pick a loop count so that one repeat takes at least min_time
+    number = 1
+    while True:
+        if timer.timeit(number) >= min_time:
+            break
+        number *= 2
+    timings = [t / number for t in timer.repeat(repeat=repeat, number=number)]
+    return min(timings), statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--save', action='store_true', help=f'write the results to {BASELINE_FILE}')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='baseline file to read or write')
+    parser.add_argument('--threshold', type=float, default=0.15,
+                        help='fail if a benchmark is this fraction slower than the baseline')
+    parser.add_argument('--repeat', type=int, default=7)
+    parser.add_argument('--min-time', type=float, default=0.05, help='minimum seconds per repeat')
+    parser.add_argument('filter', nargs='*', help='only run benchmarks containing one of these')
+    args = parser.parse_args()
+
+    baseline = {}
+    if not args.save and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+    results = {}
+    regressions = []
+    for name, function in get_benchmarks().items():
+        if args.filter and not any(part in name for part in args.filter):
+            continue
+
+        fastest, median = measure(function, args.repeat, args.min_time)
+        results[name] = {'fastest_ns': fastest * 1e9, 'median_ns': median * 1e9}
+
+        line = f'{name:<28}{fastest * 1e6:>12.2f} us{median * 1e6:>12.2f} us (median)'
+        if name in baseline:
+            change = fastest * 1e9 / baseline[name]['fastest_ns'] - 1
+            line += f'{change:>+10.1%}'
+            if change > args.threshold:
+                regressions.append(name)
+                line += '  REGRESSION'
+        print(line)
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump({'python': sys.version, 'results': results}, f, indent=2, sort_keys=True)
+        print(f'saved baseline to {args.baseline}')
+
+    if regressions:
+        print(f'{len(regressions)} benchmark(s) regressed by more than {args.threshold:.0%}: '
+              + ', '.join(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from telegram import Bot
+from telegram.error import BadRequest, NetworkError
+from telegram.utils.request import Request
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+BOT_API_SECONDS = metrics.Histogram(
+    'spoilerobot_bot_api_seconds',
+    'Latency of Bot API calls',
+    ('method',)
+)
+# (method, error class) -> count
+_errors = {}
+_errors_lock = threading.Lock()
+# every InstrumentedRequest and CircuitBreaker, for the metrics
+_requests = []
+_breakers = []
+
+
+class CircuitOpen(NetworkError):
+    """Raised instead of calling the Bot API while it's failing"""
+
+
+class CircuitBreaker:
+    """
+    Fails Bot API calls right away once `failures` calls in a row timed out or got a server
+    error, so that the workers aren't all stuck waiting on a degraded Telegram.
+    After reset_timeout seconds a single call is let through, if it succeeds calls resume.
+    """
+    def __init__(self, failures, reset_timeout):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failed = 0
+        self.opened_at = None
+        # whether the call testing if the Bot API recovered is in progress
+        self.probing = False
+        _breakers.append(self)
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def check(self, method):
+        """Raises CircuitOpen if method shouldn't be called right now"""
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if self.probing or time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpen(f'{method}: not calling the Bot API while it is failing')
+            self.probing = True
+
+    def record(self, ok):
+        with self.lock:
+            self.probing = False
+            if ok:
+                if self.opened_at is not None:
+                    logger.info('the Bot API recovered, closing the circuit')
+                self.failed = 0
+                self.opened_at = None
+                return
+
+            self.failed += 1
+            if self.opened_at is None and self.failed >= self.failures:
+                logger.warning(f'{self.failed} Bot API calls failed in a row, opening the circuit')
+            if self.opened_at is not None or self.failed >= self.failures:
+                self.opened_at = time.monotonic()
+
+
+def is_degraded(error):
+    """Timeouts and server errors mean Telegram is struggling, other errors are answers"""
+    return (
+        isinstance(error, NetworkError)
+        and not isinstance(error, (BadRequest, CircuitOpen))
+    )
+
+
+def count_error(method, error):
+    with _errors_lock:
+        key = (method, type(error).__name__)
+        _errors[key] = _errors.get(key, 0) + 1
+
+
+@contextmanager
+def observe(method, breaker=None):
+    """Times a Bot API call (and counts its errors), going through breaker if there's one"""
+    if breaker:
+        try:
+            breaker.check(method)
+        except CircuitOpen as e:
+            count_error(method, e)
+            raise
+    start = time.perf_counter()
+    try:
+        with metrics.phase('telegram', method):
+            yield
+    except Exception as e:
+        count_error(method, e)
+        if breaker:
+            breaker.record(not is_degraded(e))
+        raise
+    else:
+        if breaker:
+            breaker.record(True)
+    finally:
+        BOT_API_SECONDS.observe(time.perf_counter() - start, method)
+
+
+class InstrumentedRequest(Request):
+    """
+    The library's connection pool (which keeps connections alive), timed by Bot API method
+    and behind a circuit breaker. getUpdates skips the breaker, the updater retries it anyway.
+    """
+    def __init__(self, breaker, con_pool_size, **kwargs):
+        super().__init__(con_pool_size=con_pool_size, **kwargs)
+        self.breaker = breaker
+        self.pool_size = con_pool_size
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        # calls made while every pooled connection was in use
+        self.exhausted = 0
+        _requests.append(self)
+
+    def post(self, url, data, timeout=None):
+        method = url.rsplit('/', 1)[-1]
+        with self.lock:
+            self.in_flight += 1
+            if self.in_flight > self.pool_size:
+                self.exhausted += 1
+        try:
+            with observe(method, None if method == 'getUpdates' else self.breaker):
+                return super().post(url, data, timeout)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+def make_breaker():
+    return CircuitBreaker(config.BOT_API_BREAKER_FAILURES, config.BOT_API_BREAKER_RESET_TIMEOUT)
+
+
+def make_bot(token):
+    """A bot whose connection pool fits the dispatcher's workers, the job queue and the updater"""
+    request = InstrumentedRequest(make_breaker(), con_pool_size=config.WORKERS + 4)
+    return Bot(token, request=request)
+
+
+def expose():
+    with _errors_lock:
+        errors = dict(_errors)
+    lines = BOT_API_SECONDS.expose()
+    lines += metrics.counter(
+        'spoilerobot_bot_api_errors_total',
+        'Failed Bot API calls by method and error',
+        ('method', 'error'),
+        errors
+    )
+    lines += metrics.gauge(
+        'spoilerobot_bot_api_in_flight',
+        'Bot API calls in progress',
+        sum(request.in_flight for request in _requests)
+    )
+    lines += metrics.counter(
+        'spoilerobot_bot_api_pool_exhausted_total',
+        'Bot API calls made while every pooled connection was in use',
+        (),
+        {(): sum(request.exhausted for request in _requests)}
+    )
+    lines += metrics.gauge(
+        'spoilerobot_bot_api_open_circuits',
+        'Bots whose Bot API calls are failing fast',
+        sum(breaker.is_open for breaker in _breakers)
+    )
+    return lines
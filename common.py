@@ -0,0 +1,288 @@
+"""
+What the two engines share: the tenants' databases, the helpers that build the
+answers, and the handlers that don't wait on the database (which aio.py calls as they are)
+The threads engine is in spoilerobot.py and the asyncio one in aio.py.
+"""
+import logging
+
+from util import *
+from config import ADMIN_ID, MINOR_SPOILER_CACHE_TIME, PROFILE_SAMPLE_INTERVAL, PROFILE_MAX_DURATION
+import handlers
+import live_stats
+import metrics
+import profiler
+import rate_limiter
+
+logger = logging.getLogger(__name__)
+
+
+# store image urls as variables so it's easier to understand what they are
+IMAGE_MINOR = 'https://i.imgur.com/qrViKOz.png'
+IMAGE_MAJOR = 'https://i.imgur.com/6oSoT16.png'
+
+ARTICLE_MAJOR = ArticleTemplate('Major Spoiler', IMAGE_MAJOR)
+ARTICLE_MINOR = ArticleTemplate('Minor Spoiler', IMAGE_MINOR)
+
+# bot token -> the database of the tenant served by that bot (see config.TENANTS)
+databases = {}
+
+
+def get_database(bot):
+    return databases[bot.token]
+
+
+def check_ban(try_inbox, pass_ban):
+    """
+    Performs actions if a user is banned
+    decorates a function where the first two parameters are bot, update
+
+    try_inbox: if True, and the user has a non-empty inbox, sends the inbox
+    pass_ban: if True and the user is banned,
+        function is called with a banned keyword argument,
+        otherwise function is called if the user is not banned
+    """
+    def _real(function):
+        def wrapped(bot, update, *args, **kwargs):
+            user_id = update.effective_user.id
+            if try_inbox:
+                rate_limiter.try_inbox(user_id, bot)
+
+            with metrics.phase('ban_check'):
+                banned = get_database(bot).is_user_banned(user_id)
+            if banned and not pass_ban:
+                return lambda: None
+            if pass_ban:
+                return function(bot, update, *args, **kwargs, banned=banned)
+            else:
+                return function(bot, update, *args, **kwargs)
+        return wrapped
+
+    return _real
+
+
+def query_split(query):
+    """Attempts to split a query into a tuple of (description, content)"""
+    temp_split = [split.strip() for split in query.split(':::', 1)]
+    if len(temp_split) >= 2 and temp_split[0] and temp_split[1]:
+        return temp_split[0], temp_split[1]
+    return '', query.strip()
+
+
+def get_inline_results(query, database=None):
+    spoiler = None
+    if query.startswith('id:') and database:
+        spoiler = database.get_spoiler(query[3:].strip())
+    return build_inline_results(query, spoiler)
+
+
+def build_inline_results(query, spoiler):
+    """Builds the results for a query, spoiler is the one looked up for id: queries"""
+    old_uuid = None
+    content_type = 'Text'
+    content = ''
+    description = ''
+    if query.startswith('id:'):
+        uuid = query[3:].strip()
+        if spoiler:
+            old_uuid = uuid
+            description = spoiler['description']
+            content = spoiler['content']
+            content_type = spoiler['type']
+        else:
+            content_type = 'Text (id not found)'
+
+    if not old_uuid:
+        description, content = query_split(query)
+    if not content:
+        return []
+
+    is_url = isinstance(content, str) and content.startswith('http')
+    if is_url:
+        def get_inline_keyboard(text):
+            return get_button_json('Show spoiler', url=content)
+        content_type = 'URL'
+    else:
+        def get_inline_keyboard(text):
+            return get_button_json(text, callback_data=uuid)
+
+    # modify the inline description and reply text of the result if a custom title has been set
+    if description and content:
+        description = f'<pre>{html_escape(description)}</pre>'
+        description_fmt = f'{content_type}, custom title, {{}}'
+        text_fmt = '<{0}>{1}:</{0}> {3}'
+    else:
+        description_fmt = f'{content_type}, {{}}'
+        text_fmt = '<{0}>{1}{2}</{0}>'
+        if content == 'yes':
+            text_fmt = '<{0}>Yes{2}</{0}>'
+            def get_inline_keyboard(text):
+                return get_button_json(
+                    'Yes yes' if 'Double' in text else 'Yes',
+                    callback_data=uuid
+                )
+            old_uuid = '0yes'
+
+    results = []
+    # add options to our results (already serialized, see ArticleTemplate)
+    uuid = get_uuid(is_major=True, ignore=is_url, old=old_uuid)
+    results.append(ARTICLE_MAJOR.render(
+        uuid=uuid,
+        description=description_fmt.format('double tap'),
+        text=text_fmt.format('b', 'Major Spoiler', '!', description),
+        button=get_inline_keyboard('Double tap to show spoiler')
+    ))
+
+    uuid = get_uuid(is_major=False, ignore=is_url, old=old_uuid)
+    results.append(ARTICLE_MINOR.render(
+        uuid=uuid,
+        description=description_fmt.format('single tap'),
+        text=text_fmt.format('i', 'Minor Spoiler', '', description),
+        button=get_inline_keyboard('Show spoiler')
+    ))
+
+    return results
+
+
+def send_spoiler(bot, user_id, spoiler):
+    return getattr(handlers, spoiler['type']).send(
+        bot,
+        user_id,
+        content=spoiler['content']
+    )
+
+
+def get_callback_answer(bot, uuid, spoiler):
+    """Returns the arguments to answer a tap on a spoiler with"""
+    if spoiler['type'] == 'Text' and len(spoiler['content']) <= 200:
+        return {
+            'text': spoiler['content'],
+            'show_alert': True,
+            'cache_time': 0 if decode_uuid(uuid)['is_major'] else MINOR_SPOILER_CACHE_TIME
+        }
+    return {'url': f't.me/{bot.username}?start={uuid}'}
+
+
+def reply_done(update, uuid):
+    return update.message.reply_text(
+        text='Done! Your advanced spoiler is ready.\n\n'
+        'To see how many times it was opened, send:\n'
+        f'<code>/views {uuid}</code>',
+        parse_mode='HTML',
+        reply_markup=get_single_buttton_inline_keyboard(
+            'Send it',
+            switch_inline_query='id:'+uuid
+        )
+    )
+
+
+@check_ban(try_inbox=True, pass_ban=False)
+def cmd_cancel(bot, update, users):
+    users[update.message.from_user.id].handle_cancel(bot, update)
+
+
+@check_ban(try_inbox=True, pass_ban=False)
+def cmd_clear(bot, update):
+    update.message.reply_text(250 * '.\n')
+
+
+@check_ban(try_inbox=True, pass_ban=False)
+def cmd_help(bot, update):
+    update.message.reply_text(
+        text='Type /start to prepare an advanced spoiler with a custom title.\n\n'
+        'You can type quick spoilers by using @SpoileroBot in inline mode:\n'
+        '<pre>@SpoileroBot spoiler here…</pre>\n\n'
+        'Custom titles can also be used from inline mode as follows:\n'
+        '<pre>@SpoileroBot title for the spoiler:::contents of the spoiler</pre>\n'
+        'Note that the title will be immediately visible!\n\n'
+        'Type /views followed by the id of an advanced spoiler to see how many times it was opened.',
+        parse_mode='HTML'
+    )
+
+
+def get_views_text(args, views):
+    """The reply to /views, given its args and the view count (None if not found)"""
+    if not args:
+        return 'Usage: /views <spoiler id>'
+    if views is None:
+        return 'Spoiler not found. Too old?'
+    return f'Opened {views} time(s). Views are updated every few seconds.'
+
+
+def views_arg(args):
+    """The uuid given to /views, which may be copied from an inline query (id:...)"""
+    uuid = args[0] if args else ''
+    return uuid[3:] if uuid.startswith('id:') else uuid
+
+
+def cmd_stats(bot, update):
+    """Traffic of the last 24 hours, answered from memory so that it works during incidents"""
+    if update.effective_user.id != ADMIN_ID:
+        return
+
+    update.message.reply_text(live_stats.STATS.report())
+
+
+def cmd_profile(bot, update, args):
+    """Samples every thread for a few seconds and writes a collapsed stack file"""
+    if update.effective_user.id != ADMIN_ID:
+        return
+
+    try:
+        duration = min(float(args[0]), PROFILE_MAX_DURATION) if args else 10
+    except ValueError:
+        update.message.reply_text('Usage: /profile [seconds]')
+        return
+
+    def on_done(path, sample_count):
+        bot.send_message(
+            chat_id=ADMIN_ID,
+            text=f'Profile finished: {sample_count} samples written to {path}'
+        )
+
+    if profiler.start(duration, PROFILE_SAMPLE_INTERVAL, on_done):
+        update.message.reply_text(f'Profiling for {duration:g} seconds…')
+    else:
+        update.message.reply_text('Failed: a profile is already running.')
+
+
+def log_update(update, event, spoiler_type, msg, *args):
+    """Logs an event of an update, msg is formatted with args on the log writer thread"""
+    user = update.effective_user
+    logger.info(
+        '%s (%s) ' + msg, user.username, user.id, *args,
+        extra={
+            'user_id': user.id,
+            'username': user.username,
+            'event': event,
+            'spoiler_type': spoiler_type,
+            'latency': round(metrics.elapsed(), 6)
+        }
+    )
+
+
+def error(bot, update, error):
+    logger.warning(f'Update "{update}" caused error "{error}"')
+
+
+def add_metric_collectors(get_queue_depth):
+    # bot_api loads telegram, only needed once a bot runs
+    import bot_api
+
+    metrics.add_collector(bot_api.expose)
+    metrics.add_collector(lambda: metrics.gauge(
+        'spoilerobot_dispatcher_queue_depth',
+        'Updates waiting to be handled by the dispatcher',
+        get_queue_depth()
+    ))
+    metrics.add_collector(lambda: metrics.counter(
+        'spoilerobot_events_total',
+        'Events counted by tenant, type of event and spoiler (flushed every 5 seconds)',
+        ('tenant', 'event', 'type'),
+        {
+            (database.tenant,) + key: count
+            for database in databases.values()
+            for key, count in database.event_counts.get_totals().items()
+        }
+    ))
+
+
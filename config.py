@@ -1,7 +1,8 @@
+import json
 import os
 
-# the telegram bot token
-BOT_TOKEN = os.environ['tg_bot_spoilero']
+# the telegram bot token (not needed if tg_bot_spoilero_tenants is set)
+BOT_TOKEN = os.environ.get('tg_bot_spoilero')
 
 # the user_id of the administrator
 ADMIN_ID = int(os.environ['tg_bot_spoilero_admin'])
@@ -20,6 +21,68 @@ if 'tg_spoilero_pepper' not in os.environ:
     exit(1)
 HASH_PEPPER = os.environ['tg_spoilero_pepper']
 
+# several bots can be served by one process (threads engine only), sharing the database
+# connection, jobs and metrics but each with its own spoilers, bans and users
+# tg_bot_spoilero_tenants is a json list of {"name": ..., "token": ..., "pepper": ...}
+# the tenant named '' is the one the data from before tenants existed belongs to
+TENANTS = json.loads(os.environ.get('tg_bot_spoilero_tenants', 'null')) or [
+    {'name': '', 'token': BOT_TOKEN, 'pepper': HASH_PEPPER}
+]
+if not TENANTS[0]['token']:
+    print('Please add tg_bot_spoilero (or tg_bot_spoilero_tenants) to your environmental variables')
+    exit(1)
+
+# how updates are handled: 'threads' uses the library's dispatcher,
+# 'asyncio' runs every handler as a coroutine on a single event loop (see aio.py)
+ENGINE = os.environ.get('tg_bot_spoilero_engine', 'threads')
+
+# threads engine: how many threads handle updates, the Bot API connection pool
+# gets a few more connections for the job queue and the updater
+WORKERS = 4
+
+# after BOT_API_BREAKER_FAILURES Bot API calls in a row time out or get a server error, the
+# calls fail right away for BOT_API_BREAKER_RESET_TIMEOUT seconds (see bot_api.CircuitBreaker)
+BOT_API_BREAKER_FAILURES = 5
+BOT_API_BREAKER_RESET_TIMEOUT = 10
+
+# asyncio engine only: the most updates handled at once, the size of the database and
+# Bot API connection pools, and how many threads encryption is offloaded to
+AIO_MAX_CONCURRENCY = 2000
+AIO_DB_POOL_SIZE = 20
+AIO_HTTP_POOL_SIZE = 100
+AIO_CRYPTO_WORKERS = 4
+
+# where to serve prometheus metrics (keep this local, it's not authenticated)
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9108
+
+# the readiness check (/readyz on the metrics port) fails if a database round trip
+# takes longer than this many seconds, or if more updates than this are waiting
+READY_MAX_DB_LATENCY = 0.5
+READY_MAX_QUEUE_DEPTH = 100
+
+# how long in seconds to wait for queued updates to be handled when shutting down
+SHUTDOWN_DRAIN_TIMEOUT = 20
+
+# updates that take longer than this many seconds to handle are logged with a breakdown of where the time went
+SLOW_UPDATE_THRESHOLD = 0.5
+
+# how often in seconds the /profile command samples thread stacks, and the longest it can run for
+PROFILE_SAMPLE_INTERVAL = 0.005
+PROFILE_MAX_DURATION = 300
+
+# log file, rotated once it reaches LOG_MAX_BYTES (LOG_BACKUP_COUNT old files are kept)
+LOG_FILE = 'bot.log'
+LOG_MAX_BYTES = 50 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+
+# fraction of log records to keep by event (events not listed are always logged)
+# lower these if logging every spoiler request/creation is too much during spikes
+LOG_SAMPLE_RATES = {
+    'request': 1.0,
+    'create': 1.0,
+}
+
 # the time in seconds in between timestamps of the request count statistic
 REQUEST_COUNT_RESOLUTION = 600
 
@@ -54,4 +117,52 @@ RATE_LIMIT_BAN_TIME = 24*60*60
 # How long in seconds before a spoiler's owner if forgotten
 # When a user is banned, all their recent spoilers are deleted
 # this value controls how far back "recent" actually is
-SPOILER_OWNER_FORGET_AFTER = 60 * 20
\ No newline at end of file
+SPOILER_OWNER_FORGET_AFTER = 60 * 20
+
+# The most requested spoilers have their (encrypted) tokens cached in memory
+# HOT_SPOILERS_TRACKED is how many hashes are counted, the top HOT_SPOILERS_CACHED are cached
+HOT_SPOILERS_TRACKED = 2000
+HOT_SPOILERS_CACHED = 200
+
+# the hot hashes are saved here every HOT_SPOILERS_SNAPSHOT_INTERVAL seconds and pre-fetched on startup
+HOT_SPOILERS_FILE = 'hot_spoilers.txt'
+HOT_SPOILERS_SNAPSHOT_INTERVAL = 60
+
+# spoilers are appended to SPOOL_FILE when the database is down (or too slow) and replayed later
+SPOOL_FILE = 'spool.jsonl'
+# inserts taking longer than this many seconds are cancelled and spooled instead
+SPOOL_INSERT_TIMEOUT = 0.5
+# after the database fails, it's left alone for SPOOL_RETRY_INTERVAL seconds,
+# doubling on every failure up to SPOOL_MAX_RETRY_INTERVAL
+SPOOL_RETRY_INTERVAL = 5
+SPOOL_MAX_RETRY_INTERVAL = 120
+# how many spooled spoilers are replayed with each insert
+SPOOL_REPLAY_BATCH = 500
+
+# seconds to wait for a connection to the database
+DB_CONNECT_TIMEOUT = 5
+
+# the spoilers of a banned user are deleted in the background,
+# PURGE_BATCH_SIZE at a time with a pause of PURGE_PAUSE seconds in between
+PURGE_BATCH_SIZE = 100
+PURGE_PAUSE = 0.05
+
+# bans are loaded on startup in chunks of this many rows
+BAN_LOAD_CHUNK_SIZE = 10000
+
+# processes on the same host can share the cached hot spoiler tokens through this memory mapped
+# file (ie '/dev/shm/spoilerobot_cache'), empty keeps them in each process' memory
+SHARED_CACHE_FILE = os.environ.get('tg_bot_spoilero_shared_cache', '')
+# the cache holds this many tokens, tokens larger than SHARED_CACHE_SLOT_SIZE bytes aren't cached
+SHARED_CACHE_SLOTS = 4096
+SHARED_CACHE_SLOT_SIZE = 1024
+
+# the ids of this many recent updates are remembered so that redelivered updates are dropped
+DEDUPE_WINDOW = 10000
+
+# spoilers_v2 can be split by hash prefix across the databases listed (as json) in
+# tg_bot_spoilero_shards: 'main' is the database above, 'sqlite:PATH' a sqlite file (to test with)
+# and anything else a postgres dsn, ie ["main", "host=db2 dbname=spoilerobot user=spoilerobot"]
+SHARDS = json.loads(os.environ.get('tg_bot_spoilero_shards', 'null')) or ['main']
+# while rebalance.py moves spoilers to a new list of shards, the old list goes here
+PREVIOUS_SHARDS = json.loads(os.environ.get('tg_bot_spoilero_previous_shards', 'null'))
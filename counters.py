@@ -0,0 +1,65 @@
+import threading
+
+
+class StripedCounter:
+    """
+    A counter that is incremented from many threads without sharing a lock
+
+    Each thread increments its own stripe (a plain dict), and collect() swaps
+    every stripe out for an empty dict. A thread may still be writing into the
+    dict it grabbed just before the swap, so swapped out dicts are only summed
+    on the following collect() (they are never written to again by then)
+    """
+    def __init__(self, keep_totals=False):
+        self.local = threading.local()
+        self.stripes = []
+        self.retired = []
+        # cumulative counts of everything collected so far (for exposition)
+        self.totals = {} if keep_totals else None
+        # collect() updates the totals while the metrics thread reads them
+        self.totals_lock = threading.Lock()
+
+    def _get_stripe(self):
+        stripe = getattr(self.local, 'stripe', None)
+        if stripe is None:
+            stripe = self.local.stripe = [{}]
+            # list.append is atomic, so registering a new thread needs no lock
+            self.stripes.append(stripe)
+        return stripe
+
+    def incr(self, key, amount=1):
+        counts = self._get_stripe()[0]
+        counts[key] = counts.get(key, 0) + amount
+
+    def collect(self, final=False):
+        """
+        Returns a dict of key -> count of increments since the last collect
+        If final is True, the current stripes are included too (only safe
+        once nothing can increment anymore, ie on shutdown)
+        """
+        swapped = []
+        for stripe in list(self.stripes):
+            counts, stripe[0] = stripe[0], {}
+            swapped.append(counts)
+
+        if final:
+            ready, self.retired = self.retired + swapped, []
+        else:
+            # keep the freshly swapped dicts around until the next collect
+            ready, self.retired = self.retired, swapped
+
+        result = {}
+        for counts in ready:
+            for key, count in counts.items():
+                result[key] = result.get(key, 0) + count
+
+        if self.totals is not None:
+            with self.totals_lock:
+                for key, count in result.items():
+                    self.totals[key] = self.totals.get(key, 0) + count
+        return result
+
+    def get_totals(self):
+        """Returns a copy of the cumulative counts"""
+        with self.totals_lock:
+            return dict(self.totals)
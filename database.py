@@ -1,22 +1,38 @@
 import base64
+import hashlib
 import json
+import logging
+import sqlite3
 import threading
 import time
 
 import psycopg2
 import psycopg2.extras
-from cryptography.fernet import Fernet
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
-from cryptography.exceptions import InvalidSignature
 
 import config
-from util import timestamp_floor
+import live_stats
+import metrics
+from counters import StripedCounter
+from hot_spoilers import HotSpoilers
+from shm_cache import open_shared_cache
+from purge import Purger
+from shards import PostgresShard, ShardMap, SqliteShard
+from spool import Spool, to_rows
+from util import tenant_path, timestamp_floor
 
+logger = logging.getLogger(__name__)
 
+# errors that mean the database is down or too slow, rather than something wrong with the query
+UNAVAILABLE_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError, sqlite3.OperationalError)
+
+
+# cryptography is only imported when it's first used (most of its import time is spent
+# loading openssl), hashing uses hashlib which gives the same digests
 def derive_key(uuid, salt):
     """derives a key from a uuid+unique salt using scrypt"""
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+
     return base64.urlsafe_b64encode(
         Scrypt(
             salt=salt,
@@ -31,104 +47,381 @@ def derive_key(uuid, salt):
 
 def hash_uuid(uuid):
     """
-    hashes a uuid using SHA256 (these are the primary keys of the database)
+    hashes a uuid using SHA256 (these are the primary keys of the v1 schema)
     we can't use a unique salt here because we need the hash to find the row
     """
-    digest = hashes.Hash(hashes.SHA256(), backend=default_backend())
-    digest.update((uuid + config.HASH_PEPPER).encode())
-    return digest.finalize()
+    return hashlib.sha256((uuid + config.HASH_PEPPER).encode()).digest()
 
 
-def split_uuid(uuid):
+def split_uuid(uuid, pepper=None):
     """
     Splits a uuid into a database key and encryption key by hashing it and
     then splitting the hash (the hash is needed because uuid can be of variable length)
+    Every tenant has its own pepper, so the same uuid never finds another tenant's spoiler
     """
-    digest = hashes.Hash(hashes.SHA512(), backend=default_backend())
-    digest.update((uuid + config.HASH_PEPPER).encode())
-    digest = digest.finalize()
+    digest = hashlib.sha512((uuid + (config.HASH_PEPPER if pepper is None else pepper)).encode()).digest()
     return digest[:32], base64.urlsafe_b64encode(digest[32:])
 
 
-class Database:
-    def __init__(self):
-        self.request_count = 0
-        # we need a lock to prevent double counting (or forgetting) requests
-        self.request_lock = threading.Lock()
+def encrypt(key, data):
+    from cryptography.fernet import Fernet
+    return Fernet(key).encrypt(data)
+
+
+def decrypt(key, token):
+    """Returns the decrypted token, or None if it wasn't encrypted with this key"""
+    from cryptography.fernet import Fernet, InvalidToken
+    try:
+        return Fernet(key).decrypt(token)
+    except InvalidToken:
+        return None
+
+
+# statements that create (or migrate) the tables, run on every connect
+SCHEMA = [
+    '''
+        CREATE TABLE IF NOT EXISTS spoilers_v2 (
+            hash BYTEA PRIMARY KEY,
+            timestamp INTEGER DEFAULT date_part('epoch', now()),
+            token BYTEA,
+            owner INTEGER
+        )
+    ''',
+    '''
+        CREATE TABLE IF NOT EXISTS requests (
+            timestamp INTEGER,
+            event TEXT DEFAULT 'request',
+            type TEXT DEFAULT '',
+            count INTEGER,
+            PRIMARY KEY (timestamp, event, type)
+        )
+    ''',
+    # older tables only stored a single count per timestamp
+    '''
+        ALTER TABLE requests
+        ADD COLUMN IF NOT EXISTS event TEXT NOT NULL DEFAULT 'request',
+        ADD COLUMN IF NOT EXISTS type TEXT NOT NULL DEFAULT ''
+    ''',
+    '''
+        DO $$ BEGIN
+            IF (
+                SELECT count(*) FROM information_schema.key_column_usage
+                WHERE table_name = 'requests' AND constraint_name = 'requests_pkey'
+            ) = 1 THEN
+                ALTER TABLE requests DROP CONSTRAINT requests_pkey;
+                ALTER TABLE requests ADD PRIMARY KEY (timestamp, event, type);
+            END IF;
+        END $$;
+    ''',
+    # how many times each spoiler was opened
+    '''
+        ALTER TABLE spoilers_v2
+        ADD COLUMN IF NOT EXISTS views INTEGER NOT NULL DEFAULT 0
+    ''',
+    # only spoilers with a (not yet forgotten) owner, so that they can be purged quickly
+    '''
+        CREATE INDEX IF NOT EXISTS spoilers_v2_owner ON spoilers_v2 (owner) WHERE owner > 0
+    ''',
+    '''
+        CREATE TABLE IF NOT EXISTS banned_users (
+            user_id INTEGER PRIMARY KEY,
+            expires INTEGER
+        )
+    ''',
+    # which bot a spoiler or a ban belongs to (see config.TENANTS), bans are per tenant
+    '''
+        ALTER TABLE spoilers_v2
+        ADD COLUMN IF NOT EXISTS tenant TEXT NOT NULL DEFAULT ''
+    ''',
+    '''
+        ALTER TABLE banned_users
+        ADD COLUMN IF NOT EXISTS tenant TEXT NOT NULL DEFAULT ''
+    ''',
+    '''
+        DO $$ BEGIN
+            IF (
+                SELECT count(*) FROM information_schema.key_column_usage
+                WHERE table_name = 'banned_users' AND constraint_name = 'banned_users_pkey'
+            ) = 1 THEN
+                ALTER TABLE banned_users DROP CONSTRAINT banned_users_pkey;
+                ALTER TABLE banned_users ADD PRIMARY KEY (tenant, user_id);
+            END IF;
+        END $$;
+    ''',
+    # the request counts of every tenant are kept apart too
+    '''
+        ALTER TABLE requests
+        ADD COLUMN IF NOT EXISTS tenant TEXT NOT NULL DEFAULT ''
+    ''',
+    '''
+        DO $$ BEGIN
+            IF NOT EXISTS (
+                SELECT 1 FROM information_schema.key_column_usage
+                WHERE table_name = 'requests' AND constraint_name = 'requests_pkey'
+                AND column_name = 'tenant'
+            ) THEN
+                ALTER TABLE requests DROP CONSTRAINT requests_pkey;
+                ALTER TABLE requests ADD PRIMARY KEY (tenant, timestamp, event, type);
+            END IF;
+        END $$;
+    ''',
+]
+
+
+# the schema statements take table locks even when there's nothing to change, so they're
+# skipped on connect once this digest of them is recorded in the schema_version table
+SCHEMA_VERSION = hashlib.sha256(''.join(SCHEMA).encode()).hexdigest()[:16]
+
+
+def encode_spoiler(content_type, description, content):
+    """Json encodes the spoiler data (which is what gets encrypted)"""
+    return json.dumps({
+        'type': content_type,
+        'description': description,
+        'content': content,
+    }).encode()
+
+
+def query_step(query):
+    """Returns the statement type of a query (ie select) to name its phase step"""
+    if isinstance(query, bytes):
+        query = query.decode(errors='replace')
+    words = query.split(None, 1)
+    return words[0].lower() if words else 'query'
+
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """A cursor which attributes the time spent executing queries to the db phase"""
+    def execute(self, query, *args, **kwargs):
+        with metrics.phase('db', query_step(query)):
+            return super().execute(query, *args, **kwargs)
+
+
+class TimedDictCursor(psycopg2.extras.DictCursor):
+    def execute(self, query, *args, **kwargs):
+        with metrics.phase('db', query_step(query)):
+            return super().execute(query, *args, **kwargs)
+
+
+class Connection:
+    """
+    The connection shared by the databases of every tenant
+    psycopg2 connections are thread safe, so one is enough for the whole process
+    dsn connects to another database than the configured one (ie a shard)
+    """
+    def __init__(self, dsn=None):
+        self.dsn = dsn
+        self._shards = None
+        self.reconnect_lock = threading.Lock()
         self.connect()
-        self.banned_users = self.get_banned_users()
 
-    # utility methods
     def connect(self):
-        self.connection = psycopg2.connect(
-            dbname=config.DB_NAME,
-            user=config.DB_USERNAME,
-            host=config.DB_HOST,
-            password=config.DB_PASSWORD
-        )
+        if self.dsn:
+            self.connection = psycopg2.connect(self.dsn, connect_timeout=config.DB_CONNECT_TIMEOUT)
+        else:
+            self.connection = psycopg2.connect(
+                dbname=config.DB_NAME,
+                user=config.DB_USERNAME,
+                host=config.DB_HOST,
+                password=config.DB_PASSWORD,
+                connect_timeout=config.DB_CONNECT_TIMEOUT
+            )
         self.connection.autocommit = True
 
-        cursor = self.get_cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS spoilers_v2 (
-                hash BYTEA PRIMARY KEY,
-                timestamp INTEGER DEFAULT date_part('epoch', now()),
-                token BYTEA,
-                owner INTEGER
-            )
-        ''')
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS requests (
-                timestamp INTEGER PRIMARY KEY,
-                count INTEGER
-            )
-        ''')
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS banned_users (
-                user_id INTEGER PRIMARY KEY,
-                expires INTEGER
-            )
-        ''')
+        cursor = self.cursor(use_dict_factory=False)
+        cursor.execute('CREATE TABLE IF NOT EXISTS schema_version (version TEXT PRIMARY KEY)')
+        cursor.execute('SELECT 1 FROM schema_version WHERE version = %s', (SCHEMA_VERSION,))
+        if cursor.fetchone():
+            return
 
-    def get_cursor(self, use_dict_factory=True):
-        #TODO Reconnect if connection dropped?
+        for statement in SCHEMA:
+            cursor.execute(statement)
+        cursor.execute(
+            'INSERT INTO schema_version (version) VALUES (%s) ON CONFLICT DO NOTHING', (SCHEMA_VERSION,)
+        )
+
+    def cursor(self, use_dict_factory=True):
+        if self.connection.closed:
+            self.reconnect()
         return self.connection.cursor(
-            cursor_factory=psycopg2.extras.DictCursor if use_dict_factory else None
+            cursor_factory=TimedDictCursor if use_dict_factory else TimedCursor
         )
 
-    def forget_old_owners(self, forget_time):
-        cursor = self.get_cursor()
-        cursor.execute(
-            'UPDATE spoilers_v2 SET owner = 0 WHERE timestamp <= %s AND owner > 0;',
-            (time.time() - forget_time,)
+    def reconnect(self):
+        """Replaces a connection that was closed (ie the server went away), raises if it can't"""
+        with self.reconnect_lock:
+            # another thread may have reconnected while this one waited
+            if self.connection.closed:
+                self.connect()
+
+    @property
+    def shards(self):
+        """Where spoilers_v2 is (see shards.py), opened on first use"""
+        if self._shards is None:
+            self._shards = open_shard_map(self)
+        return self._shards
+
+    def close(self):
+        if self._shards is not None:
+            self._shards.close()
+        self.connection.close()
+
+
+def open_shard(spec, connection):
+    """
+    Opens a shard from its entry in config.SHARDS: 'main' is the main database,
+    'sqlite:PATH' a sqlite file (to test with) and anything else a postgres dsn
+    """
+    if spec == 'main':
+        return PostgresShard(connection, owns_connection=False)
+    if spec.startswith('sqlite:'):
+        return SqliteShard(spec[len('sqlite:'):])
+    return PostgresShard(Connection(spec))
+
+
+def open_shard_map(connection):
+    # a shard that's in both layouts is opened once
+    opened = {}
+
+    def get_shard(spec):
+        if spec not in opened:
+            opened[spec] = open_shard(spec, connection)
+        return opened[spec]
+
+    return ShardMap(
+        [get_shard(spec) for spec in config.SHARDS],
+        [get_shard(spec) for spec in config.PREVIOUS_SHARDS or []]
+    )
+
+
+class Database:
+    """
+    The spoilers and bans of one tenant (see config.TENANTS)
+    Spoilers are kept apart by the tenant's pepper, which their hashes depend on,
+    and owners and bans by the tenant column.
+    """
+    def __init__(self, tenant='', pepper=None, connection=None):
+        self.tenant = tenant
+        self.pepper = config.HASH_PEPPER if pepper is None else pepper
+        # a connection is made (and closed) by the database unless a shared one is passed
+        self.shared = connection or Connection()
+        self.owns_connection = connection is None
+        # counts of (event, spoiler type) since the last flush
+        self.event_counts = StripedCounter(keep_totals=True)
+        # views of each spoiler (by hash) since the last flush
+        self.view_counts = StripedCounter()
+        self.hot_spoilers = HotSpoilers(
+            config.HOT_SPOILERS_TRACKED, config.HOT_SPOILERS_CACHED,
+            tenant_path(config.HOT_SPOILERS_FILE, tenant)
         )
-        return cursor.rowcount
+        # spoilers_v2, which may be split across several databases (shared by the tenants too)
+        self.shards = self.shared.shards
+        # spoilers created while the database was unavailable, see start()
+        self.spool = None
+        self.unavailable_until = 0
+        self.retry_interval = config.SPOOL_RETRY_INTERVAL
+        self.purger = None
+        self.banned_users = self.get_banned_users()
+
+    def start(self):
+        """
+        Starts what only the bot itself needs (the tools just run queries): the spool, the
+        purger thread and the shared hot spoiler cache. Needed to insert spoilers, ban users and flush.
+        """
+        self.spool = Spool(tenant_path(config.SPOOL_FILE, self.tenant))
+        self.purger = Purger(
+            self.purge_spoilers, lambda owner: self.shards.has_owner(owner, self.tenant),
+            config.PURGE_BATCH_SIZE, config.PURGE_PAUSE
+        )
+        self.hot_spoilers.shared = open_shared_cache(self.tenant)
+
+    # utility methods
+    @property
+    def connection(self):
+        return self.shared.connection
+
+    def connect(self):
+        self.shared.connect()
+
+    def close(self):
+        if self.owns_connection:
+            self.shared.close()
+        if self.spool:
+            self.spool.close()
+        if self.hot_spoilers.shared:
+            self.hot_spoilers.shared.close()
+
+    def mark_unavailable(self, error):
+        """Leaves the database alone for a while, backing off exponentially"""
+        logger.warning(f'database unavailable, retrying in {self.retry_interval}s: {error}')
+        self.unavailable_until = time.time() + self.retry_interval
+        self.retry_interval = min(self.retry_interval * 2, config.SPOOL_MAX_RETRY_INTERVAL)
+
+    def ping(self):
+        """Makes a round trip to the database, raises if it's unreachable"""
+        self.get_cursor(use_dict_factory=False).execute('SELECT 1')
+        self.shards.ping()
+
+    def flush(self, final=False):
+        """
+        Writes out anything buffered in memory
+        final should only be set once no more requests will be handled
+        """
+        self.store_request_count(final=final)
+        self.store_view_counts(final=final)
+        self.hot_spoilers.snapshot()
+        self.replay_spool()
+
+    def get_cursor(self, use_dict_factory=True):
+        return self.shared.cursor(use_dict_factory)
+
+    def forget_old_owners(self, forget_time):
+        return self.shards.forget_owners(time.time() - forget_time, self.tenant)
 
     # banned user management
     def get_banned_users(self):
-        cursor = self.get_cursor()
-        cursor.execute('SELECT * FROM banned_users;')
-        results = cursor.fetchall()
-        banned_users = {}
-        for result in results:
-            banned_users[int(result['user_id'])] = int(result['expires'])
+        """Loads the bans that haven't expired, streamed from a server side cursor as tuples"""
+        now = int(time.time())
+        # only the loaded bans are ever checked (and removed once they expire)
+        self.get_cursor().execute(
+            'DELETE FROM banned_users WHERE tenant = %s AND expires <= %s',
+            (self.tenant, now)
+        )
+        cursor = self.connection.cursor('load_banned_users', cursor_factory=TimedCursor, withhold=True)
+        cursor.itersize = config.BAN_LOAD_CHUNK_SIZE
+        cursor.execute(
+            'SELECT user_id, expires FROM banned_users WHERE tenant = %s AND expires > %s;',
+            (self.tenant, now)
+        )
+        banned_users = {int(user_id): int(expires) for user_id, expires in cursor}
+        cursor.close()
         return banned_users
 
-    def ban_user(self, user_id, expires):
+    def ban_user(self, user_id, expires, on_purged=None):
+        """
+        Bans a user right away and deletes their spoilers in the background
+        on_purged is called with the number of deleted spoilers once that's done
+        """
+        self.banned_users[user_id] = expires
         cursor = self.get_cursor()
         cursor.execute('''
-            INSERT INTO banned_users (user_id, expires) VALUES (%(user_id)s, %(expires)s)
-            ON CONFLICT (user_id) DO UPDATE
+            INSERT INTO banned_users (tenant, user_id, expires)
+            VALUES (%(tenant)s, %(user_id)s, %(expires)s)
+            ON CONFLICT (tenant, user_id) DO UPDATE
             SET expires = %(expires)s;
             ''',
-            {'user_id': user_id, 'expires': expires}
+            {'tenant': self.tenant, 'user_id': user_id, 'expires': expires}
         )
-        cursor.execute(
-            'DELETE from spoilers_v2 WHERE owner = %s;',
-            (user_id,)
-        )
-        self.banned_users[user_id] = expires
-        return cursor.rowcount
+
+        spooled = self.spool.remove_owner(user_id)
+        self.purger.purge(user_id, on_purged and (lambda count: on_purged(count + spooled)))
+
+    def purge_spoilers(self, owner, limit):
+        """Deletes up to limit spoilers of an owner (from each shard), returns how many were deleted"""
+        hashes = self.shards.delete_owner(owner, self.tenant, limit)
+        for db_hash in hashes:
+            self.hot_spoilers.invalidate(db_hash)
+        return len(hashes)
 
     def is_user_banned(self, user_id):
         user_id = int(user_id)
@@ -148,66 +441,141 @@ class Database:
 
         del self.banned_users[user_id]
         self.get_cursor().execute(
-            'DELETE FROM banned_users WHERE user_id=%s',
-            (user_id,)
+            'DELETE FROM banned_users WHERE user_id=%s AND tenant=%s',
+            (user_id, self.tenant)
         )
         return True
 
     # statistics
-    def store_request_count(self):
-        with self.request_lock:
-            request_count = self.request_count
-            self.request_count = 0
+    def count_event(self, event, spoiler_type=''):
+        """
+        Counts an event (request, inline, callback, start, create, ban)
+        optionally split by the type of spoiler involved
+        """
+        self.event_counts.incr((event, spoiler_type))
+        live_stats.STATS.count(event, spoiler_type)
 
-        if request_count == 0:
+    def store_request_count(self, final=False):
+        counts = self.event_counts.collect(final=final)
+        if not counts:
             # no need to do anything if there were are no requests to store
             return
 
+        timestamp = timestamp_floor(config.REQUEST_COUNT_RESOLUTION)
         cursor = self.get_cursor()
-        # insert the request count into the database and add to it if there's a conflict
-        cursor.execute('''
-            INSERT INTO requests (timestamp, count) VALUES (%(timestamp)s, %(count)s)
-            ON CONFLICT (timestamp) DO UPDATE
-            SET count = requests.count + %(count)s;
+        # insert all the counts at once and add to them if there's a conflict
+        psycopg2.extras.execute_values(
+            cursor,
+            '''
+            INSERT INTO requests (tenant, timestamp, event, type, count) VALUES %s
+            ON CONFLICT (tenant, timestamp, event, type) DO UPDATE
+            SET count = requests.count + EXCLUDED.count;
             ''',
-            {'timestamp': timestamp_floor(config.REQUEST_COUNT_RESOLUTION), 'count': request_count}
+            [
+                (self.tenant, timestamp, event, spoiler_type, count)
+                for (event, spoiler_type), count in counts.items()
+            ]
         )
 
+    def store_view_counts(self, final=False):
+        counts = self.view_counts.collect(final=final)
+        if not counts:
+            return
+
+        # sorted so that concurrent flushes can't deadlock
+        self.shards.add_views(sorted(counts.items()))
+
+    def get_views(self, uuid):
+        """
+        Returns how many times a spoiler was opened (up to the last flush)
+        or None if there is no such spoiler
+        """
+        uuid = uuid[1:]
+        if not uuid or uuid == 'yes':
+            return None
+
+        with metrics.phase('crypto', 'hash'):
+            db_hash, _ = split_uuid(uuid, self.pepper)
+        return self.shards.get_views(db_hash)
+
+    # hot spoiler caching
+    def warm_up_hot_spoilers(self):
+        """
+        Pre-fetches the spoilers that were hot before the last restart
+        this isn't needed to serve requests, so it's run as a job once polling started
+        """
+        hashes = self.hot_spoilers.load_snapshot()
+        if not hashes:
+            return
+
+        generation = self.hot_spoilers.generation
+        self.hot_spoilers.warm_up(self.shards.get_tokens(hashes), generation)
+
     # spoiler management
     def insert_spoiler(self, uuid, content_type, description, content, owner):
+        """Returns False if the spoiler was already stored (ie the update was delivered twice)"""
         # Slice away the first character since it stores instance specific data
         uuid = uuid[1:]
         if uuid == 'yes':
-            return
+            return True
 
-        # Json encode the spoiler data
-        data = json.dumps({
-            'type': content_type,
-            'description': description,
-            'content': content,
-        }).encode()
+        data = encode_spoiler(content_type, description, content)
 
         # Encrypt the data with a key derived from the uuid
-        db_hash, key = split_uuid(uuid)
-        token = Fernet(key).encrypt(data)
+        with metrics.phase('crypto', 'hash'):
+            db_hash, key = split_uuid(uuid, self.pepper)
+        if self.spool.get_token(db_hash):
+            # delivered twice while the database was unavailable, it's still waiting in the spool
+            return False
+        with metrics.phase('crypto', 'encrypt'):
+            token = encrypt(key, data)
+
+        if time.time() < self.unavailable_until:
+            # don't stall on a database that just failed, the spool is replayed once it's back
+            self.spool.append(db_hash, token, owner, int(time.time()))
+            return True
 
         # Store it keyed by the first part of the hash of the uuid
-        cursor = self.get_cursor()
-        cursor.execute(
-            'INSERT INTO spoilers_v2 (hash, token, owner) VALUES (%s, %s, %s)',
-            (db_hash, token, owner)
-        )
+        try:
+            return self.shards.insert(
+                (db_hash, int(time.time()), token, owner, self.tenant), config.SPOOL_INSERT_TIMEOUT
+            )
+        except UNAVAILABLE_ERRORS as e:
+            self.mark_unavailable(e)
+            self.spool.append(db_hash, token, owner, int(time.time()))
+            return True
+
+    def replay_spool(self):
+        """Moves spooled spoilers into the database, if there are any and it's back"""
+        if not len(self.spool) or time.time() < self.unavailable_until:
+            return
+
+        try:
+            while len(self.spool):
+                batch = self.spool.take(config.SPOOL_REPLAY_BATCH)
+                self.insert_spooled(to_rows(batch))
+                self.spool.forget(batch)
+        except UNAVAILABLE_ERRORS as e:
+            self.mark_unavailable(e)
+            return
+        finally:
+            self.spool.compact()
+
+        self.retry_interval = config.SPOOL_RETRY_INTERVAL
+        logger.info('replayed the spool into the database')
+
+    def insert_spooled(self, rows):
+        self.shards.insert_many([row + (self.tenant, 0) for row in rows])
 
     def _spoiler_convert_v1_v2(self, old_hash, uuid, data, timestamp):
         # Takes a spoiler data+timestamp and inserts it into the v2 table
-        db_hash, key = split_uuid(uuid)
-        token = Fernet(key).encrypt(data)
+        with metrics.phase('crypto', 'hash'):
+            db_hash, key = split_uuid(uuid, self.pepper)
+        with metrics.phase('crypto', 'encrypt'):
+            token = encrypt(key, data)
 
+        self.shards.insert((db_hash, timestamp, token, 0, self.tenant))
         cursor = self.get_cursor()
-        cursor.execute(
-            'INSERT INTO spoilers_v2 (timestamp, hash, token, owner) VALUES (%s, %s, %s, %s)',
-            (timestamp, db_hash, token, 0)
-        )
         cursor.execute(
             'DELETE FROM spoilers WHERE hash=%s',
             (old_hash,)
@@ -218,8 +586,13 @@ class Database:
         Tries to get a spoiler from the old (v1) schema
         If found it is inserted into the new (v2) schema
         """
+        if self.tenant:
+            # the v1 schema predates tenants, its spoilers all belong to the default one
+            return None
+
         # try to find uuid by hash in the database
-        db_hash = hash_uuid(uuid)
+        with metrics.phase('crypto', 'hash'):
+            db_hash = hash_uuid(uuid)
         cursor = self.get_cursor()
         cursor.execute(
             'SELECT timestamp, salt, token FROM spoilers WHERE hash=%s',
@@ -230,23 +603,22 @@ class Database:
         if not spoiler:
             return None
             
-        if increment_stats:
-            with self.request_lock:
-                self.request_count += 1
-
         # Decrypt the data and decode it
-        try:
-            data = Fernet(derive_key(uuid, bytes(spoiler['salt']))).decrypt(bytes(spoiler['token']))
-        except InvalidSignature:
+        with metrics.phase('crypto', 'decrypt'):
+            data = decrypt(derive_key(uuid, bytes(spoiler['salt'])), bytes(spoiler['token']))
+        if data is None:
             # this shouldn't happen unless someone messes with the database
             return None
 
         # move it to the new schema
         self._spoiler_convert_v1_v2(db_hash, uuid, data, spoiler['timestamp'])
 
-        return json.loads(data)
+        spoiler = json.loads(data)
+        if increment_stats:
+            self.count_event('request', spoiler['type'])
+        return spoiler
 
-    def get_spoiler(self, uuid, increment_stats=True):
+    def get_spoiler(self, uuid, increment_stats=True, count_view=False):
         uuid = uuid[1:]
         if not uuid:
             return None
@@ -258,27 +630,42 @@ class Database:
                 'content': 'Yes',
             }
 
-        db_hash, key = split_uuid(uuid)
+        with metrics.phase('crypto', 'hash'):
+            db_hash, key = split_uuid(uuid, self.pepper)
 
-        # try to find uuid by hash in the database
-        cursor = self.get_cursor()
-        cursor.execute(
-            'SELECT token FROM spoilers_v2 WHERE hash=%s',
-            (db_hash,)
-        )
-        spoiler = cursor.fetchone()
+        # hot spoilers are served without a database round trip
+        self.hot_spoilers.record(db_hash)
+        token = self.hot_spoilers.get_token(db_hash)
+        if token:
+            self.count_event('cache_hit')
+        else:
+            self.count_event('cache_miss')
+            token = self.spool and self.spool.get_token(db_hash)
 
-        if not spoiler:
-            return self.get_spoiler_v1(uuid)
+        if not token:
+            # try to find uuid by hash in the database
+            generation = self.hot_spoilers.generation
+            token = self.shards.get_token(db_hash)
 
-        if increment_stats:
-            with self.request_lock:
-                self.request_count += 1
+            if not token:
+                spoiler = self.get_spoiler_v1(uuid, increment_stats)
+                # it was moved to the new schema under the same hash
+                if spoiler and count_view:
+                    self.view_counts.incr(db_hash)
+                return spoiler
+
+            self.hot_spoilers.offer_token(db_hash, token, generation)
 
         # Decrypt the data and decode it
-        try:
-            data = Fernet(key).decrypt(bytes(spoiler['token']))
-        except InvalidSignature:
+        with metrics.phase('crypto', 'decrypt'):
+            data = decrypt(key, token)
+        if data is None:
             # this shouldn't happen unless someone messes with the database
             return None
-        return json.loads(data)
+
+        spoiler = json.loads(data)
+        if increment_stats:
+            self.count_event('request', spoiler['type'])
+        if count_view:
+            self.view_counts.incr(db_hash)
+        return spoiler
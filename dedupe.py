@@ -0,0 +1,24 @@
+import collections
+import threading
+
+
+class RecentUpdates:
+    """
+    The ids of the last `size` updates, to drop the ones Telegram delivers twice
+    The oldest id is forgotten when a new one is added, seen() is O(1).
+    """
+    def __init__(self, size):
+        self.order = collections.deque(maxlen=size)
+        self.ids = set()
+        self.lock = threading.Lock()
+
+    def seen(self, update_id):
+        """Returns True if update_id was already seen, otherwise remembers it"""
+        with self.lock:
+            if update_id in self.ids:
+                return True
+            if len(self.order) == self.order.maxlen:
+                self.ids.discard(self.order[0])
+            self.order.append(update_id)
+            self.ids.add(update_id)
+            return False
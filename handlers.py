@@ -1,4 +1,3 @@
-import telegram
 import html
 import json
 
@@ -23,7 +22,7 @@ class GenericHandler:
         self.extract_content = extract_content
     
     def send(self, bot, user_id, content):
-        send_content(self.get_send_function(bot), user_id, content)
+        return send_content(self.get_send_function(bot), user_id, content)
 
     def get_content(self, message):
         return self.extract_content(message)
@@ -33,7 +32,7 @@ class Photo:
     """Wrapper class for handling photos"""
     @staticmethod
     def send(bot, user_id, content):
-        send_content(bot.send_photo, user_id, content)
+        return send_content(bot.send_photo, user_id, content)
 
     @staticmethod
     def get_content(message):
@@ -50,7 +49,7 @@ class Text:
     """Wrapper class for handling plain text messages"""
     @staticmethod
     def send(bot, user_id, content):
-        bot.send_message(
+        return bot.send_message(
             chat_id=user_id,
             text=content
         )
@@ -64,7 +63,7 @@ class HTML:
     """Wrapper class for handling messages with formatting entities"""
     @staticmethod
     def send(bot, user_id, content):
-        bot.send_message(
+        return bot.send_message(
             chat_id=user_id,
             text=content,
             parse_mode='HTML'
@@ -141,16 +140,57 @@ Contact = GenericHandler(
 )
 
 
+class Album:
+    """Wrapper class for handling media groups, which are sent back with a single call"""
+    # the handlers that can be part of an album, and the telegram class each item is sent as
+    INPUT_MEDIA = {
+        'Photo': 'InputMediaPhoto',
+        'Video': 'InputMediaVideo'
+    }
+    # telegram doesn't allow more than this many items in a media group
+    MAX_ITEMS = 10
+
+    @staticmethod
+    def send(bot, user_id, content):
+        # imported here so that importing the handlers doesn't load telegram
+        import telegram
+
+        return bot.send_media_group(
+            chat_id=user_id,
+            media=[
+                getattr(telegram, Album.INPUT_MEDIA[item['type']])(
+                    media=item['media'], caption=item.get('caption')
+                )
+                for item in content
+            ]
+        )
+
+    @staticmethod
+    def get_item(message):
+        """Returns the album item for a message, or None if it can't be part of an album"""
+        handler = get_handler(message, message.effective_attachment)
+        if not handler or handler.__name__ not in Album.INPUT_MEDIA:
+            return None
+
+        content = handler.get_content(message)
+        return build_content(
+            type=handler.__name__,
+            media=content[handler.__name__.lower()],
+            caption=content.get('caption')
+        )
+
+
+# by the name of the attachment's telegram class
 ATTACHMENT_MAPPING = {
-    telegram.Audio: Audio,
-    telegram.Contact: Contact,
-    telegram.Document: Document,
-    telegram.Location: Location,
-    telegram.PhotoSize: Photo,
-    telegram.Sticker: Sticker,
-    telegram.Video: Video,
-    telegram.VideoNote: VideoNote,
-    telegram.Voice: Voice
+    'Audio': Audio,
+    'Contact': Contact,
+    'Document': Document,
+    'Location': Location,
+    'PhotoSize': Photo,
+    'Sticker': Sticker,
+    'Video': Video,
+    'VideoNote': VideoNote,
+    'Voice': Voice
 }
 
 
@@ -164,4 +204,4 @@ def get_handler(message, attachment):
     if isinstance(attachment, list):
         attachment = attachment[0]
 
-    return ATTACHMENT_MAPPING.get(attachment.__class__, None)
\ No newline at end of file
+    return ATTACHMENT_MAPPING.get(attachment.__class__.__name__, None)
\ No newline at end of file
@@ -0,0 +1,41 @@
+import json
+import time
+
+import metrics
+from config import READY_MAX_DB_LATENCY, READY_MAX_QUEUE_DEPTH
+
+
+class Health:
+    """
+    Liveness and readiness checks, served next to the metrics endpoint
+    /healthz only checks that the process is serving requests
+    /readyz fails while draining, if the database is slow or down, or if updates are piling up
+    """
+    def __init__(self, ping, get_queue_depth):
+        # ping makes a round trip to the database and raises if it fails
+        self.ping = ping
+        self.get_queue_depth = get_queue_depth
+        self.draining = False
+
+    def live(self):
+        return 200, 'application/json', json.dumps({'status': 'ok'})
+
+    def ready(self):
+        status = {'draining': self.draining, 'queue_depth': self.get_queue_depth()}
+        ready = not self.draining and status['queue_depth'] <= READY_MAX_QUEUE_DEPTH
+
+        start = time.perf_counter()
+        try:
+            self.ping()
+            status['db_latency'] = round(time.perf_counter() - start, 6)
+            ready = ready and status['db_latency'] <= READY_MAX_DB_LATENCY
+        except Exception as e:
+            status['db_error'] = str(e)
+            ready = False
+
+        status['status'] = 'ready' if ready else 'unavailable'
+        return (200 if ready else 503), 'application/json', json.dumps(status)
+
+    def register(self):
+        metrics.add_route('/healthz', self.live)
+        metrics.add_route('/readyz', self.ready)
@@ -0,0 +1,156 @@
+import collections
+import heapq
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+class SpaceSaving:
+    """
+    Approximate counts of the most frequent keys in bounded memory (the space-saving algorithm)
+    When full, a new key replaces the least counted one and inherits its count
+
+    The least counted key is found with a heap holding one (count, key) entry per key.
+    Increments don't touch the heap, so an entry's count can be lower than the key's:
+    such an entry is pushed back with the right count when it's popped, until the
+    popped one is up to date (which makes it the minimum, as counts only grow).
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.heap = []
+
+    def add(self, key, amount=1):
+        if key in self.counts:
+            self.counts[key] += amount
+            return
+
+        count = amount
+        if len(self.counts) >= self.capacity:
+            count += self.pop_min()
+        self.counts[key] = count
+        heapq.heappush(self.heap, (count, key))
+
+    def pop_min(self):
+        """Removes the least counted key, returns its count"""
+        while True:
+            count, key = heapq.heappop(self.heap)
+            current = self.counts[key]
+            if current == count:
+                del self.counts[key]
+                return count
+            heapq.heappush(self.heap, (current, key))
+
+    def top(self, n):
+        return heapq.nlargest(n, self.counts, key=self.counts.get)
+
+    def decay(self):
+        """Halves every count so that the tracker follows recent traffic"""
+        self.counts = {key: count // 2 for key, count in self.counts.items() if count > 1}
+        self.heap = [(count, key) for key, count in self.counts.items()]
+        heapq.heapify(self.heap)
+
+
+class HotSpoilers:
+    """
+    Tracks the most requested spoiler hashes and caches their tokens
+
+    record() is called on every lookup and only appends to a deque (which is
+    thread safe without a lock), the counting happens in update() from a job.
+    With a shared cache (see shm_cache.py) the tokens are kept there instead,
+    where every process on the host can find the ones the others made hot.
+    """
+    def __init__(self, tracked, cached, snapshot_file, shared=None):
+        self.tracker = SpaceSaving(tracked)
+        self.shared = shared
+        self.cached = cached
+        self.snapshot_file = snapshot_file
+        # hashes that were looked up since the last update, when there are more the oldest
+        # are dropped: the tracker then only counts a sample of the lookups, which is enough
+        self.pending = collections.deque(maxlen=tracked * 10)
+        self.hot = frozenset()
+        # db_hash -> token for the hashes in self.hot
+        self.tokens = {}
+        # bumped by invalidate, a token fetched before then may have been deleted since
+        self.generation = 0
+        # whether the last snapshot was read, until then it mustn't be overwritten
+        self.loaded = False
+
+    def record(self, db_hash):
+        self.pending.append(db_hash)
+
+    def get_token(self, db_hash):
+        if self.shared:
+            return self.shared.get(db_hash)
+        return self.tokens.get(db_hash)
+
+    def offer_token(self, db_hash, token, generation):
+        """
+        Caches a token fetched from the database if its hash is hot
+        generation is the one from before the fetch, the token isn't cached if a spoiler was deleted since
+        """
+        if db_hash not in self.hot or generation != self.generation:
+            return
+        if self.shared:
+            self.shared.put(db_hash, token)
+        else:
+            self.tokens[db_hash] = token
+
+    def invalidate(self, db_hash):
+        self.generation += 1
+        if self.shared:
+            self.shared.invalidate(db_hash)
+        self.tokens.pop(db_hash, None)
+
+    def update(self):
+        """Counts the pending lookups and recomputes the hot set"""
+        while True:
+            try:
+                self.tracker.add(self.pending.popleft())
+            except IndexError:
+                break
+
+        self.hot = frozenset(self.tracker.top(self.cached))
+        # the shared cache is left to its clock eviction, the others' hot hashes are in there too
+        for db_hash in list(self.tokens):
+            if db_hash not in self.hot:
+                del self.tokens[db_hash]
+
+    def snapshot(self):
+        """Saves the hot hashes (never the tokens) so they can be warmed up after a restart"""
+        if not self.loaded:
+            return
+        self.update()
+        temp_file = self.snapshot_file + '.tmp'
+        with open(temp_file, 'w') as f:
+            for db_hash in self.tracker.top(self.cached):
+                f.write(db_hash.hex() + '\n')
+        os.replace(temp_file, self.snapshot_file)
+        self.tracker.decay()
+
+    def load_snapshot(self):
+        """Returns the hashes saved by the last snapshot"""
+        self.loaded = True
+        try:
+            with open(self.snapshot_file) as f:
+                hashes = [bytes.fromhex(line.strip()) for line in f if line.strip()]
+        except (OSError, ValueError) as e:
+            logger.info(f'not warming up hot spoilers: {e}')
+            return []
+
+        for db_hash in hashes:
+            self.tracker.add(db_hash)
+        self.hot = frozenset(hashes)
+        return hashes
+
+    def warm_up(self, tokens, generation):
+        """
+        Caches the tokens of previously hot spoilers, tokens is an iterable of (hash, token)
+        fetched after generation was read
+        """
+        count = 0
+        for db_hash, token in tokens:
+            self.offer_token(bytes(db_hash), bytes(token), generation)
+            count += 1
+        logger.info(f'warmed up {count} hot spoiler(s)')
@@ -0,0 +1,147 @@
+import bisect
+import threading
+import time
+
+from counters import StripedCounter
+
+# upper bounds (in seconds) of the latency buckets, finer than the metrics ones for the percentiles
+LATENCY_BUCKETS = tuple(round(0.001 * 1.25 ** i, 6) for i in range(42))
+# the periods /stats reports on, in minutes
+PERIODS = (('5m', 5), ('1h', 60), ('24h', 1440))
+
+
+class RollingStats:
+    """
+    Event counts and handler latencies of the last `minutes` minutes, one slot per minute
+    The slots are reused as a ring, so the memory used never grows. Events and latencies
+    are counted per thread along with the minute they happened in, and added to the slots
+    by flush(), which a single job calls every 5 seconds (so they're up to 10 seconds late).
+    """
+    def __init__(self, minutes=1440):
+        self.minutes = minutes
+        self.lock = threading.Lock()
+        # the minute each slot currently holds
+        self.stamps = [-1] * minutes
+        # (event, spoiler type) -> count
+        self.counts = [{} for _ in range(minutes)]
+        # handled updates per latency bucket (the last one is for slower updates)
+        self.latencies = [[0] * (len(LATENCY_BUCKETS) + 1) for _ in range(minutes)]
+        # (minute, event, spoiler type) and (minute, latency bucket) -> count, until flushed
+        self.pending_counts = StripedCounter()
+        self.pending_latencies = StripedCounter()
+
+    def slot(self, minute):
+        """
+        Returns the index of a minute's slot, clearing it if it held an older minute
+        or None if the minute is too old to be kept (call with the lock held)
+        """
+        index = minute % self.minutes
+        if self.stamps[index] > minute:
+            return None
+        if self.stamps[index] != minute:
+            self.stamps[index] = minute
+            self.counts[index].clear()
+            latencies = self.latencies[index]
+            latencies[:] = [0] * len(latencies)
+        return index
+
+    def count(self, event, spoiler_type=''):
+        self.pending_counts.incr((int(time.time() // 60), event, spoiler_type))
+
+    def observe_latency(self, elapsed):
+        # the first bucket whose upper bound is at least elapsed, or the last one
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, elapsed)
+        self.pending_latencies.incr((int(time.time() // 60), bucket))
+
+    def flush(self, final=False):
+        """Adds what was counted since the last flush to the slots (see StripedCounter.collect)"""
+        with self.lock:
+            for (minute, event, spoiler_type), count in self.pending_counts.collect(final).items():
+                index = self.slot(minute)
+                if index is not None:
+                    slot_counts = self.counts[index]
+                    key = (event, spoiler_type)
+                    slot_counts[key] = slot_counts.get(key, 0) + count
+            for (minute, bucket), count in self.pending_latencies.collect(final).items():
+                index = self.slot(minute)
+                if index is not None:
+                    self.latencies[index][bucket] += count
+
+    def summarize(self, minutes):
+        """Returns the summed counts and latency buckets of the last few minutes"""
+        now = int(time.time() // 60)
+        counts = {}
+        latencies = [0] * (len(LATENCY_BUCKETS) + 1)
+        with self.lock:
+            for minute in range(now - minutes + 1, now + 1):
+                index = minute % self.minutes
+                if self.stamps[index] != minute:
+                    continue
+                for key, count in self.counts[index].items():
+                    counts[key] = counts.get(key, 0) + count
+                for i, count in enumerate(self.latencies[index]):
+                    latencies[i] += count
+        return counts, latencies
+
+    def report(self):
+        """A plain text summary of the last 5 minutes, hour and day"""
+        summaries = [self.summarize(minutes) for _, minutes in PERIODS]
+        lines = ['Last ' + ' / '.join(name for name, _ in PERIODS)]
+
+        def event_line(label, event, spoiler_type=None):
+            values = [
+                sum(
+                    count for (e, t), count in counts.items()
+                    if e == event and spoiler_type in (None, t)
+                )
+                for counts, _ in summaries
+            ]
+            lines.append(f'{label}: ' + ' / '.join(map(str, values)))
+
+        event_line('requests', 'request')
+        event_line('created', 'create')
+        spoiler_types = sorted({
+            spoiler_type for counts, _ in summaries
+            for event, spoiler_type in counts if event == 'create'
+        })
+        for spoiler_type in spoiler_types:
+            event_line(f'  {spoiler_type}', 'create', spoiler_type)
+        event_line('rate limit hits', 'hit')
+        event_line('bans', 'ban')
+
+        hit_rates = []
+        for counts, _ in summaries:
+            hits, misses = counts.get(('cache_hit', ''), 0), counts.get(('cache_miss', ''), 0)
+            hit_rates.append(f'{hits / (hits + misses):.0%}' if hits + misses else '-')
+        lines.append('cache hit rate: ' + ' / '.join(hit_rates))
+
+        for q in (0.5, 0.99):
+            values = [percentile(latencies, q) for _, latencies in summaries]
+            lines.append(f'p{round(q * 100)} latency: ' + ' / '.join(
+                format_latency(value) for value in values
+            ))
+        return '\n'.join(lines)
+
+
+def format_latency(value):
+    if value is None:
+        return '-'
+    if value == float('inf'):
+        return f'>{LATENCY_BUCKETS[-1]:.1f}s'
+    return f'{value * 1000:.0f}ms'
+
+
+def percentile(latencies, q):
+    """Estimates a percentile as the upper bound of the bucket it falls in"""
+    total = sum(latencies)
+    if not total:
+        return None
+    cumulative = 0
+    for bound, count in zip(LATENCY_BUCKETS + (float('inf'),), latencies):
+        cumulative += count
+        if cumulative >= q * total:
+            return bound
+
+
+# shared by every tenant of the process
+STATS = RollingStats()
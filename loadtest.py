@@ -0,0 +1,293 @@
+"""
+Drives synthetic updates through the real handlers to measure throughput
+
+The handlers talk to a fake bot (no Telegram traffic) but to a real database,
+so point --db-name at a scratch database: spoilers are created and users get banned.
+
+    python loadtest.py --db-name spoilerobot_load --updates 20000 --concurrency 8 --users 500
+"""
+import argparse
+import logging
+import random
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import telegram
+
+import config
+from database import Database
+from user import User
+from util import get_uuid
+import common
+import rate_limiter
+import spoilerobot
+
+logger = logging.getLogger(__name__)
+
+
+class FakeBot:
+    """Accepts any Bot API call and optionally pretends it took some time"""
+    username = 'spoilerobot'
+    token = 'LOADTEST'
+    base_url = 'https://api.telegram.org/botLOADTEST'
+
+    def __init__(self, api_latency=0):
+        self.api_latency = api_latency
+        self.calls = defaultdict(int)
+        self.lock = threading.Lock()
+        # for calls that post pre-serialized data directly (see util.answer_inline_query)
+        self.request = SimpleNamespace(
+            post=lambda url, data, timeout=None: self.call(url.rsplit('/', 1)[-1])
+        )
+
+    def call(self, method):
+        with self.lock:
+            self.calls[method] += 1
+        if self.api_latency:
+            time.sleep(self.api_latency)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self.call(name)
+
+
+class Scenarios:
+    """Builds synthetic updates and feeds them to the handlers"""
+    def __init__(self, bot, users, user_count):
+        self.bot = bot
+        self.users = users
+        self.user_count = user_count
+        # uuids of spoilers that have been created so far (as inline results would be)
+        self.uuids = []
+        self.next_id = 0
+        self.id_lock = threading.Lock()
+
+    def new_id(self):
+        with self.id_lock:
+            self.next_id += 1
+            return self.next_id
+
+    def random_user(self):
+        user_id = random.randrange(1, self.user_count + 1)
+        return telegram.User(user_id, first_name=f'load{user_id}', is_bot=False, username=f'load{user_id}')
+
+    def random_uuid(self):
+        if not self.uuids:
+            return get_uuid(is_major=random.random() < 0.5)
+        return random.choice(self.uuids)
+
+    def update(self, user, **kwargs):
+        return SimpleNamespace(update_id=self.new_id(), effective_user=user, **kwargs)
+
+    def message(self, user, text=None, photo=None, media_group_id=None):
+        return SimpleNamespace(
+            message_id=self.new_id(),
+            from_user=user,
+            text=text,
+            text_html=text,
+            caption=None,
+            photo=photo or [],
+            effective_attachment=photo,
+            media_group_id=media_group_id,
+            reply_text=lambda *args, **kwargs: self.bot.call('sendMessage')
+        )
+
+    # scenarios
+    def inline(self):
+        user = self.random_user()
+        query = f'spoiler number {random.randrange(10**6)}'
+        if random.random() < 0.3:
+            query = 'a title:::' + query
+        spoilerobot.on_inline(self.bot, self.update(user, inline_query=SimpleNamespace(
+            id=str(self.new_id()),
+            query=query,
+            from_user=user
+        )))
+
+    def inline_id(self):
+        user = self.random_user()
+        spoilerobot.on_inline(self.bot, self.update(user, inline_query=SimpleNamespace(
+            id=str(self.new_id()),
+            query='id:' + self.random_uuid(),
+            from_user=user
+        )))
+
+    def chosen(self):
+        user = self.random_user()
+        uuid = get_uuid(is_major=random.random() < 0.5)
+        spoilerobot.on_inline_chosen(self.bot, self.update(user, chosen_inline_result=SimpleNamespace(
+            result_id=uuid,
+            query=f'chosen spoiler {random.randrange(10**6)}',
+            from_user=user
+        )))
+        self.uuids.append(uuid)
+
+    def tap(self, uuid=None):
+        user = self.random_user()
+        spoilerobot.on_callback_query(self.bot, self.update(user, callback_query=SimpleNamespace(
+            id=str(self.new_id()),
+            data=uuid or self.random_uuid(),
+            from_user=user,
+            answer=lambda *args, **kwargs: self.bot.call('answerCallbackQuery')
+        )), self.users)
+
+    def double_tap(self):
+        uuid = self.random_uuid()
+        self.tap(uuid)
+        self.tap(uuid)
+
+    def deep_link(self):
+        user = self.random_user()
+        spoilerobot.cmd_start(
+            self.bot,
+            self.update(user, message=self.message(user, text='/start')),
+            [self.random_uuid()],
+            self.users
+        )
+
+    def media_conversation(self):
+        user = self.random_user()
+        spoilerobot.cmd_start(
+            self.bot, self.update(user, message=self.message(user, text='/start')), [], self.users
+        )
+        photo = [
+            telegram.PhotoSize(f'file{self.new_id()}', width=size, height=size)
+            for size in (90, 320, 800)
+        ]
+        for message in (self.message(user, photo=photo), self.message(user, text='a title')):
+            spoilerobot.on_message(self.bot, self.update(user, message=message), self.users)
+
+    def album_conversation(self):
+        user = self.random_user()
+        spoilerobot.cmd_start(
+            self.bot, self.update(user, message=self.message(user, text='/start')), [], self.users
+        )
+        media_group_id = str(self.new_id())
+        messages = [
+            self.message(
+                user,
+                photo=[telegram.PhotoSize(f'file{self.new_id()}', width=800, height=800)],
+                media_group_id=media_group_id
+            )
+            for _ in range(random.randint(2, 10))
+        ]
+        for message in messages + [self.message(user, text='-')]:
+            spoilerobot.on_message(self.bot, self.update(user, message=message), self.users)
+
+
+# name -> relative weight in the traffic mix
+MIX = {
+    'inline': 50,
+    'inline_id': 5,
+    'chosen': 10,
+    'tap': 20,
+    'double_tap': 10,
+    'deep_link': 3,
+    'media_conversation': 2,
+    'album_conversation': 1,
+}
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db-name', required=True, help='scratch database to run against')
+    parser.add_argument('--updates', type=int, default=10000, help='how many scenarios to run')
+    parser.add_argument('--concurrency', type=int, default=4, help='how many threads run scenarios')
+    parser.add_argument('--users', type=int, default=1000, help='how many distinct synthetic users')
+    parser.add_argument('--api-latency', type=float, default=0, help='seconds each fake Bot API call takes')
+    parser.add_argument(
+        '--memory-updates', type=int, default=2000,
+        help='how many more scenarios to run with tracemalloc after the timed run (0 to skip)'
+    )
+    args = parser.parse_args()
+
+    # the handlers log every request, which would drown out the report
+    logging.getLogger().setLevel(logging.WARNING)
+
+    config.DB_NAME = args.db_name
+    bot = FakeBot(args.api_latency)
+    database = common.databases[bot.token] = Database()
+    database.start()
+    users = defaultdict(User)
+    scenarios = Scenarios(bot, users, args.users)
+    names = list(MIX)
+    weights = [MIX[name] for name in names]
+
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    errors_lock = threading.Lock()
+    # scenarios whose first failure was logged
+    logged = set()
+
+    def run(name):
+        start = time.perf_counter()
+        try:
+            getattr(scenarios, name)()
+        except Exception:
+            with errors_lock:
+                errors[name] += 1
+                first = name not in logged
+                logged.add(name)
+            if first:
+                logger.exception(f'scenario {name} failed (further failures are only counted)')
+        latencies[name].append(time.perf_counter() - start)
+
+    def run_all(count):
+        plan = random.choices(names, weights=weights, k=count)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            for _ in executor.map(run, plan):
+                pass
+        return time.perf_counter() - start
+
+    # tracing allocations slows everything down, so the timed run isn't traced
+    elapsed = run_all(args.updates)
+    timed_latencies = {name: list(values) for name, values in latencies.items()}
+    timed_errors = dict(errors)
+
+    if args.memory_updates:
+        tracemalloc.start()
+        memory_before = tracemalloc.get_traced_memory()[0]
+        run_all(args.memory_updates)
+        memory_after, memory_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    print(f'{args.updates} scenarios in {elapsed:.2f}s ({args.updates / elapsed:.1f}/s) '
+          f'with {args.concurrency} threads and {args.users} users')
+    print(f'{"scenario":<20}{"count":>8}{"errors":>8}{"p50 ms":>10}{"p90 ms":>10}{"p99 ms":>10}')
+    for name in names:
+        values = timed_latencies.get(name, [])
+        print(
+            f'{name:<20}{len(values):>8}{timed_errors.get(name, 0):>8}'
+            f'{percentile(values, 0.5) * 1000:>10.2f}'
+            f'{percentile(values, 0.9) * 1000:>10.2f}'
+            f'{percentile(values, 0.99) * 1000:>10.2f}'
+        )
+
+    print(f'\nusers: {len(users)} entries, '
+          f'{sum(len(user.last_clicks) for user in users.values())} remembered clicks')
+    pressures = rate_limiter.PRESSURES[bot.token]
+    print(f'PRESSURES: {len(pressures)} entries, '
+          f'{sum(1 for pressure in pressures.values() if pressure.inbox)} pending inboxes')
+    print(f'banned users: {len(database.banned_users)}')
+    if args.memory_updates:
+        print(f'memory growth over {args.memory_updates} more scenarios: '
+              f'{(memory_after - memory_before) / 1024:.1f} KiB '
+              f'(peak {(memory_peak - memory_before) / 1024:.1f} KiB)')
+    print('Bot API calls: ' + ', '.join(f'{k}={v}' for k, v in sorted(bot.calls.items())))
+
+
+if __name__ == '__main__':
+    main()
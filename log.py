@@ -0,0 +1,115 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+from datetime import datetime, timezone
+
+from config import LOG_FILE, LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_SAMPLE_RATES
+
+# fields passed through the extra argument that are copied into json records
+STRUCTURED_FIELDS = ('user_id', 'username', 'event', 'spoiler_type', 'latency', 'sample_rate')
+
+_listener = None
+_exception_formatter = logging.Formatter()
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as one json object per line"""
+    def format(self, record):
+        data = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in STRUCTURED_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Drops a fraction of records by their event field
+    rates maps an event to the fraction of records to keep, other records are always kept
+    """
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        rate = self.rates.get(getattr(record, 'event', None))
+        if rate is None:
+            return True
+        if random.random() >= rate:
+            return False
+        # so that counts can be estimated from a sampled log
+        record.sample_rate = rate
+        return True
+
+
+# argument types that can't change before the listener thread formats the message
+IMMUTABLE_ARGS = (str, int, float, bool, type(None))
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    A QueueHandler that leaves formatting to the listener thread when it's safe to
+    (the stock one formats the message before enqueueing it, on the caller's thread)
+    Messages with other arguments and tracebacks are still formatted right away,
+    since the objects they refer to may have changed by the time the listener gets to them
+    """
+    def prepare(self, record):
+        args = record.args
+        if args and not (
+            isinstance(args, tuple) and all(isinstance(arg, IMMUTABLE_ARGS) for arg in args)
+        ):
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            record.exc_text = _exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup():
+    """Routes the root logger through a queue so that handlers only pay for an enqueue"""
+    global _listener
+    log_queue = queue.SimpleQueue()
+
+    file_handler = logging.handlers.RotatingFileHandler(
+        LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT
+    )
+    file_handler.setFormatter(JsonFormatter())
+
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(
+        logging.Formatter("%(asctime)s - %(levelname)-5.5s - %(message)s")
+    )
+
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(LOG_SAMPLE_RATES))
+
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+    logger.addHandler(queue_handler)
+
+    _listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler)
+    _listener.start()
+    atexit.register(stop)
+    return logger
+
+
+def stop():
+    """Writes out everything that's still queued and stops the writer thread"""
+    global _listener
+    if _listener:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,278 @@
+import asyncio
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import live_stats
+from config import SLOW_UPDATE_THRESHOLD
+
+logger = logging.getLogger(__name__)
+
+# upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+
+
+class Histogram:
+    """A prometheus style histogram with one set of buckets per label set"""
+    def __init__(self, name, help_text, label_names, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # labels -> [bucket counts..., overflow count, sum, count]
+        self.series = {}
+
+    def observe(self, value, *labels):
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [0] * (len(self.buckets) + 3)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            else:
+                series[len(self.buckets)] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def expose(self):
+        lines = [
+            f'# HELP {self.name} {self.help_text}',
+            f'# TYPE {self.name} histogram'
+        ]
+        with self.lock:
+            series = {labels: list(values) for labels, values in self.series.items()}
+
+        for labels, values in sorted(series.items()):
+            label_str = ','.join(f'{k}="{v}"' for k, v in zip(self.label_names, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), values):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label_str},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{label_str}}} {values[-2]}')
+            lines.append(f'{self.name}_count{{{label_str}}} {values[-1]}')
+        return lines
+
+
+HANDLER_SECONDS = Histogram(
+    'spoilerobot_handler_seconds',
+    'Time spent handling an update',
+    ('handler',)
+)
+PHASE_SECONDS = Histogram(
+    'spoilerobot_handler_phase_seconds',
+    'Time spent in each phase (db, crypto, telegram) while handling an update',
+    ('handler', 'phase')
+)
+
+class UpdateTiming:
+    """Where the update currently being handled has spent its time"""
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {}
+        # (step, elapsed) in the order they happened
+        self.steps = []
+
+
+# a context variable rather than a thread local, so that it also works for asyncio tasks
+_current = ContextVar('update_timing', default=None)
+_in_flight = 0
+_in_flight_lock = threading.Lock()
+# callables that return extra exposition lines, see add_collector
+_collectors = []
+
+
+@contextmanager
+def phase(name, step=None):
+    """
+    Attributes the time spent inside the block to a phase of the current update
+    step is a finer grained name (ie select, decrypt) only used for the slow update log
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing = _current.get()
+        if timing is not None:
+            elapsed = time.perf_counter() - start
+            timing.phases[name] = timing.phases.get(name, 0) + elapsed
+            timing.steps.append((step or name, elapsed))
+
+
+def instrument(name):
+    """
+    Records the latency of a handler and the phases it spent time in
+    decorates a handler function (or coroutine function),
+    should be outside check_ban so the ban check is included
+    """
+    def begin():
+        global _in_flight
+        with _in_flight_lock:
+            _in_flight += 1
+        return _current.set(UpdateTiming())
+
+    def end(token):
+        global _in_flight
+        timing = _current.get()
+        _current.reset(token)
+        with _in_flight_lock:
+            _in_flight -= 1
+
+        elapsed = time.perf_counter() - timing.start
+        HANDLER_SECONDS.observe(elapsed, name)
+        live_stats.STATS.observe_latency(elapsed)
+        for phase_name, phase_elapsed in timing.phases.items():
+            PHASE_SECONDS.observe(phase_elapsed, name, phase_name)
+
+        if elapsed >= SLOW_UPDATE_THRESHOLD:
+            log_slow_update(name, elapsed, timing.steps)
+
+    def _real(function):
+        if asyncio.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def wrapped_async(*args, **kwargs):
+                token = begin()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    end(token)
+            return wrapped_async
+
+        @functools.wraps(function)
+        def wrapped(*args, **kwargs):
+            token = begin()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                end(token)
+        return wrapped
+
+    return _real
+
+
+def elapsed():
+    """Returns how long the current update has been handled for (0 outside of handlers)"""
+    timing = _current.get()
+    if timing is None:
+        return 0
+    return time.perf_counter() - timing.start
+
+
+def log_slow_update(name, elapsed, steps):
+    accounted = sum(step_elapsed for _, step_elapsed in steps)
+    breakdown = ', '.join(
+        f'{step}={step_elapsed * 1000:.1f}ms' for step, step_elapsed in steps
+    )
+    logger.warning(
+        f'slow update in {name}: {elapsed * 1000:.1f}ms '
+        f'({breakdown or "no phases"}; other={(elapsed - accounted) * 1000:.1f}ms)'
+    )
+
+
+class StartupTimer:
+    """Times the phases of the startup, from start (a perf_counter value) until report is called"""
+    def __init__(self, start):
+        self.start = start
+        self.last = start
+        self.phases = []
+
+    def mark(self, name):
+        """Ends the current phase, which is called name"""
+        now = time.perf_counter()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def report(self):
+        total = self.last - self.start
+        breakdown = ', '.join(f'{name} {elapsed:.3f}s' for name, elapsed in self.phases)
+        logger.info(
+            f'started in {total:.3f}s ({breakdown})',
+            extra={'startup': {name: round(elapsed, 6) for name, elapsed in self.phases}}
+        )
+        return total
+
+
+def in_flight():
+    return _in_flight
+
+
+def add_route(path, route):
+    """Serves a path from the metrics server, route returns (status, content type, body)"""
+    MetricsRequestHandler.routes[path] = route
+
+
+def add_collector(collector):
+    """Adds a callable returning a list of extra lines for the metrics endpoint"""
+    _collectors.append(collector)
+
+
+def gauge(name, help_text, value):
+    return [
+        f'# HELP {name} {help_text}',
+        f'# TYPE {name} gauge',
+        f'{name} {value}'
+    ]
+
+
+def counter(name, help_text, label_names, values):
+    """Formats a dict of label tuple -> value as a prometheus counter"""
+    lines = [
+        f'# HELP {name} {help_text}',
+        f'# TYPE {name} counter'
+    ]
+    for labels, value in sorted(values.items()):
+        label_str = ','.join(f'{k}="{v}"' for k, v in zip(label_names, labels))
+        lines.append(f'{name}{{{label_str}}} {value}')
+    return lines
+
+
+def expose():
+    lines = []
+    lines += HANDLER_SECONDS.expose()
+    lines += PHASE_SECONDS.expose()
+    lines += gauge('spoilerobot_in_flight_updates', 'Updates currently being handled', _in_flight)
+    for collector in _collectors:
+        lines += collector()
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    # path -> callable returning (status, content type, body)
+    routes = {
+        '/metrics': lambda: (200, 'text/plain; version=0.0.4', expose())
+    }
+
+    def do_GET(self):
+        route = self.routes.get(self.path.split('?', 1)[0])
+        if not route:
+            self.send_error(404)
+            return
+
+        status, content_type, body = route()
+        body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes are far too frequent to be worth logging
+        pass
+
+
+def serve(host, port):
+    """Serves the metrics endpoint from a background thread"""
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f'serving metrics on http://{host}:{port}/metrics')
+    return server
@@ -0,0 +1,72 @@
+import logging
+import sys
+import threading
+import time
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+_running = threading.Lock()
+
+
+def frame_stack(frame):
+    """Returns the stack of a frame as a list of names, outermost first"""
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f'{code.co_name} ({code.co_filename.rsplit("/", 1)[-1]}:{code.co_firstlineno})')
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+def sample(duration, interval):
+    """
+    Samples the stacks of every other thread for duration seconds
+    returns a Counter of collapsed stacks (semicolon separated frames)
+    """
+    own_id = threading.get_ident()
+    thread_names = {}
+    stacks = Counter()
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            if thread_id not in thread_names:
+                thread_names = {t.ident: t.name for t in threading.enumerate()}
+            thread_name = thread_names.get(thread_id, str(thread_id))
+            stacks[';'.join([thread_name] + frame_stack(frame))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+def write_collapsed(stacks, path):
+    """Writes stacks in the collapsed format used by flamegraph.pl and speedscope"""
+    with open(path, 'w') as f:
+        for stack, count in stacks.most_common():
+            f.write(f'{stack} {count}\n')
+
+
+def start(duration, interval, on_done):
+    """
+    Starts profiling in a background thread, calls on_done(path, sample_count) when finished
+    Returns False if a profile is already running
+    """
+    if not _running.acquire(blocking=False):
+        return False
+
+    def run():
+        try:
+            stacks = sample(duration, interval)
+            path = f'profile-{int(time.time())}.folded'
+            write_collapsed(stacks, path)
+            logger.info(f'wrote {sum(stacks.values())} profile samples to {path}')
+            on_done(path, sum(stacks.values()))
+        except Exception:
+            logger.exception('profiling failed')
+        finally:
+            _running.release()
+
+    threading.Thread(target=run, name='profiler', daemon=True).start()
+    return True
@@ -0,0 +1,62 @@
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Purger:
+    """
+    Deletes the spoilers of banned users from a background thread
+    Each owner is purged delete_batch(owner, batch_size) rows at a time (the
+    function returns how many it deleted), pausing in between so that a large
+    purge never holds many row locks or hogs the connection for long.
+    A short batch doesn't mean the owner has no spoilers left (rows may have been
+    locked or added meanwhile), it's over once has_more(owner) returns False.
+    """
+    def __init__(self, delete_batch, has_more, batch_size, pause):
+        self.delete_batch = delete_batch
+        self.has_more = has_more
+        self.batch_size = batch_size
+        self.pause = pause
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='purger', daemon=True)
+        self.thread.start()
+
+    def purge(self, owner, on_done=None):
+        """Queues a purge, on_done is called with the number of deleted spoilers once it's done"""
+        self.queue.put((owner, on_done))
+
+    def run(self):
+        while True:
+            owner, on_done = self.queue.get()
+            count = 0
+            try:
+                while True:
+                    deleted = self.delete_batch(owner, self.batch_size)
+                    count += deleted
+                    if deleted < self.batch_size and not self.has_more(owner):
+                        break
+                    time.sleep(self.pause)
+                logger.info(f'purged {count} spoiler(s) of {owner}')
+            except Exception:
+                logger.exception(f'purge of {owner} failed after {count} spoiler(s)')
+
+            try:
+                if on_done:
+                    on_done(count)
+            except Exception:
+                logger.exception('purge callback failed')
+            finally:
+                self.queue.task_done()
+
+    def wait(self, timeout):
+        """Waits for the queued purges to finish, returns False if they didn't in time"""
+        deadline = time.monotonic() + timeout
+        while self.queue.unfinished_tasks:
+            if time.monotonic() > deadline:
+                logger.warning(f'gave up waiting on {self.queue.unfinished_tasks} purge(s)')
+                return False
+            time.sleep(0.05)
+        return True
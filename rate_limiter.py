@@ -4,6 +4,7 @@ from config import (
     RATE_LIMIT_DECAY_PERIOD, RATE_LIMIT_PRESSURE_LIMIT, RATE_LIMIT_BAN_TIME,
     ADMIN_ID
 )
+import metrics
 from util import pretty_timestamp
 
 
@@ -12,10 +13,16 @@ class UserPressure:
         self.pressure = 0
         self.last_hit = 0
         self.inbox = ''
+        # whether the inbox is being sent right now
+        self.inbox_sending = False
 
 
-def hit(user_id, database, bot):
-    user = PRESSURES[user_id]
+def add_pressure(user_id, bot):
+    """
+    Records a hit for a user
+    returns the time the user should be banned until if the limit was reached, otherwise None
+    """
+    user = PRESSURES[bot.token][user_id]
 
     current_time = time.time()
     time_delta = current_time - user.last_hit
@@ -24,33 +31,66 @@ def hit(user_id, database, bot):
     user.last_hit = current_time
 
     if user.pressure > RATE_LIMIT_PRESSURE_LIMIT:
-        ban_expiry = current_time + RATE_LIMIT_BAN_TIME
-        pretty_expiry = pretty_timestamp(ban_expiry)
-        remove_count = database.ban_user(user_id, ban_expiry)
-        user.inbox = (
-            f'You have been banned from creating new spoilers until {pretty_expiry}.\n'
-            f'As a result of this, {remove_count} of your most recent spoilers have been permanently deleted.\n\n'
-            f'Please contact <a href="tg://user?id={ADMIN_ID}">my owner</a> if you feel this was done in error!'
-        )
-        try_inbox(user_id, bot)
-        bot.send_message(
-            chat_id=ADMIN_ID,
-            text=f'<a href="tg://user?id={user_id}">{user_id}</a> has been banned'
-                 f' until {pretty_expiry}\n{remove_count} spoilers were removed.',
-            parse_mode='HTML'
+        return current_time + RATE_LIMIT_BAN_TIME
+    return None
+
+
+def notify_ban(user_id, bot, ban_expiry, remove_count):
+    """Tells the user and the admin about a ban"""
+    pretty_expiry = pretty_timestamp(ban_expiry)
+    PRESSURES[bot.token][user_id].inbox = (
+        f'You have been banned from creating new spoilers until {pretty_expiry}.\n'
+        f'As a result of this, {remove_count} of your most recent spoilers have been permanently deleted.\n\n'
+        f'Please contact <a href="tg://user?id={ADMIN_ID}">my owner</a> if you feel this was done in error!'
+    )
+    try_inbox(user_id, bot)
+    bot.send_message(
+        chat_id=ADMIN_ID,
+        text=f'<a href="tg://user?id={user_id}">{user_id}</a> has been banned'
+             f' until {pretty_expiry}\n{remove_count} spoilers were removed.',
+        parse_mode='HTML'
+    )
+
+
+def hit(user_id, database, bot):
+    with metrics.phase('rate_limit'):
+        ban_expiry = add_pressure(user_id, bot)
+    database.count_event('hit')
+    if ban_expiry:
+        # the user is told once their spoilers were deleted, which happens in the background
+        database.ban_user(
+            user_id, ban_expiry,
+            on_purged=lambda remove_count: notify_ban(user_id, bot, ban_expiry, remove_count)
         )
+        database.count_event('ban')
 
 
 def try_inbox(user_id, bot):
-    user = PRESSURES[user_id]
-    if not user.inbox:
+    user = PRESSURES[bot.token][user_id]
+    if not user.inbox or user.inbox_sending:
         return
 
+    inbox = user.inbox
+
+    def sent(ok):
+        user.inbox_sending = False
+        # kept if the message couldn't be sent, or if a newer one replaced it in the meantime
+        if ok and user.inbox == inbox:
+            user.inbox = ''
+
+    user.inbox_sending = True
     try:
-        bot.send_message(chat_id=user_id, text=user.inbox, parse_mode='HTML')
-        user.inbox = ''
+        result = bot.send_message(chat_id=user_id, text=inbox, parse_mode='HTML')
     except:
-        pass
+        sent(False)
+        return
+
+    if hasattr(result, 'add_done_callback'):
+        # the asyncio engine's bot only schedules the call
+        result.add_done_callback(lambda future: sent(not future.cancelled() and not future.exception()))
+    else:
+        sent(True)
 
 
-PRESSURES = defaultdict(UserPressure)
\ No newline at end of file
+# bot token -> user id -> pressure, each tenant (see config.TENANTS) limits its own users
+PRESSURES = defaultdict(lambda: defaultdict(UserPressure))
\ No newline at end of file
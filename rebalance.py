@@ -0,0 +1,94 @@
+"""
+Moves spoilers to the shard they belong to after the list of shards changed, online
+
+    1. set tg_bot_spoilero_previous_shards to the current list of shards and
+       tg_bot_spoilero_shards to the new one, then restart the bots: new spoilers
+       go to the new shards and lookups fall back to the previous ones
+    2. python rebalance.py (with the same environment)
+    3. once it's done, unset tg_bot_spoilero_previous_shards and restart the bots
+
+Every previous shard is scanned in hash order. Rows that belong to another shard in
+the new layout are copied there (rows that are already there are kept) and then
+deleted. An interrupted rebalance can be resumed by running it again, only the rows
+that stay where they are are scanned again. Views counted while a batch is being
+moved may be lost. Copied rows whose owner got banned meanwhile are deleted again,
+the ban's purge may have run in between the scan and the copy.
+"""
+import argparse
+import time
+
+import config
+
+
+class Progress:
+    def __init__(self):
+        self.start = time.monotonic()
+        self.scanned = 0
+        self.moved = 0
+
+    def add(self, index, after, scanned, moved):
+        self.scanned += scanned
+        self.moved += moved
+        elapsed = time.monotonic() - self.start
+        print(
+            f'shard {index} up to {after[:4].hex()}: moved {moved} of {scanned} rows '
+            f'(total {self.moved} of {self.scanned}, {self.scanned / elapsed:.0f} rows/s)'
+        )
+
+
+def banned_owners(connection, rows):
+    """The (tenant, owner) pairs of the rows whose owner is banned"""
+    owners = list({row[3] for row in rows if row[3] > 0})
+    if not owners:
+        return set()
+    cursor = connection.cursor(use_dict_factory=False)
+    cursor.execute(
+        'SELECT tenant, user_id FROM banned_users WHERE user_id = ANY(%s) AND expires > %s',
+        (owners, int(time.time()))
+    )
+    return set(cursor)
+
+
+def rebalance(shard_map, batch_size, pause, get_banned):
+    """get_banned(rows) returns the (tenant, owner) pairs of rows whose owner is banned"""
+    progress = Progress()
+    for index, shard in enumerate(shard_map.previous):
+        after = b''
+        while True:
+            rows = shard.scan(after, batch_size)
+            if not rows:
+                break
+            after = rows[-1][0]
+
+            leaving = [row for row in rows if shard_map.for_hash(row[0]) is not shard]
+            if leaving:
+                # copied before they're deleted, so that a lookup always finds them somewhere
+                shard_map.insert_many(leaving)
+                # checked after the copy: a ban is stored before its purge starts
+                banned = get_banned(leaving)
+                if banned:
+                    shard_map.delete([row[0] for row in leaving if (row[4], row[3]) in banned])
+                shard.delete([row[0] for row in leaving])
+
+            progress.add(index, after, len(rows), len(leaving))
+            time.sleep(pause)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch', type=int, default=1000, help='rows scanned at a time')
+    parser.add_argument('--pause', type=float, default=0.1, help='seconds to wait in between batches')
+    args = parser.parse_args()
+
+    if not config.PREVIOUS_SHARDS:
+        parser.error('tg_bot_spoilero_previous_shards must list the shards to move the spoilers from')
+
+    from database import Connection
+    connection = Connection()
+    rebalance(connection.shards, args.batch, args.pause, lambda rows: banned_owners(connection, rows))
+    connection.close()
+    print('done, tg_bot_spoilero_previous_shards can be unset')
+
+
+if __name__ == '__main__':
+    main()
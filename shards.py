@@ -0,0 +1,393 @@
+"""
+spoilers_v2 split across several databases by the prefix of the spoiler's hash
+
+The hashes from split_uuid are uniformly distributed, so the first two bytes of a
+hash pick its shard: shard i of n holds the prefixes in [65536 * i / n, 65536 * (i + 1) / n).
+Lookups and inserts go to a single shard, operations by owner go to all of them.
+
+While the shards are being rebalanced (see rebalance.py) the previous layout is kept
+too: new spoilers go to the new layout and lookups that miss there are retried on the
+shard the spoiler used to be on, until rebalance.py moved it. Inserts check that
+shard too, so that an update delivered twice doesn't store the spoiler again.
+"""
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+def shard_index(db_hash, count):
+    return int.from_bytes(db_hash[:2], 'big') * count >> 16
+
+
+class PostgresShard:
+    """
+    spoilers_v2 on a postgres database, through a database.Connection
+    psycopg2 is imported where it's used, so that sqlite shards work without it
+    """
+    def __init__(self, connection, owns_connection=True):
+        self.shared = connection
+        self.owns_connection = owns_connection
+
+    def cursor(self):
+        return self.shared.cursor(use_dict_factory=False)
+
+    def insert(self, row, timeout=None):
+        """Inserts a (hash, timestamp, token, owner, tenant) row, returns False if it was there already"""
+        cursor = self.cursor()
+        # both statements run in one implicit transaction, so the timeout only applies to this insert
+        cursor.execute(
+            'SET LOCAL statement_timeout = %s; '
+            'INSERT INTO spoilers_v2 (hash, timestamp, token, owner, tenant) VALUES (%s, %s, %s, %s, %s) '
+            'ON CONFLICT (hash) DO NOTHING',
+            (int(timeout * 1000) if timeout else 0,) + tuple(row)
+        )
+        return cursor.rowcount == 1
+
+    def insert_many(self, rows):
+        """Inserts (hash, timestamp, token, owner, tenant, views) rows, skipping existing hashes"""
+        import psycopg2.extras
+        psycopg2.extras.execute_values(
+            self.cursor(),
+            '''
+            INSERT INTO spoilers_v2 (hash, timestamp, token, owner, tenant, views) VALUES %s
+            ON CONFLICT (hash) DO NOTHING;
+            ''',
+            rows,
+            page_size=len(rows)
+        )
+
+    def get_token(self, db_hash):
+        cursor = self.cursor()
+        cursor.execute('SELECT token FROM spoilers_v2 WHERE hash=%s', (db_hash,))
+        row = cursor.fetchone()
+        return bytes(row[0]) if row else None
+
+    def get_tokens(self, hashes):
+        """Returns (hash, token) of the hashes that are stored here"""
+        import psycopg2
+        cursor = self.cursor()
+        cursor.execute(
+            'SELECT hash, token FROM spoilers_v2 WHERE hash = ANY(%s)',
+            ([psycopg2.Binary(db_hash) for db_hash in hashes],)
+        )
+        return [(bytes(db_hash), bytes(token)) for db_hash, token in cursor]
+
+    def add_views(self, counts):
+        """Adds to the views of a sorted list of (hash, count), sorted so that flushes can't deadlock"""
+        import psycopg2.extras
+        psycopg2.extras.execute_values(
+            self.cursor(),
+            '''
+            UPDATE spoilers_v2 SET views = spoilers_v2.views + v.count
+            FROM (VALUES %s) AS v (hash, count)
+            WHERE spoilers_v2.hash = v.hash;
+            ''',
+            counts,
+            page_size=1000
+        )
+
+    def get_views(self, db_hash):
+        cursor = self.cursor()
+        cursor.execute('SELECT views FROM spoilers_v2 WHERE hash=%s', (db_hash,))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def delete_owner(self, owner, tenant, limit):
+        """Deletes up to limit spoilers of an owner, returns their hashes"""
+        cursor = self.cursor()
+        # by hash rather than ctid, a row updated in the meantime (ie its views) has a new ctid
+        cursor.execute('''
+            DELETE FROM spoilers_v2 WHERE hash IN (
+                SELECT hash FROM spoilers_v2 WHERE owner = %s AND tenant = %s LIMIT %s
+            ) RETURNING hash;
+            ''',
+            (owner, tenant, limit)
+        )
+        return [bytes(db_hash) for (db_hash,) in cursor]
+
+    def has_owner(self, owner, tenant):
+        cursor = self.cursor()
+        cursor.execute('SELECT 1 FROM spoilers_v2 WHERE owner = %s AND tenant = %s LIMIT 1', (owner, tenant))
+        return cursor.fetchone() is not None
+
+    def forget_owners(self, before, tenant):
+        cursor = self.cursor()
+        cursor.execute(
+            'UPDATE spoilers_v2 SET owner = 0 WHERE timestamp <= %s AND owner > 0 AND tenant = %s;',
+            (before, tenant)
+        )
+        return cursor.rowcount
+
+    def scan(self, after, limit):
+        """Returns up to limit full rows (see insert_many) with a hash greater than after, in hash order"""
+        cursor = self.cursor()
+        cursor.execute(
+            'SELECT hash, timestamp, token, owner, tenant, views FROM spoilers_v2 '
+            'WHERE hash > %s ORDER BY hash LIMIT %s',
+            (after, limit)
+        )
+        return [
+            (bytes(db_hash), timestamp, bytes(token), owner, tenant, views)
+            for db_hash, timestamp, token, owner, tenant, views in cursor
+        ]
+
+    def delete(self, hashes):
+        import psycopg2
+        self.cursor().execute(
+            'DELETE FROM spoilers_v2 WHERE hash = ANY(%s)',
+            ([psycopg2.Binary(db_hash) for db_hash in hashes],)
+        )
+
+    def timestamps(self):
+        cursor = self.cursor()
+        cursor.execute('SELECT timestamp FROM spoilers_v2')
+        return [timestamp for (timestamp,) in cursor]
+
+    def ping(self):
+        self.cursor().execute('SELECT 1')
+
+    def close(self):
+        if self.owns_connection:
+            self.shared.close()
+
+
+class SqliteShard:
+    """
+    spoilers_v2 in a sqlite file, a stand-in for a postgres shard when testing
+    (ie sharding across a few files on a laptop), not meant for production
+    """
+    SCHEMA = (
+        '''
+            CREATE TABLE IF NOT EXISTS spoilers_v2 (
+                hash BLOB PRIMARY KEY,
+                timestamp INTEGER,
+                token BLOB,
+                owner INTEGER,
+                tenant TEXT NOT NULL DEFAULT '',
+                views INTEGER NOT NULL DEFAULT 0
+            )
+        ''',
+        # like database.SCHEMA, only spoilers with an owner so that they can be purged quickly
+        '''
+            CREATE INDEX IF NOT EXISTS spoilers_v2_owner ON spoilers_v2 (owner) WHERE owner > 0
+        ''',
+    )
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.lock = threading.Lock()
+        for statement in self.SCHEMA:
+            self.connection.execute(statement)
+
+    def execute(self, query, parameters=()):
+        with self.lock:
+            return self.connection.execute(query, parameters).fetchall()
+
+    def insert(self, row, timeout=None):
+        with self.lock:
+            cursor = self.connection.execute(
+                'INSERT OR IGNORE INTO spoilers_v2 (hash, timestamp, token, owner, tenant) VALUES (?, ?, ?, ?, ?)',
+                tuple(row)
+            )
+            return cursor.rowcount == 1
+
+    def insert_many(self, rows):
+        with self.lock:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO spoilers_v2 (hash, timestamp, token, owner, tenant, views) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                rows
+            )
+
+    def get_token(self, db_hash):
+        rows = self.execute('SELECT token FROM spoilers_v2 WHERE hash = ?', (db_hash,))
+        return bytes(rows[0][0]) if rows else None
+
+    def get_tokens(self, hashes):
+        found = []
+        for db_hash in hashes:
+            token = self.get_token(db_hash)
+            if token:
+                found.append((db_hash, token))
+        return found
+
+    def add_views(self, counts):
+        with self.lock:
+            self.connection.executemany(
+                'UPDATE spoilers_v2 SET views = views + ? WHERE hash = ?',
+                [(count, db_hash) for db_hash, count in counts]
+            )
+
+    def get_views(self, db_hash):
+        rows = self.execute('SELECT views FROM spoilers_v2 WHERE hash = ?', (db_hash,))
+        return rows[0][0] if rows else None
+
+    def delete_owner(self, owner, tenant, limit):
+        with self.lock:
+            hashes = [
+                bytes(db_hash) for (db_hash,) in self.connection.execute(
+                    'SELECT hash FROM spoilers_v2 WHERE owner = ? AND tenant = ? LIMIT ?',
+                    (owner, tenant, limit)
+                )
+            ]
+            self.connection.executemany('DELETE FROM spoilers_v2 WHERE hash = ?', [(h,) for h in hashes])
+            return hashes
+
+    def has_owner(self, owner, tenant):
+        return bool(self.execute(
+            'SELECT 1 FROM spoilers_v2 WHERE owner = ? AND tenant = ? LIMIT 1', (owner, tenant)
+        ))
+
+    def forget_owners(self, before, tenant):
+        with self.lock:
+            return self.connection.execute(
+                'UPDATE spoilers_v2 SET owner = 0 WHERE timestamp <= ? AND owner > 0 AND tenant = ?',
+                (before, tenant)
+            ).rowcount
+
+    def scan(self, after, limit):
+        return [
+            (bytes(db_hash), timestamp, bytes(token), owner, tenant, views)
+            for db_hash, timestamp, token, owner, tenant, views in self.execute(
+                'SELECT hash, timestamp, token, owner, tenant, views FROM spoilers_v2 '
+                'WHERE hash > ? ORDER BY hash LIMIT ?',
+                (after, limit)
+            )
+        ]
+
+    def delete(self, hashes):
+        with self.lock:
+            self.connection.executemany('DELETE FROM spoilers_v2 WHERE hash = ?', [(h,) for h in hashes])
+
+    def timestamps(self):
+        return [timestamp for (timestamp,) in self.execute('SELECT timestamp FROM spoilers_v2')]
+
+    def ping(self):
+        self.execute('SELECT 1')
+
+    def close(self):
+        self.connection.close()
+
+
+class ShardMap:
+    """
+    Routes spoilers_v2 operations to shards, see the module docstring
+    shards and previous are lists of shards (previous only while rebalancing),
+    a shard that's in both layouts should be the same object in both lists.
+    """
+    def __init__(self, shards, previous=None):
+        self.shards = shards
+        self.previous = previous or None
+        # every shard a spoiler may be on, for the operations that fan out
+        self.all = list({id(shard): shard for shard in shards + (previous or [])}.values())
+        self.executor = ThreadPoolExecutor(max_workers=len(self.all), thread_name_prefix='shard')
+
+    def for_hash(self, db_hash):
+        return self.shards[shard_index(db_hash, len(self.shards))]
+
+    def candidates(self, db_hash):
+        """The shards a spoiler may be on, where it should be first"""
+        shard = self.for_hash(db_hash)
+        if not self.previous:
+            return [shard]
+        previous = self.previous[shard_index(db_hash, len(self.previous))]
+        return [shard] if previous is shard else [shard, previous]
+
+    def group(self, items, key=lambda item: item):
+        """Splits items by the shard their hash belongs to"""
+        groups = {}
+        for item in items:
+            shard = self.for_hash(key(item))
+            groups.setdefault(id(shard), (shard, []))[1].append(item)
+        return groups.values()
+
+    def fan_out(self, function):
+        """Calls function(shard) on every shard in parallel, returns the results"""
+        if len(self.all) == 1:
+            return [function(self.all[0])]
+        futures = [self.executor.submit(function, shard) for shard in self.all]
+        return [future.result() for future in futures]
+
+    def insert(self, row, timeout=None):
+        """Returns False if the spoiler was there already, on its shard or the one it used to be on"""
+        shard, *previous = self.candidates(row[0])
+        if previous and previous[0].get_token(row[0]):
+            return False
+        return shard.insert(row, timeout)
+
+    def insert_many(self, rows):
+        for shard, shard_rows in self.group(rows, key=lambda row: row[0]):
+            shard.insert_many(shard_rows)
+
+    def delete(self, hashes):
+        for shard, shard_hashes in self.group(hashes):
+            shard.delete(shard_hashes)
+
+    def get_token(self, db_hash):
+        for shard in self.candidates(db_hash):
+            token = shard.get_token(db_hash)
+            if token:
+                return token
+        return None
+
+    def get_tokens(self, hashes):
+        found = []
+        for shard, shard_hashes in self.group(hashes):
+            found += shard.get_tokens(shard_hashes)
+        if self.previous:
+            missing = set(hashes) - {db_hash for db_hash, _ in found}
+            for db_hash in missing:
+                token = self.get_token(db_hash)
+                if token:
+                    found.append((db_hash, token))
+        return found
+
+    def add_views(self, counts):
+        if not self.previous:
+            for shard, shard_counts in self.group(counts, key=lambda item: item[0]):
+                shard.add_views(shard_counts)
+            return
+        # the spoiler may not have been moved yet, the update is a no-op on the shard that doesn't have it
+        by_shard = {}
+        for item in counts:
+            for shard in self.candidates(item[0]):
+                by_shard.setdefault(id(shard), (shard, []))[1].append(item)
+        for shard, shard_counts in by_shard.values():
+            shard.add_views(shard_counts)
+
+    def get_views(self, db_hash):
+        for shard in self.candidates(db_hash):
+            views = shard.get_views(db_hash)
+            if views is not None:
+                return views
+        return None
+
+    def delete_owner(self, owner, tenant, limit):
+        """Deletes up to limit spoilers of an owner from each shard, returns their hashes"""
+        return [
+            db_hash
+            for hashes in self.fan_out(lambda shard: shard.delete_owner(owner, tenant, limit))
+            for db_hash in hashes
+        ]
+
+    def has_owner(self, owner, tenant):
+        """Whether any shard still has a spoiler of owner"""
+        return any(self.fan_out(lambda shard: shard.has_owner(owner, tenant)))
+
+    def forget_owners(self, before, tenant):
+        return sum(self.fan_out(lambda shard: shard.forget_owners(before, tenant)))
+
+    def timestamps(self):
+        return [
+            timestamp
+            for timestamps in self.fan_out(lambda shard: shard.timestamps())
+            for timestamp in timestamps
+        ]
+
+    def ping(self):
+        self.fan_out(lambda shard: shard.ping())
+
+    def close(self):
+        for shard in self.all:
+            shard.close()
+        self.executor.shutdown()
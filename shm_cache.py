@@ -0,0 +1,181 @@
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import threading
+from contextlib import contextmanager
+
+import config
+from util import tenant_path
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'SPLRSHM1'
+# magic, slot count, slot size, clock hand
+HEADER = struct.Struct('<8sIII')
+HEADER_SIZE = 64
+# sequence number, reference bit, hash, token length (the token follows)
+SLOT = struct.Struct('<IB3x32sI')
+SEQUENCE = struct.Struct('<I')
+EMPTY_HASH = bytes(32)
+# the token length of an invalidated hash, its slot is kept so that the token can't be put back
+TOMBSTONE = 2**32 - 1
+# a hash can be stored in any of the PROBE slots following its home slot
+PROBE = 8
+# how many times a read is retried while the slot is being written to
+READ_RETRIES = 3
+
+
+def open_shared_cache(tenant):
+    """Returns the tenant's shared cache, or None if SHARED_CACHE_FILE isn't set"""
+    if not config.SHARED_CACHE_FILE:
+        return None
+    return SharedTokenCache(
+        tenant_path(config.SHARED_CACHE_FILE, tenant),
+        config.SHARED_CACHE_SLOTS, config.SHARED_CACHE_SLOT_SIZE
+    )
+
+
+class SharedTokenCache:
+    """
+    A fixed size hash table of spoiler tokens in a memory mapped file (ie in /dev/shm)
+    that every bot process on the host shares, keyed by the db_hash from split_uuid.
+
+    Reads don't take any lock: every slot has a sequence number that's odd while it's
+    being written, a reader retries (or misses) if it changed while it was copying.
+    Writes are serialized with flock between processes and a lock within one.
+    An invalidated hash keeps its slot as a tombstone until it's evicted, so that
+    another process that fetched the token before it was deleted can't put it back.
+    When all the slots a hash can go in are taken, one is evicted with the clock
+    algorithm: hits set a slot's reference bit, and the hand skips (and clears) those.
+    """
+    def __init__(self, path, slots, slot_size):
+        self.path = path
+        self.lock = threading.Lock()
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        with self.locked():
+            self.slots, self.slot_size = self.init_file(slots, slot_size)
+        self.stride = stride(self.slot_size)
+        self.map = mmap.mmap(self.fd, HEADER_SIZE + self.slots * self.stride)
+
+    def init_file(self, slots, slot_size):
+        """Lays out a new file, or returns the layout of the one the other processes use"""
+        header = os.pread(self.fd, HEADER.size, 0)
+        if len(header) == HEADER.size and header[:len(MAGIC)] == MAGIC:
+            _, file_slots, file_slot_size, _ = HEADER.unpack(header)
+            size = os.fstat(self.fd).st_size
+            if file_slots and size == HEADER_SIZE + file_slots * stride(file_slot_size):
+                if (file_slots, file_slot_size) != (slots, slot_size):
+                    logger.warning(
+                        f'{self.path} has {file_slots} slots of {file_slot_size} bytes, '
+                        f'using that instead of the configured {slots} of {slot_size}'
+                    )
+                return file_slots, file_slot_size
+            logger.warning(f'{self.path} is {size} bytes, which doesn\'t match its header, starting over')
+
+        os.ftruncate(self.fd, 0)
+        os.ftruncate(self.fd, HEADER_SIZE + slots * stride(slot_size))
+        os.pwrite(self.fd, HEADER.pack(MAGIC, slots, slot_size, 0), 0)
+        return slots, slot_size
+
+    @contextmanager
+    def locked(self):
+        with self.lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def probe(self, db_hash):
+        """The offsets of the slots db_hash can be stored in"""
+        home = int.from_bytes(db_hash[:8], 'little') % self.slots
+        return [
+            HEADER_SIZE + ((home + i) % self.slots) * self.stride
+            for i in range(min(PROBE, self.slots))
+        ]
+
+    def get(self, db_hash):
+        for offset in self.probe(db_hash):
+            for _ in range(READ_RETRIES):
+                sequence, _, slot_hash, length = SLOT.unpack_from(self.map, offset)
+                if sequence & 1:
+                    continue
+                if slot_hash != db_hash or length > self.slot_size:
+                    break
+                start = offset + SLOT.size
+                token = self.map[start:start + length]
+                if SEQUENCE.unpack_from(self.map, offset)[0] != sequence:
+                    continue
+                # a racy write, but losing a reference bit only makes an eviction a bit less fair
+                self.map[offset + 4] = 1
+                return token
+        return None
+
+    def put(self, db_hash, token):
+        """Caches a token, returns False if it's too large to fit in a slot or was invalidated"""
+        if len(token) > self.slot_size:
+            return False
+
+        with self.locked():
+            offsets = self.probe(db_hash)
+            slot = self.find(offsets, db_hash)
+            if slot is not None and SLOT.unpack_from(self.map, slot)[3] == TOMBSTONE:
+                return False
+            if slot is None:
+                slot = self.find(offsets, EMPTY_HASH)
+            if slot is None:
+                slot = self.evict(offsets)
+            self.write(slot, db_hash, token)
+        return True
+
+    def invalidate(self, db_hash):
+        with self.locked():
+            offsets = self.probe(db_hash)
+            slot = self.find(offsets, db_hash)
+            if slot is None:
+                # live tokens aren't evicted for it, purges invalidate a lot of hashes that weren't cached
+                slot = self.find(offsets, EMPTY_HASH)
+            if slot is not None:
+                self.write(slot, db_hash, b'', TOMBSTONE)
+
+    def find(self, offsets, db_hash):
+        """Returns the offset of the slot holding db_hash (call with the write lock held)"""
+        for offset in offsets:
+            if SLOT.unpack_from(self.map, offset)[2] == db_hash:
+                return offset
+        return None
+
+    def evict(self, offsets):
+        """Picks a slot to overwrite with the clock algorithm (call with the write lock held)"""
+        hand = HEADER.unpack_from(self.map, 0)[3]
+        while True:
+            offset = offsets[hand % len(offsets)]
+            hand += 1
+            if self.map[offset + 4]:
+                self.map[offset + 4] = 0
+            else:
+                HEADER.pack_into(self.map, 0, MAGIC, self.slots, self.slot_size, hand % 2**32)
+                return offset
+
+    def write(self, offset, db_hash, token, length=None):
+        """Replaces a slot's content (call with the write lock held)"""
+        if length is None:
+            length = len(token)
+        sequence = SEQUENCE.unpack_from(self.map, offset)[0]
+        SEQUENCE.pack_into(self.map, offset, (sequence + 1) % 2**32)
+        start = offset + SLOT.size
+        self.map[start:start + len(token)] = token
+        SLOT.pack_into(self.map, offset, (sequence + 1) % 2**32, 1, db_hash, length)
+        SEQUENCE.pack_into(self.map, offset, (sequence + 2) % 2**32)
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+
+def stride(slot_size):
+    """The space taken by a slot, they're aligned to cache lines"""
+    return -(-(SLOT.size + slot_size) // 64) * 64
+
@@ -1,163 +1,54 @@
+import time
+# taken before anything heavy is imported, see metrics.StartupTimer
+START_TIME = time.perf_counter()
+
 import logging
+import signal
+import threading
 from collections import defaultdict
 
-from telegram.ext import (
-    Updater, InlineQueryHandler, ChosenInlineResultHandler,
-    MessageHandler, CallbackQueryHandler, CommandHandler, Filters
-)
-
 from user import User
 from util import *
 from config import (
-    BOT_TOKEN, ADMIN_ID,
-    MINOR_SPOILER_CACHE_TIME, MAX_INLINE_LENGTH,
-    SPOILER_OWNER_FORGET_AFTER
+    TENANTS, ADMIN_ID, MAX_INLINE_LENGTH,
+    SPOILER_OWNER_FORGET_AFTER, HOT_SPOILERS_SNAPSHOT_INTERVAL, METRICS_HOST, METRICS_PORT,
+    SHUTDOWN_DRAIN_TIMEOUT, SPOOL_RETRY_INTERVAL, ENGINE, WORKERS, DEDUPE_WINDOW
 )
-from database import Database
-import handlers
+from common import (
+    databases, get_database, check_ban, query_split, get_inline_results, send_spoiler,
+    get_callback_answer, reply_done, cmd_cancel, cmd_clear, cmd_help, get_views_text, views_arg,
+    cmd_stats, cmd_profile, log_update, error, add_metric_collectors
+)
+from database import Connection, Database
+from dedupe import RecentUpdates
+from health import Health
+import live_stats
+import log
+import metrics
 import rate_limiter
 
-
-logger = logging.getLogger()
-logFormatter = logging.Formatter("%(asctime)s - %(levelname)-5.5s - %(message)s")
-logger.setLevel(logging.INFO)
-
-fileHandler = logging.FileHandler('bot.log')
-fileHandler.setFormatter(logFormatter)
-logger.addHandler(fileHandler)
-
-consoleHandler = logging.StreamHandler()
-consoleHandler.setFormatter(logFormatter)
-logger.addHandler(consoleHandler)
-
-
-# store image urls as variables so it's easier to understand what they are
-IMAGE_MINOR = 'https://i.imgur.com/qrViKOz.png'
-IMAGE_MAJOR = 'https://i.imgur.com/6oSoT16.png'
-
-
-def check_ban(try_inbox, pass_ban):
-    """
-    Performs actions if a user is banned
-    decorates a function where the first two parameters are bot, update
-
-    try_inbox: if True, and the user has a non-empty inbox, sends the inbox
-    pass_ban: if True and the user is banned,
-        function is called with a banned keyword argument,
-        otherwise function is called if the user is not banned
-    """
-    def _real(function):
-        def wrapped(bot, update, *args, **kwargs):
-            user_id = update.effective_user.id
-            if try_inbox:
-                rate_limiter.try_inbox(user_id, bot)
-
-            banned = database.is_user_banned(user_id)
-            if banned and not pass_ban:
-                return lambda: None
-            if pass_ban:
-                return function(bot, update, *args, **kwargs, banned=banned)
-            else:
-                return function(bot, update, *args, **kwargs)
-        return wrapped
-
-    return _real
-
-
-def query_split(query):
-    """Attempts to split a query into a tuple of (description, content)"""
-    temp_split = [split.strip() for split in query.split(':::', 1)]
-    if len(temp_split) >= 2 and temp_split[0] and temp_split[1]:
-        return temp_split[0], temp_split[1]
-    return '', query.strip()
-
-
-def get_inline_results(query):
-    old_uuid = None
-    content_type = 'Text'
-    content = ''
-    description = ''
-    if query.startswith('id:'):
-        uuid = query[3:].strip()
-        spoiler = database.get_spoiler(uuid)
-        if spoiler:
-            old_uuid = uuid
-            description = spoiler['description']
-            content = spoiler['content']
-            content_type = spoiler['type']
-        else:
-            content_type = 'Text (id not found)'
-
-    if not old_uuid:
-        description, content = query_split(query)
-    if not content:
-        return []
-
-    is_url = isinstance(content, str) and content.startswith('http')
-    if is_url:
-        def get_inline_keyboard(text):
-            return get_single_buttton_inline_keyboard('Show spoiler', url=content)
-        content_type = 'URL'
-    else:
-        def get_inline_keyboard(text):
-            return get_single_buttton_inline_keyboard(text, callback_data=uuid)
-
-    # modify the inline description and reply text of the result if a custom title has been set
-    if description and content:
-        description = f'<pre>{html_escape(description)}</pre>'
-        description_fmt = f'{content_type}, custom title, {{}}'
-        text_fmt = '<{0}>{1}:</{0}> {3}'
-    else:
-        description_fmt = f'{content_type}, {{}}'
-        text_fmt = '<{0}>{1}{2}</{0}>'
-        if content == 'yes':
-            text_fmt = '<{0}>Yes{2}</{0}>'
-            def get_inline_keyboard(text):
-                return get_single_buttton_inline_keyboard(
-                    'Yes yes' if 'Double' in text else 'Yes',
-                    callback_data=uuid
-                )
-            old_uuid = '0yes'
-
-    results = []
-    # add options to our results
-    uuid = get_uuid(is_major=True, ignore=is_url, old=old_uuid)
-    results.append(get_article(
-        title='Major Spoiler',
-        description=description_fmt.format('double tap'),
-        thumb_url=IMAGE_MAJOR,
-        text=text_fmt.format('b', 'Major Spoiler', '!', description),
-        uuid=uuid,
-        reply_markup=get_inline_keyboard('Double tap to show spoiler')
-    ))
-
-    uuid = get_uuid(is_major=False, ignore=is_url, old=old_uuid)
-    results.append(get_article(
-        title='Minor Spoiler',
-        description=description_fmt.format('single tap'),
-        thumb_url=IMAGE_MINOR,
-        text=text_fmt.format('i', 'Minor Spoiler', '', description),
-        uuid=uuid,
-        reply_markup=get_inline_keyboard('Show spoiler')
-    ))
-
-    return results
+logger = logging.getLogger(__name__)
 
 
+@metrics.instrument('on_inline')
 @check_ban(try_inbox=False, pass_ban=True)
 def on_inline(bot, update, banned):
+    database = get_database(bot)
     query = update.inline_query.query
+    database.count_event('inline')
 
     def get_text_and_results():
         if banned:
             return 'Banned! :(', []
         if len(query) >= MAX_INLINE_LENGTH:
             return 'Too long! Use an advanced spoiler!', []
-        return 'Advanced spoiler (media etc.)…', get_inline_results(query)
+        return 'Advanced spoiler (media etc.)…', get_inline_results(query, database)
 
     switch_pm_text, results = get_text_and_results()
 
-    update.inline_query.answer(
+    answer_inline_query(
+        bot,
+        update.inline_query.id,
         results,
         cache_time=1,
         is_personal=True,
@@ -166,6 +57,7 @@ def on_inline(bot, update, banned):
     )
 
 
+@metrics.instrument('on_inline_chosen')
 def on_inline_chosen(bot, update):
     """Stores the chosen inline result in the db, if necessary"""
     result = update.chosen_inline_result
@@ -177,19 +69,16 @@ def on_inline_chosen(bot, update):
 
     description, content = query_split(result.query)
 
-    log_update(update, f"created Text from inline")
-    database.insert_spoiler(uuid, 'Text', description, content, user_id)
+    database = get_database(bot)
+    if not database.insert_spoiler(uuid, 'Text', description, content, user_id):
+        # chosen twice (ie redelivered after a restart), it was counted the first time
+        return
+    log_update(update, 'create', 'Text', 'created Text from inline')
+    database.count_event('create', 'Text')
     rate_limiter.hit(user_id, database, bot)
 
 
-def send_spoiler(bot, user_id, spoiler):
-    getattr(handlers, spoiler['type']).send(
-        bot,
-        user_id,
-        content=spoiler['content']
-    )
-
-
+@metrics.instrument('on_callback_query')
 def on_callback_query(bot, update, users):
     uuid = update.callback_query.data
     from_id = update.callback_query.from_user.id
@@ -201,25 +90,19 @@ def on_callback_query(bot, update, users):
         )
         return
 
-    spoiler = database.get_spoiler(uuid)
+    database = get_database(bot)
+    spoiler = database.get_spoiler(uuid, count_view=True)
     if not spoiler:
         update.callback_query.answer(text='Spoiler not found. Too old?')
         return
     is_major = decode_uuid(uuid)['is_major']
 
-    log_update(update, f"requested {spoiler['type']} major={is_major}")
-
-    if spoiler['type'] == 'Text' and len(spoiler['content']) <= 200:
-        cache_time = 0 if is_major else MINOR_SPOILER_CACHE_TIME
-        update.callback_query.answer(
-            text=spoiler['content'],
-            show_alert=True,
-            cache_time=cache_time
-        )
-    else:
-        update.callback_query.answer(url=f't.me/{bot.username}?start={uuid}')
+    log_update(update, 'request', spoiler['type'], 'requested %s major=%s', spoiler['type'], is_major)
+    database.count_event('callback', spoiler['type'])
+    update.callback_query.answer(**get_callback_answer(bot, uuid, spoiler))
 
 
+@metrics.instrument('on_message')
 def on_message(bot, update, users):
     if not update.message:
         return
@@ -228,25 +111,23 @@ def on_message(bot, update, users):
     user = users[user_id]
     if user.handle_conversation(bot, update) == 'END':
         uuid = get_uuid()
+        database = get_database(bot)
 
-        log_update(update, f"created {user.spoiler_type}")
         database.insert_spoiler(
             uuid, user.spoiler_type, user.spoiler_description, user.spoiler_content,
             user_id
         )
+        # counted once it's stored, a failed insert raises
+        log_update(update, 'create', user.spoiler_type, 'created %s', user.spoiler_type)
+        database.count_event('create', user.spoiler_type)
 
         rate_limiter.hit(user_id, database, bot)
 
-        update.message.reply_text(
-            text='Done! Your advanced spoiler is ready.',
-            reply_markup=get_single_buttton_inline_keyboard(
-                'Send it',
-                switch_inline_query='id:'+uuid
-            )
-        )
+        reply_done(update, uuid)
         user.reset_state()
 
 
+@metrics.instrument('cmd_start')
 @check_ban(try_inbox=True, pass_ban=True)
 def cmd_start(bot, update, args, users, banned):
     user = users[update.message.from_user.id]
@@ -254,8 +135,10 @@ def cmd_start(bot, update, args, users, banned):
         args = ['']
 
     if args[0] != 'inline':
+        database = get_database(bot)
         spoiler = database.get_spoiler(args[0], increment_stats=False)
         if spoiler:
+            database.count_event('start', spoiler['type'])
             return send_spoiler(bot, update.message.from_user.id, spoiler)
 
     if banned:
@@ -264,26 +147,9 @@ def cmd_start(bot, update, args, users, banned):
 
 
 @check_ban(try_inbox=True, pass_ban=False)
-def cmd_cancel(bot, update, users):
-    users[update.message.from_user.id].handle_cancel(bot, update)
-
-
-@check_ban(try_inbox=True, pass_ban=False)
-def cmd_clear(bot, update):
-    update.message.reply_text(250 * '.\n')
-
-
-@check_ban(try_inbox=True, pass_ban=False)
-def cmd_help(bot, update):
-    update.message.reply_text(
-        text='Type /start to prepare an advanced spoiler with a custom title.\n\n'
-        'You can type quick spoilers by using @SpoileroBot in inline mode:\n'
-        '<pre>@SpoileroBot spoiler here…</pre>\n\n'
-        'Custom titles can also be used from inline mode as follows:\n'
-        '<pre>@SpoileroBot title for the spoiler:::contents of the spoiler</pre>\n'
-        'Note that the title will be immediately visible!',
-        parse_mode='HTML'
-    )
+def cmd_views(bot, update, args):
+    views = get_database(bot).get_views(views_arg(args)) if args else None
+    update.message.reply_text(get_views_text(args, views))
 
 
 def cmd_unban(bot, update, args):
@@ -292,33 +158,88 @@ def cmd_unban(bot, update, args):
     if not args:
         return
 
-    if database.remove_banned_user(args[0]):
+    if get_database(bot).remove_banned_user(args[0]):
         update.message.reply_text('Successfully unbanned user.')
     else:
         update.message.reply_text('Failed: user was not banned.')
 
 
-def log_update(update, msg):
-    logger.info(
-        f'{update.effective_user.username} ({update.effective_user.id}) {msg}'
-    )
+def forget_old_owners(database):
+    row_count = database.forget_old_owners(SPOILER_OWNER_FORGET_AFTER)
+    if row_count:
+        logger.info(f'forgot owners from {row_count} spoiler(s)')
 
 
-def error(bot, update, error):
-    logger.warning(f'Update "{update}" caused error "{error}"')
+def wait_for_stop_signal():
+    """Blocks until SIGINT, SIGTERM or SIGABRT is received"""
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+        signal.signal(signum, lambda signum, frame: stop.set())
+    while not stop.wait(1):
+        pass
 
 
-def job_forget_old_owners(bot, job):
-    row_count = database.forget_old_owners(SPOILER_OWNER_FORGET_AFTER)
-    if row_count:
-        logger.info(f'forgot owners from {row_count} spoiler(s)')
+def drain(updaters, connection, health):
+    """
+    Shuts down in order: stop fetching updates, let the queued ones finish
+    (for up to SHUTDOWN_DRAIN_TIMEOUT seconds), flush buffered state, then disconnect
+    """
+    logger.info('draining updates before shutting down')
+    health.draining = True
+    # Updater.stop() stops the job queue and the polling, then stops the dispatcher, which only
+    # exits once its queue is empty and the update it's handling is done. A batch the polling
+    # thread fetches after that isn't handled, but it wasn't confirmed to Telegram either
+    # so it's delivered again after a restart.
+    stopping = [threading.Thread(target=updater.stop, daemon=True) for updater in updaters]
+    for thread in stopping:
+        thread.start()
+    deadline = time.monotonic() + SHUTDOWN_DRAIN_TIMEOUT
+    for thread in stopping:
+        thread.join(max(0, deadline - time.monotonic()))
+    if any(thread.is_alive() for thread in stopping):
+        logger.warning(
+            f'gave up waiting on {get_queue_depth(updaters)} queued and '
+            f'{metrics.in_flight()} in-flight update(s)'
+        )
 
+    live_stats.STATS.flush(final=True)
+    for database in databases.values():
+        database.purger.wait(SHUTDOWN_DRAIN_TIMEOUT)
+        database.flush(final=True)
+        database.close()
+    connection.close()
+    logger.info('shut down cleanly')
+    log.stop()
+
+
+def get_queue_depth(updaters):
+    return sum(updater.dispatcher.update_queue.qsize() for updater in updaters)
+
+
+def drop_duplicate(bot, update, recent_updates):
+    """Stops redelivered updates before any other handler sees them"""
+    if recent_updates.seen(update.update_id):
+        from telegram.ext import DispatcherHandlerStop
+
+        get_database(bot).count_event('duplicate')
+        raise DispatcherHandlerStop()
+
+
+def add_handlers(dp):
+    # telegram is imported once the bot starts, so that importing this module stays cheap
+    from telegram import Update
+    from telegram.ext import (
+        InlineQueryHandler, ChosenInlineResultHandler, MessageHandler, CallbackQueryHandler,
+        CommandHandler, TypeHandler, Filters
+    )
 
-def main():
     users = defaultdict(User)
-    updater = Updater(BOT_TOKEN)
+    recent_updates = RecentUpdates(DEDUPE_WINDOW)
 
-    dp = updater.dispatcher
+    # group -1 runs before the handlers below
+    dp.add_handler(TypeHandler(
+        Update, lambda bot, update: drop_duplicate(bot, update, recent_updates)
+    ), group=-1)
 
     dp.add_handler(InlineQueryHandler(on_inline))
     dp.add_handler(ChosenInlineResultHandler(on_inline_chosen))
@@ -337,7 +258,10 @@ def main():
     ))
     dp.add_handler(CommandHandler('clear', cmd_clear))
     dp.add_handler(CommandHandler('help', cmd_help))
+    dp.add_handler(CommandHandler('views', cmd_views, pass_args=True))
     dp.add_handler(CommandHandler('unban', cmd_unban, pass_args=True))
+    dp.add_handler(CommandHandler('profile', cmd_profile, pass_args=True))
+    dp.add_handler(CommandHandler('stats', cmd_stats))
 
     dp.add_handler(MessageHandler(
         Filters.all,
@@ -346,17 +270,85 @@ def main():
 
     dp.add_error_handler(error)
 
-    j = updater.job_queue
+
+def add_jobs(j, database):
+    # nothing here is needed to answer the first updates, so the jobs are
+    # added once polling started and the first runs are pushed back a bit
+    j.run_once(lambda bot, job: database.warm_up_hot_spoilers(), 0)
     j.run_repeating(
         lambda bot, job: database.store_request_count(),
-        interval=5, first=0
+        interval=5, first=5
+    )
+    j.run_repeating(
+        lambda bot, job: database.store_view_counts(),
+        interval=5, first=5
+    )
+    j.run_repeating(
+        lambda bot, job: forget_old_owners(database),
+        interval=60, first=60
+    )
+    j.run_repeating(
+        lambda bot, job: database.replay_spool(),
+        interval=SPOOL_RETRY_INTERVAL, first=SPOOL_RETRY_INTERVAL
+    )
+    j.run_repeating(
+        lambda bot, job: database.hot_spoilers.update(),
+        interval=5, first=5
+    )
+    j.run_repeating(
+        lambda bot, job: database.hot_spoilers.snapshot(),
+        interval=HOT_SPOILERS_SNAPSHOT_INTERVAL, first=HOT_SPOILERS_SNAPSHOT_INTERVAL
     )
-    j.run_repeating(job_forget_old_owners, interval=60, first=0)
 
-    updater.start_polling()
-    updater.idle()
+
+def main():
+    from telegram.ext import Updater
+    import bot_api
+
+    log.setup()
+    startup = metrics.StartupTimer(START_TIME)
+    startup.mark('imports')
+
+    # every tenant gets its own updater, they share the connection, the jobs and the metrics
+    # (the library calls handlers with the bot of the dispatcher they were added to, and an
+    # updater always makes its own dispatcher and job queue, so those can't be shared)
+    connection = Connection()
+    startup.mark('connect')
+    updaters = []
+    for tenant in TENANTS:
+        updater = Updater(bot=bot_api.make_bot(tenant['token']), workers=WORKERS)
+        database = Database(tenant['name'], tenant['pepper'], connection)
+        database.start()
+        databases[tenant['token']] = database
+
+        add_handlers(updater.dispatcher)
+        updaters.append(updater)
+    startup.mark('tenants')
+
+    add_metric_collectors(lambda: get_queue_depth(updaters))
+    health = Health(database.ping, lambda: get_queue_depth(updaters))
+    health.register()
+    metrics.serve(METRICS_HOST, METRICS_PORT)
+    startup.mark('metrics')
+
+    for updater in updaters:
+        updater.start_polling()
+    # the jobs of every tenant run on the first tenant's job queue
+    for database in databases.values():
+        add_jobs(updaters[0].job_queue, database)
+    # the live stats are shared by the tenants, collecting them twice in a row would lose counts
+    updaters[0].job_queue.run_repeating(lambda bot, job: live_stats.STATS.flush(), interval=5, first=5)
+    startup.mark('polling')
+    startup.report()
+
+    wait_for_stop_signal()
+    drain(updaters, connection, health)
 
 
 if __name__ == '__main__':
-    database = Database()
-    main()
+    if ENGINE == 'asyncio':
+        import aio
+        aio.run(START_TIME)
+    else:
+        main()
+
@@ -0,0 +1,163 @@
+import base64
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def to_rows(batch):
+    """Converts a batch to (hash, timestamp, token, owner) rows for spoilers_v2"""
+    return [(db_hash, timestamp, token, owner) for db_hash, (token, owner, timestamp) in batch]
+
+
+def encode_entry(db_hash, entry):
+    token, owner, timestamp = entry
+    return {
+        'hash': base64.b64encode(db_hash).decode(),
+        'token': token.decode(),
+        'owner': owner,
+        'timestamp': timestamp,
+    }
+
+
+class Spool:
+    """
+    An append-only file of spoilers that couldn't be written to the database
+    The spooled tokens are also kept in memory, so they can be looked up until
+    they've been replayed into the database.
+
+    Appends are made durable with group commit: a writer only returns once its
+    line was fsynced, but a single fsync covers every line written before it,
+    so concurrent writers share them instead of queueing for one each.
+    Deleted entries (ie from banned users) are written as tombstones.
+    """
+    def __init__(self, path):
+        self.path = path
+        # hash -> (token, owner, timestamp)
+        self.entries = {}
+        self.lock = threading.Lock()
+        # held while syncing, taken before self.lock
+        self.sync_lock = threading.Lock()
+        self.written = 0
+        self.synced = 0
+        # entries forgotten since the file was last rewritten
+        self.forgotten = 0
+        damaged = self.load()
+        self.file = open(self.path, 'a')
+        if damaged:
+            # appending after a torn line would glue the next entry onto it
+            self.rewrite()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def load(self):
+        """Reads the spooled entries, returns True if the file has a corrupt line"""
+        damaged = False
+        if not os.path.exists(self.path):
+            return damaged
+
+        with open(self.path) as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    # the last line may be torn if we crashed while writing it
+                    damaged = True
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    logger.warning(f'skipping a corrupt line in {self.path}')
+                    damaged = True
+                    continue
+
+                db_hash = base64.b64decode(entry['hash'])
+                if entry.get('deleted'):
+                    self.entries.pop(db_hash, None)
+                else:
+                    self.entries[db_hash] = (entry['token'].encode(), entry['owner'], entry['timestamp'])
+
+        if self.entries:
+            logger.info(f'{len(self.entries)} spoiler(s) waiting in the spool to be replayed')
+        return damaged
+
+    def write(self, entry):
+        """Appends a line, returns its sequence number (call with self.lock held)"""
+        self.file.write(json.dumps(entry) + '\n')
+        self.written += 1
+        return self.written
+
+    def sync(self, sequence):
+        """Returns once every line up to sequence is on disk"""
+        with self.sync_lock:
+            if self.synced >= sequence:
+                # another writer's fsync already covered it
+                return
+            with self.lock:
+                self.file.flush()
+                target = self.written
+            os.fsync(self.file.fileno())
+            self.synced = target
+
+    def append(self, db_hash, token, owner, timestamp):
+        with self.lock:
+            self.entries[db_hash] = (token, owner, timestamp)
+            sequence = self.write(encode_entry(db_hash, (token, owner, timestamp)))
+        self.sync(sequence)
+
+    def get_token(self, db_hash):
+        entry = self.entries.get(db_hash)
+        return entry[0] if entry else None
+
+    def remove_owner(self, owner):
+        """Deletes every spooled spoiler of an owner, returns how many there were"""
+        with self.lock:
+            hashes = [db_hash for db_hash, entry in self.entries.items() if entry[1] == owner]
+            sequence = self.written
+            for db_hash in hashes:
+                del self.entries[db_hash]
+                sequence = self.write({'hash': base64.b64encode(db_hash).decode(), 'deleted': True})
+        if hashes:
+            self.sync(sequence)
+        return len(hashes)
+
+    def take(self, batch_size):
+        """Returns up to batch_size spooled spoilers to be replayed"""
+        with self.lock:
+            return list(self.entries.items())[:batch_size]
+
+    def forget(self, batch):
+        """
+        Forgets a batch once it was replayed, it's only dropped from the file by compact()
+        (until then a restart replays it again, which inserts nothing new)
+        """
+        with self.lock:
+            for db_hash, entry in batch:
+                # it may have been deleted (or spooled again) in the meantime
+                if self.entries.get(db_hash) == entry:
+                    del self.entries[db_hash]
+                    self.forgotten += 1
+
+    def compact(self):
+        """Rewrites the file with what's left, if anything was forgotten since the last time"""
+        with self.sync_lock, self.lock:
+            if self.forgotten:
+                self.rewrite()
+                self.forgotten = 0
+
+    def rewrite(self):
+        """Replaces the file with only the current entries (call with both locks held)"""
+        self.file.close()
+        with open(self.path + '.tmp', 'w') as f:
+            for db_hash, entry in self.entries.items():
+                f.write(json.dumps(encode_entry(db_hash, entry)) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.path + '.tmp', self.path)
+
+        self.file = open(self.path, 'a')
+        self.synced = self.written
+
+    def close(self):
+        with self.sync_lock, self.lock:
+            self.file.close()
@@ -9,13 +9,14 @@ import matplotlib.dates as md
 import telegram
 
 from database import Database
-from config import BOT_TOKEN, REQUEST_COUNT_RESOLUTION
+from config import TENANTS, REQUEST_COUNT_RESOLUTION
 from util import timestamp_floor
 
 DESTINATION_CHAT = os.environ['spoilero_stats_destination']
 
 
-db_cursor = Database().get_cursor()
+database = Database()
+db_cursor = database.get_cursor()
 CURRENT_TIMESTAMP = timestamp_floor(24*3600)
 CUTOFF_TIMESTAMP = CURRENT_TIMESTAMP - 24*3600*5
 YESTERDAY_TIMESTAMP = CURRENT_TIMESTAMP - 24*3600
@@ -35,7 +36,11 @@ ax1.set_xlabel('Time (UTC)')
 
 # fetch data
 db_cursor.execute(
-    'SELECT timestamp, count FROM requests WHERE timestamp >= %s AND timestamp < %s',
+    '''
+    SELECT timestamp, SUM(count) AS count FROM requests
+    WHERE event = 'request' AND timestamp >= %s AND timestamp < %s
+    GROUP BY timestamp
+    ''',
     (CUTOFF_TIMESTAMP, CURRENT_TIMESTAMP)
 )
 requests = db_cursor.fetchall()
@@ -56,10 +61,10 @@ ax1.tick_params('y', colors='xkcd:bright blue')
 
 
 # fetch data
-db_cursor.execute('''
-    (SELECT timestamp FROM spoilers) UNION ALL (SELECT timestamp FROM spoilers_v2)
-''')
-spoilers = sorted(spoiler['timestamp'] for spoiler in db_cursor.fetchall() if spoiler['timestamp'] < CURRENT_TIMESTAMP)
+db_cursor.execute('SELECT timestamp FROM spoilers')
+# spoilers_v2 may be split across shards
+timestamps = [spoiler['timestamp'] for spoiler in db_cursor.fetchall()] + database.shards.timestamps()
+spoilers = sorted(timestamp for timestamp in timestamps if timestamp < CURRENT_TIMESTAMP)
 total_spoilers = len(spoilers)
 
 # process data
@@ -92,7 +97,8 @@ caption = (
 )
 print(caption)
 
-bot = telegram.Bot(BOT_TOKEN)
+# sent by the first tenant's bot
+bot = telegram.Bot(TENANTS[0]['token'])
 bot.send_photo(
     chat_id=DESTINATION_CHAT,
     photo=open('stats.png', 'rb'),
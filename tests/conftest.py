@@ -0,0 +1,11 @@
+import os
+import sys
+
+# the modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# config reads these when it's imported, the tests never connect to anything
+os.environ.setdefault('tg_bot_spoilero', 'test')
+os.environ.setdefault('tg_bot_spoilero_admin', '1')
+os.environ.setdefault('tg_bot_spoilero_db_pwd', 'test')
+os.environ.setdefault('tg_spoilero_pepper', 'test')
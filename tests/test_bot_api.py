@@ -0,0 +1,66 @@
+import pytest
+
+pytest.importorskip('telegram')
+
+from telegram.error import BadRequest, TimedOut
+
+import bot_api
+from bot_api import CircuitBreaker, CircuitOpen, observe
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(bot_api.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def fail(breaker, error=TimedOut):
+    with pytest.raises(error):
+        with observe('sendMessage', breaker):
+            raise error('failed')
+
+
+def test_opens_after_failures_in_a_row(clock):
+    breaker = CircuitBreaker(failures=3, reset_timeout=10)
+    fail(breaker)
+    fail(breaker)
+    with observe('sendMessage', breaker):
+        pass
+    fail(breaker)
+    fail(breaker)
+    assert not breaker.is_open
+    fail(breaker)
+    assert breaker.is_open
+    with pytest.raises(CircuitOpen):
+        breaker.check('sendMessage')
+
+
+def test_answers_are_not_failures(clock):
+    breaker = CircuitBreaker(failures=1, reset_timeout=10)
+    fail(breaker, BadRequest)
+    assert not breaker.is_open
+
+
+def test_lets_a_single_probe_through_after_the_timeout(clock):
+    breaker = CircuitBreaker(failures=1, reset_timeout=10)
+    fail(breaker)
+    clock[0] += 10
+    breaker.check('sendMessage')
+    # the probe is still in progress
+    with pytest.raises(CircuitOpen):
+        breaker.check('sendMessage')
+    breaker.record(True)
+    assert not breaker.is_open
+    breaker.check('sendMessage')
+
+
+def test_a_failed_probe_keeps_it_open(clock):
+    breaker = CircuitBreaker(failures=1, reset_timeout=10)
+    fail(breaker)
+    clock[0] += 10
+    fail(breaker)
+    assert breaker.is_open
+    clock[0] += 5
+    with pytest.raises(CircuitOpen):
+        breaker.check('sendMessage')
@@ -0,0 +1,46 @@
+import threading
+
+from counters import StripedCounter
+
+
+def test_collect_sums_every_thread():
+    counter = StripedCounter()
+
+    def work():
+        for _ in range(1000):
+            counter.incr(('request', 'Text'))
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert counter.collect(final=True) == {('request', 'Text'): 4000}
+    assert counter.collect(final=True) == {}
+
+
+def test_swapped_stripes_are_counted_on_the_next_collect():
+    counter = StripedCounter()
+    counter.incr('a')
+    counter.incr('a', 2)
+    assert counter.collect() == {}
+    counter.incr('b')
+    assert counter.collect() == {'a': 3}
+    assert counter.collect() == {'b': 1}
+
+
+def test_totals():
+    counter = StripedCounter(keep_totals=True)
+    counter.incr('a')
+    counter.collect(final=True)
+    counter.incr('a')
+    counter.incr('b', 5)
+    counter.collect(final=True)
+
+    totals = counter.get_totals()
+    assert totals == {'a': 2, 'b': 5}
+    # a copy, which the next collect doesn't change
+    counter.incr('a')
+    counter.collect(final=True)
+    assert totals == {'a': 2, 'b': 5}
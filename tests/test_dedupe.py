@@ -0,0 +1,37 @@
+import threading
+
+from dedupe import RecentUpdates
+
+
+def test_drops_updates_seen_twice():
+    recent = RecentUpdates(3)
+    assert not recent.seen(1)
+    assert not recent.seen(2)
+    assert recent.seen(1)
+    assert recent.seen(2)
+
+
+def test_forgets_the_oldest_ids():
+    recent = RecentUpdates(3)
+    for update_id in (1, 2, 3, 4):
+        assert not recent.seen(update_id)
+    assert not recent.seen(1)
+    assert recent.seen(4)
+    assert recent.ids == set(recent.order) == {3, 4, 1}
+
+
+def test_each_id_is_new_to_a_single_thread():
+    recent = RecentUpdates(1000)
+    new = []
+
+    def worker():
+        for update_id in range(500):
+            if not recent.seen(update_id):
+                new.append(update_id)
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(new) == list(range(500))
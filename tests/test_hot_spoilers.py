@@ -0,0 +1,98 @@
+import random
+
+from hot_spoilers import HotSpoilers, SpaceSaving
+
+
+def test_counts_exactly_below_capacity():
+    tracker = SpaceSaving(10)
+    for key, count in (('a', 5), ('b', 3), ('c', 1)):
+        for _ in range(count):
+            tracker.add(key)
+    assert tracker.counts == {'a': 5, 'b': 3, 'c': 1}
+    assert tracker.top(2) == ['a', 'b']
+
+
+def test_new_key_replaces_the_least_counted():
+    tracker = SpaceSaving(2)
+    tracker.add('a', 5)
+    tracker.add('b', 2)
+    tracker.add('a')
+    tracker.add('c')
+    # b was the least counted, c inherits its count
+    assert tracker.counts == {'a': 6, 'c': 3}
+    tracker.add('d')
+    assert tracker.counts == {'a': 6, 'd': 4}
+
+
+def test_finds_heavy_hitters():
+    random.seed(1)
+    tracker = SpaceSaving(50)
+    hot = [f'hot{i}' for i in range(5)]
+    for _ in range(20000):
+        if random.random() < 0.5:
+            tracker.add(random.choice(hot))
+        else:
+            tracker.add(f'cold{random.randrange(10000)}')
+    assert set(tracker.top(5)) == set(hot)
+    assert len(tracker.counts) == len(tracker.heap) == 50
+
+
+def test_evicts_the_minimum():
+    random.seed(2)
+    tracker = SpaceSaving(20)
+    for _ in range(5000):
+        key = random.randrange(60)
+        if key not in tracker.counts and len(tracker.counts) == 20:
+            smallest = min(tracker.counts.values())
+            before = dict(tracker.counts)
+            tracker.add(key)
+            evicted, = before.keys() - tracker.counts.keys()
+            assert before[evicted] == smallest
+            assert tracker.counts[key] == smallest + 1
+        else:
+            tracker.add(key)
+        assert len(tracker.counts) == len(tracker.heap) <= 20
+
+
+def test_decay():
+    tracker = SpaceSaving(10)
+    tracker.add('a', 4)
+    tracker.add('b', 1)
+    tracker.decay()
+    assert tracker.counts == {'a': 2}
+    tracker.add('c')
+    tracker.add('c')
+    assert tracker.counts == {'a': 2, 'c': 2}
+
+
+def test_hot_spoilers_caches_only_hot_tokens(tmp_path):
+    hot_spoilers = HotSpoilers(tracked=10, cached=1, snapshot_file=str(tmp_path / 'hot.txt'))
+    assert hot_spoilers.load_snapshot() == []
+    for db_hash in (b'a', b'a', b'b'):
+        hot_spoilers.record(db_hash)
+    hot_spoilers.update()
+    hot_spoilers.offer_token(b'a', b'token a', hot_spoilers.generation)
+    hot_spoilers.offer_token(b'b', b'token b', hot_spoilers.generation)
+    assert hot_spoilers.get_token(b'a') == b'token a'
+    assert hot_spoilers.get_token(b'b') is None
+
+    hot_spoilers.snapshot()
+    assert hot_spoilers.load_snapshot() == [b'a']
+
+
+def test_snapshot_waits_for_the_previous_one_to_be_loaded(tmp_path):
+    snapshot_file = tmp_path / 'hot.txt'
+    snapshot_file.write_text(b'a'.hex() + '\n')
+    hot_spoilers = HotSpoilers(tracked=10, cached=1, snapshot_file=str(snapshot_file))
+    hot_spoilers.snapshot()
+    assert hot_spoilers.load_snapshot() == [b'a']
+
+
+def test_tokens_fetched_before_an_invalidate_are_not_cached(tmp_path):
+    hot_spoilers = HotSpoilers(tracked=10, cached=1, snapshot_file=str(tmp_path / 'hot.txt'))
+    hot_spoilers.record(b'a')
+    hot_spoilers.update()
+    generation = hot_spoilers.generation
+    hot_spoilers.invalidate(b'a')
+    hot_spoilers.offer_token(b'a', b'token a', generation)
+    assert hot_spoilers.get_token(b'a') is None
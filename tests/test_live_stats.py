@@ -0,0 +1,65 @@
+import live_stats
+from live_stats import LATENCY_BUCKETS, RollingStats, percentile
+
+
+def set_minute(monkeypatch, minute):
+    monkeypatch.setattr(live_stats.time, 'time', lambda: minute * 60 + 30)
+
+
+def test_percentile_is_the_bucket_upper_bound():
+    latencies = [0] * (len(LATENCY_BUCKETS) + 1)
+    latencies[0] = 50
+    latencies[3] = 49
+    latencies[-1] = 1
+    assert percentile(latencies, 0.5) == LATENCY_BUCKETS[0]
+    assert percentile(latencies, 0.99) == LATENCY_BUCKETS[3]
+    assert percentile(latencies, 1) == float('inf')
+    assert percentile([0] * len(latencies), 0.5) is None
+
+
+def test_latencies_go_in_the_first_bucket_they_fit(monkeypatch):
+    set_minute(monkeypatch, 100)
+    stats = RollingStats(minutes=10)
+    stats.observe_latency(LATENCY_BUCKETS[2])
+    stats.observe_latency(LATENCY_BUCKETS[2] + 1e-9)
+    stats.observe_latency(LATENCY_BUCKETS[-1] * 2)
+    stats.flush(final=True)
+    _, latencies = stats.summarize(1)
+    assert latencies[2] == 1
+    assert latencies[3] == 1
+    assert latencies[-1] == 1
+
+
+def test_counts_keep_the_minute_they_happened_in(monkeypatch):
+    set_minute(monkeypatch, 100)
+    stats = RollingStats(minutes=10)
+    stats.count('request')
+    # flushed a few minutes later
+    set_minute(monkeypatch, 103)
+    stats.count('request')
+    stats.flush(final=True)
+    assert stats.summarize(1)[0] == {('request', ''): 1}
+    assert stats.summarize(4)[0] == {('request', ''): 2}
+
+
+def test_flushes_lag_one_collect_behind(monkeypatch):
+    set_minute(monkeypatch, 100)
+    stats = RollingStats(minutes=10)
+    stats.count('create', 'Text')
+    stats.flush()
+    assert stats.summarize(1)[0] == {}
+    stats.flush()
+    assert stats.summarize(1)[0] == {('create', 'Text'): 1}
+
+
+def test_slots_are_reused_as_a_ring(monkeypatch):
+    set_minute(monkeypatch, 100)
+    stats = RollingStats(minutes=10)
+    stats.count('request')
+    stats.flush(final=True)
+    set_minute(monkeypatch, 110)
+    stats.count('ban')
+    # a minute older than the ring is dropped instead of clearing a newer one
+    stats.pending_counts.incr((100, 'request', ''))
+    stats.flush(final=True)
+    assert stats.summarize(10)[0] == {('ban', ''): 1}
@@ -0,0 +1,109 @@
+import os
+
+import pytest
+
+from rebalance import rebalance
+from shards import ShardMap, SqliteShard, shard_index
+
+
+def make_hash(prefix):
+    return prefix.to_bytes(2, 'big') + os.urandom(30)
+
+
+def make_row(db_hash, owner=1, tenant=''):
+    return (db_hash, 1600000000, b'token ' + db_hash[:4], owner, tenant, 0)
+
+
+@pytest.fixture
+def open_shards(tmp_path):
+    opened = []
+
+    def open_shards(count, name):
+        shards = [SqliteShard(str(tmp_path / f'{name}{i}.sqlite')) for i in range(count)]
+        opened.extend(shards)
+        return shards
+
+    yield open_shards
+    for shard in opened:
+        shard.close()
+
+
+def test_shard_index_boundaries():
+    assert shard_index(b'\x00\x00', 3) == 0
+    assert shard_index((65536 // 3).to_bytes(2, 'big'), 3) == 0
+    assert shard_index((65536 // 3 + 1).to_bytes(2, 'big'), 3) == 1
+    assert shard_index(b'\xff\xff', 3) == 2
+    assert all(shard_index(b'\xff\xff', count) == count - 1 for count in range(1, 10))
+
+
+def test_candidates_fall_back_to_the_previous_layout(open_shards):
+    old = open_shards(1, 'old')
+    new = open_shards(2, 'new')
+    low, high = make_hash(0), make_hash(0xffff)
+    shard_map = ShardMap(new, old)
+    assert shard_map.candidates(low) == [new[0], old[0]]
+    assert shard_map.candidates(high) == [new[1], old[0]]
+
+    # not moved yet, found on the previous shard
+    old[0].insert_many([make_row(high)])
+    assert shard_map.get_token(high) == b'token ' + high[:4]
+    assert shard_map.get_tokens([low, high]) == [(high, b'token ' + high[:4])]
+    shard_map.add_views([(high, 3)])
+    assert shard_map.get_views(high) == 3
+    # delivered again before it was moved
+    assert not shard_map.insert(make_row(high)[:5])
+    assert not new[1].get_token(high)
+    assert shard_map.insert(make_row(low)[:5])
+    assert not shard_map.insert(make_row(low)[:5])
+    shard_map.close()
+
+
+def test_the_same_shard_is_not_a_fallback(open_shards):
+    shards = open_shards(2, 'shard')
+    shard_map = ShardMap(shards, shards[:1])
+    assert shard_map.candidates(make_hash(0)) == [shards[0]]
+    shard_map.close()
+
+
+def test_delete_owner_fans_out(open_shards):
+    shards = open_shards(3, 'shard')
+    shard_map = ShardMap(shards)
+    rows = [make_row(make_hash(prefix), owner=i % 2) for i, prefix in enumerate(range(0, 65536, 4096))]
+    shard_map.insert_many(rows)
+    assert all(shard.has_owner(1, '') for shard in shards)
+
+    deleted = shard_map.delete_owner(1, '', limit=1000)
+    assert sorted(deleted) == sorted(row[0] for row in rows if row[3] == 1)
+    assert not shard_map.has_owner(1, '')
+    # other tenants and owners are left alone
+    assert shard_map.has_owner(0, '')
+    shard_map.close()
+
+
+def test_rebalance_through_growing_layouts(open_shards):
+    rows = [make_row(make_hash(prefix)) for prefix in range(0, 65536, 512)]
+    first = open_shards(1, 'a')
+    ShardMap(first).insert_many(rows)
+
+    previous = first
+    for count, name in ((2, 'b'), (3, 'c')):
+        # the shard at the start of the hash range stays in the layout
+        current = previous[:1] + open_shards(count - 1, name)
+        shard_map = ShardMap(current, previous)
+        rebalance(shard_map, batch_size=10, pause=0, get_banned=lambda rows: set())
+        for row in rows:
+            assert [shard for shard in current if shard.get_token(row[0])] == [shard_map.for_hash(row[0])]
+        previous = current
+    assert sum(len(shard.scan(b'', 1000)) for shard in previous) == len(rows)
+
+
+def test_rebalance_drops_banned_owners_copied_meanwhile(open_shards):
+    old = open_shards(1, 'old')
+    new = old + open_shards(1, 'new')
+    banned, kept = make_row(make_hash(0xffff), owner=7), make_row(make_hash(0xfffe), owner=8)
+    old[0].insert_many([banned, kept])
+    shard_map = ShardMap(new, old)
+    rebalance(shard_map, batch_size=10, pause=0, get_banned=lambda rows: {('', 7)})
+    assert shard_map.get_token(banned[0]) is None
+    assert new[1].scan(b'', 10) == [kept]
+    shard_map.close()
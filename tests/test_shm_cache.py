@@ -0,0 +1,50 @@
+import os
+
+from shm_cache import HEADER_SIZE, SharedTokenCache
+
+
+def make_hash(i):
+    return i.to_bytes(8, 'little') + bytes(24)
+
+
+def test_processes_share_tokens(tmp_path):
+    path = str(tmp_path / 'cache')
+    first = SharedTokenCache(path, 64, 32)
+    second = SharedTokenCache(path, 128, 16)
+    assert (second.slots, second.slot_size) == (64, 32)
+    assert first.put(make_hash(1), b'token')
+    assert second.get(make_hash(1)) == b'token'
+    assert not first.put(make_hash(2), bytes(33))
+    first.close()
+    second.close()
+
+
+def test_invalidated_tokens_cannot_be_put_back(tmp_path):
+    cache = SharedTokenCache(str(tmp_path / 'cache'), 64, 32)
+    cache.put(make_hash(1), b'token')
+    cache.invalidate(make_hash(1))
+    assert cache.get(make_hash(1)) is None
+    assert not cache.put(make_hash(1), b'token')
+    assert cache.get(make_hash(1)) is None
+    cache.close()
+
+
+def test_eviction_keeps_the_probe_window_full(tmp_path):
+    cache = SharedTokenCache(str(tmp_path / 'cache'), 8, 32)
+    for i in range(20):
+        cache.put(make_hash(i), b'token %d' % i)
+    cached = [i for i in range(20) if cache.get(make_hash(i))]
+    assert len(cached) == 8
+    assert 19 in cached
+    cache.close()
+
+
+def test_truncated_files_are_laid_out_again(tmp_path):
+    path = str(tmp_path / 'cache')
+    SharedTokenCache(path, 64, 32).close()
+    os.truncate(path, HEADER_SIZE + 10)
+    cache = SharedTokenCache(path, 16, 32)
+    assert cache.slots == 16
+    assert cache.put(make_hash(1), b'token')
+    assert cache.get(make_hash(1)) == b'token'
+    cache.close()
@@ -0,0 +1,107 @@
+import threading
+
+from spool import Spool, to_rows
+
+
+def test_reload(tmp_path):
+    path = str(tmp_path / 'spool.jsonl')
+    spool = Spool(path)
+    spool.append(b'a' * 32, b'token a', 1, 100)
+    spool.append(b'b' * 32, b'token b', 2, 101)
+    spool.close()
+
+    spool = Spool(path)
+    assert len(spool) == 2
+    assert spool.get_token(b'a' * 32) == b'token a'
+    assert to_rows(spool.take(1)) == [(b'a' * 32, 100, b'token a', 1)]
+
+
+def test_remove_owner_writes_tombstones(tmp_path):
+    path = str(tmp_path / 'spool.jsonl')
+    spool = Spool(path)
+    spool.append(b'a' * 32, b'token a', 1, 100)
+    spool.append(b'b' * 32, b'token b', 2, 101)
+    spool.append(b'c' * 32, b'token c', 1, 102)
+    assert spool.remove_owner(1) == 2
+    spool.close()
+
+    spool = Spool(path)
+    assert len(spool) == 1
+    assert spool.get_token(b'a' * 32) is None
+
+
+def test_forget_and_compact(tmp_path):
+    path = str(tmp_path / 'spool.jsonl')
+    spool = Spool(path)
+    for i in range(10):
+        spool.append(bytes([i]) * 32, b'token', i, 100 + i)
+
+    batch = spool.take(4)
+    # spooled again with another token while the batch was being replayed
+    spool.append(bytes([0]) * 32, b'newer token', 0, 200)
+    spool.forget(batch)
+    assert len(spool) == 7
+    assert spool.get_token(bytes([0]) * 32) == b'newer token'
+
+    # the file only shrinks once it's compacted
+    with open(path) as f:
+        assert len(f.readlines()) == 11
+    spool.compact()
+    with open(path) as f:
+        assert len(f.readlines()) == 7
+
+    spool.append(b'x' * 32, b'token x', 1, 300)
+    spool.close()
+    assert len(Spool(path)) == 8
+
+
+def test_concurrent_appends(tmp_path):
+    path = str(tmp_path / 'spool.jsonl')
+    spool = Spool(path)
+
+    def work(thread):
+        for i in range(50):
+            spool.append(bytes([thread, i]) * 16, b'token', thread, i)
+
+    threads = [threading.Thread(target=work, args=(thread,)) for thread in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert spool.synced == spool.written == 200
+    spool.close()
+    assert len(Spool(path)) == 200
+
+
+def test_skips_a_torn_line(tmp_path):
+    path = str(tmp_path / 'spool.jsonl')
+    spool = Spool(path)
+    spool.append(b'a' * 32, b'token a', 1, 100)
+    spool.close()
+    with open(path, 'a') as f:
+        f.write('{"hash": "tor')
+
+    spool = Spool(path)
+    assert len(spool) == 1
+    spool.append(b'b' * 32, b'token b', 2, 101)
+    spool.close()
+
+    spool = Spool(path)
+    assert len(spool) == 2
+    assert spool.get_token(b'b' * 32) == b'token b'
+
+
+def test_an_entry_missing_its_newline_is_kept(tmp_path):
+    path = str(tmp_path / 'spool.jsonl')
+    spool = Spool(path)
+    spool.append(b'a' * 32, b'token a', 1, 100)
+    spool.close()
+    with open(path) as f:
+        content = f.read()
+    with open(path, 'w') as f:
+        f.write(content.rstrip('\n'))
+
+    spool = Spool(path)
+    spool.append(b'b' * 32, b'token b', 2, 101)
+    spool.close()
+    assert len(Spool(path)) == 2
@@ -0,0 +1,42 @@
+from transfer import chunk_file, exported_ranges, get_chunks
+
+
+class FakeCursor:
+    """Answers the min/max query of get_chunks"""
+    def __init__(self, first, last):
+        self.result = (first, last)
+
+    def execute(self, query, parameters):
+        self.parameters = parameters
+
+    def fetchone(self):
+        return self.result
+
+
+def test_chunks_start_at_since():
+    cursor = FakeCursor(1600000000, 1600100000)
+    chunks = get_chunks(cursor, 'spoilers_v2', 1600000000, 1600090000, 86400)
+    assert cursor.parameters == (1600000000, 1600090000)
+    assert chunks == [(1600000000, 1600041600), (1600041600, 1600090000)]
+
+
+def test_chunks_are_aligned_without_since():
+    chunks = get_chunks(FakeCursor(1600000000, 1600000001), 'spoilers_v2', 0, 2**31 - 1, 86400)
+    assert chunks == [(1599955200, 1600041600)]
+
+
+def test_no_chunks_without_rows():
+    assert get_chunks(FakeCursor(None, None), 'requests', 0, 100, 10) == []
+
+
+def test_untimed_tables_are_a_single_snapshot():
+    assert get_chunks(None, 'banned_users', 0, 100, 10) == [(None, None)]
+
+
+def test_exported_ranges(tmp_path):
+    for table, start, end in (('spoilers_v2', 0, 10), ('spoilers_v2', 10, 15), ('requests', 0, 10)):
+        open(chunk_file(str(tmp_path), table, start, end), 'w').close()
+    open(chunk_file(str(tmp_path), 'banned_users', None, 20), 'w').close()
+    open(chunk_file(str(tmp_path), 'spoilers_v2', 15, 20) + '.part', 'w').close()
+    assert sorted(exported_ranges(str(tmp_path), 'spoilers_v2')) == [(0, 10), (10, 15)]
+    assert exported_ranges(str(tmp_path), 'banned_users') == []
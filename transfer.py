@@ -0,0 +1,198 @@
+"""
+Streams tables between databases with binary COPY, in constant memory
+
+    python transfer.py export dump/ --since 1600000000 --tables spoilers_v2,banned_users
+    python transfer.py import dump/ --db-host new-host
+
+Tables with a timestamp are split into chunk files by time range. The most recent
+rows may still be written to, so they're left out: running the export again later
+picks up where the last run stopped, in new chunk files. Tables without one are
+exported whole on every run, in a file named after the time of the export. An interrupted export or
+import can be resumed the same way, imported chunks are recorded in dump/imported.txt.
+Conflicting rows are skipped, except for the request counts which are added up.
+Tokens are copied as they are, so nothing is ever decrypted. spoilers_v2 can't be copied
+while it's split across shards (see shards.py), rebalance.py moves spoilers between those.
+"""
+import argparse
+import os
+import time
+
+import config
+
+# table -> (timestamp column or None, columns in the order they're copied)
+TABLES = {
+    'spoilers_v2': ('timestamp', ('hash', 'timestamp', 'token', 'owner', 'views', 'tenant')),
+    'banned_users': (None, ('user_id', 'expires', 'tenant')),
+    'requests': ('timestamp', ('timestamp', 'event', 'type', 'count', 'tenant')),
+}
+# how rows that are already in the destination are merged, the default is to skip them
+ON_CONFLICT = {
+    'requests': (
+        'ON CONFLICT (tenant, timestamp, event, type) DO UPDATE SET count = requests.count + EXCLUDED.count'
+    ),
+    # the files are imported in the order they were exported, the last one has the current bans
+    'banned_users': 'ON CONFLICT (tenant, user_id) DO UPDATE SET expires = EXCLUDED.expires',
+}
+IMPORTED_FILE = 'imported.txt'
+# rows from the last EXPORT_MARGIN seconds are left to the next export, the bots may still be
+# writing them (request counts are added to the current period until it's over)
+EXPORT_MARGIN = 2 * config.REQUEST_COUNT_RESOLUTION
+
+
+class Progress:
+    def __init__(self, action):
+        self.action = action
+        self.start = time.monotonic()
+        self.rows = 0
+        self.bytes = 0
+
+    def add(self, name, rows, size):
+        self.rows += max(rows, 0)
+        self.bytes += size
+        elapsed = time.monotonic() - self.start
+        print(
+            f'{self.action} {name}: {rows} rows, {size / 1024:.0f} KiB '
+            f'(total {self.rows} rows, {self.rows / elapsed:.0f} rows/s, '
+            f'{self.bytes / 1024 / 1024 / elapsed:.1f} MiB/s)'
+        )
+
+
+def get_chunks(cursor, table, since, until, chunk_size):
+    """Returns a list of (start, end) timestamp ranges covering the rows of a table"""
+    time_column = TABLES[table][0]
+    if not time_column:
+        return [(None, None)]
+
+    cursor.execute(
+        f'SELECT min({time_column}), max({time_column}) FROM {table} '
+        f'WHERE {time_column} >= %s AND {time_column} < %s',
+        (since, until)
+    )
+    first, last = cursor.fetchone()
+    if first is None:
+        return []
+
+    # the chunks are aligned, but the first one doesn't go further back than since
+    start = first - first % chunk_size
+    return [(max(t, since), min(t + chunk_size, until)) for t in range(start, last + 1, chunk_size)]
+
+
+def chunk_file(directory, table, start, end):
+    if start is None:
+        # a snapshot of the whole table, end is when it was taken
+        return os.path.join(directory, f'{table}.{end:012d}.copy')
+    return os.path.join(directory, f'{table}.{start:012d}-{end:012d}.copy')
+
+
+def exported_ranges(directory, table):
+    """Returns the (start, end) time ranges of a table's chunk files that already exist"""
+    ranges = []
+    for name in os.listdir(directory):
+        parts = name.split('.')
+        if len(parts) == 3 and parts[0] == table and parts[2] == 'copy' and '-' in parts[1]:
+            start, end = parts[1].split('-')
+            ranges.append((int(start), int(end)))
+    return ranges
+
+
+def export(connection, directory, tables, since, until, chunk_size):
+    os.makedirs(directory, exist_ok=True)
+    cursor = connection.cursor()
+    progress = Progress('exported')
+    until = min(until, int(time.time()) - EXPORT_MARGIN)
+
+    for table in tables:
+        time_column, columns = TABLES[table]
+        exported = exported_ranges(directory, table)
+        for start, end in get_chunks(cursor, table, since, until, chunk_size):
+            if start is None:
+                end = int(time.time())
+            else:
+                # an earlier run may have exported the beginning of the chunk (up to its own until)
+                start = max([e for s, e in exported if start <= s < end], default=start)
+                if start >= end:
+                    continue
+            path = chunk_file(directory, table, start, end)
+            if os.path.exists(path):
+                continue
+
+            query = f'SELECT {", ".join(columns)} FROM {table}'
+            if time_column:
+                query += cursor.mogrify(
+                    f' WHERE {time_column} >= %s AND {time_column} < %s', (start, end)
+                ).decode()
+
+            # write to a temporary file so that a partial chunk is never mistaken for a complete one
+            with open(path + '.part', 'wb') as f:
+                cursor.copy_expert(f'COPY ({query}) TO STDOUT WITH (FORMAT binary)', f)
+            os.replace(path + '.part', path)
+            progress.add(os.path.basename(path), cursor.rowcount, os.path.getsize(path))
+
+
+def import_(connection, directory, tables):
+    imported_path = os.path.join(directory, IMPORTED_FILE)
+    imported = set()
+    if os.path.exists(imported_path):
+        with open(imported_path) as f:
+            imported = set(f.read().split())
+
+    cursor = connection.cursor()
+    progress = Progress('imported')
+    with open(imported_path, 'a') as imported_file:
+        for name in sorted(os.listdir(directory)):
+            table = name.split('.', 1)[0]
+            if not name.endswith('.copy') or table not in tables or name in imported:
+                continue
+
+            columns = ', '.join(TABLES[table][1])
+            cursor.execute('BEGIN')
+            cursor.execute(
+                f'CREATE TEMPORARY TABLE transfer_chunk (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP'
+            )
+            with open(os.path.join(directory, name), 'rb') as f:
+                cursor.copy_expert(f'COPY transfer_chunk ({columns}) FROM STDIN WITH (FORMAT binary)', f)
+            on_conflict = ON_CONFLICT.get(table, 'ON CONFLICT DO NOTHING')
+            cursor.execute(
+                f'INSERT INTO {table} ({columns}) SELECT {columns} FROM transfer_chunk {on_conflict}'
+            )
+            inserted = cursor.rowcount
+            cursor.execute('COMMIT')
+
+            imported_file.write(name + '\n')
+            imported_file.flush()
+            progress.add(name, inserted, os.path.getsize(os.path.join(directory, name)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('action', choices=('export', 'import'))
+    parser.add_argument('directory', help='where the chunk files are written to or read from')
+    parser.add_argument('--tables', default='spoilers_v2',
+                        help=f'comma separated tables to copy (any of {", ".join(TABLES)})')
+    parser.add_argument('--since', type=int, default=0, help='only export rows with timestamp >= this')
+    parser.add_argument('--until', type=int, default=2**31 - 1, help='only export rows with timestamp < this')
+    parser.add_argument('--chunk', type=int, default=24 * 3600, help='seconds of rows per chunk file')
+    parser.add_argument('--db-host', default=config.DB_HOST)
+    parser.add_argument('--db-name', default=config.DB_NAME)
+    args = parser.parse_args()
+
+    tables = args.tables.split(',')
+    for table in tables:
+        if table not in TABLES:
+            parser.error(f'unknown table {table}')
+    if 'spoilers_v2' in tables and (config.SHARDS != ['main'] or config.PREVIOUS_SHARDS):
+        parser.error('spoilers_v2 is split across tg_bot_spoilero_shards, only the main database can be copied')
+
+    config.DB_HOST = args.db_host
+    config.DB_NAME = args.db_name
+    from database import Database
+    connection = Database().connection
+
+    if args.action == 'export':
+        export(connection, args.directory, tables, args.since, args.until, args.chunk)
+    else:
+        import_(connection, args.directory, tables)
+
+
+if __name__ == '__main__':
+    main()
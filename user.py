@@ -14,6 +14,8 @@ class User:
         self.spoiler_type = None
         self.spoiler_content = None
         self.spoiler_description = None
+        # set while the messages of an album are being collected
+        self.media_group_id = None
         self.handle_conversation = self.conversation_neutral
 
     def record_click(self, uuid):
@@ -59,13 +61,24 @@ class User:
         )
 
     def conversation_handle_content(self, bot, update):
-        handler = handlers.get_handler(update.message, update.message.effective_attachment)
-        if not handler:
-            update.message.reply_text('Unrecognized media type.')
-            return
+        if update.message.media_group_id:
+            item = handlers.Album.get_item(update.message)
+            if not item:
+                update.message.reply_text('Only photos and videos can be spoiled as an album.')
+                return
+
+            self.media_group_id = update.message.media_group_id
+            self.spoiler_type = handlers.Album.__name__
+            self.spoiler_content = [item]
+        else:
+            handler = handlers.get_handler(update.message, update.message.effective_attachment)
+            if not handler:
+                update.message.reply_text('Unrecognized media type.')
+                return
+
+            self.spoiler_type = handler.__name__
+            self.spoiler_content = handler.get_content(update.message)
 
-        self.spoiler_type = handler.__name__
-        self.spoiler_content = handler.get_content(update.message)
         self.handle_conversation = self.conversation_handle_title
 
         update.message.reply_text(
@@ -74,8 +87,26 @@ class User:
             'Type a dash (-) now if you do not want a title for your spoiler.'
         )
 
+    def conversation_handle_album_item(self, message):
+        """Adds the rest of an album's messages, which arrive as separate updates"""
+        if len(self.spoiler_content) >= handlers.Album.MAX_ITEMS:
+            message.reply_text(
+                f'An album can have at most {handlers.Album.MAX_ITEMS} items, this one was left out.'
+            )
+            return
+
+        item = handlers.Album.get_item(message)
+        if not item:
+            message.reply_text('Only photos and videos can be spoiled as an album, this item was left out.')
+            return
+        self.spoiler_content.append(item)
+
     def conversation_handle_title(self, bot, update):
         message = update.message
+        if self.media_group_id and message.media_group_id == self.media_group_id:
+            self.conversation_handle_album_item(message)
+            return
+
         if not message.text:
             return
 
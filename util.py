@@ -1,20 +1,23 @@
 import base64
 import html
+import json
 import os
 import time
 from datetime import datetime
 
 
-from telegram import (
-    InlineQueryResultArticle, InputTextMessageContent,
-    InlineKeyboardMarkup, InlineKeyboardButton
-)
-
-
 def pretty_timestamp(timestamp):
     return datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S UTC')
 
 
+def tenant_path(path, tenant):
+    """Gives every tenant but the default one its own file (ie spool.jsonl -> spool.name.jsonl)"""
+    if not tenant:
+        return path
+    root, extension = os.path.splitext(path)
+    return f'{root}.{tenant}{extension}'
+
+
 def timestamp_floor(period):
     return int(time.time() // period) * period
 
@@ -52,24 +55,55 @@ def html_unescape(s):
     return html.unescape(str(s).replace('<br/>', '\n'))
 
 
-def get_article(title, description, thumb_url, text, uuid, reply_markup=None):
-    return InlineQueryResultArticle(
-        id=uuid,
-        title=title,
-        description=description,
-        thumb_url=thumb_url,
-        thumb_width=512,
-        thumb_height=512,
-        input_message_content=InputTextMessageContent(
-            message_text=text,
-            parse_mode='HTML'
-        ),
-        reply_markup=reply_markup
-    )
+class ArticleTemplate:
+    """
+    An inline article result whose constant fields are serialized once
+    render() only has to json encode the fields that change for each query
+    """
+    def __init__(self, title, thumb_url):
+        # everything but the closing brace, so the per-query fields can be appended
+        self.head = json.dumps({
+            'type': 'article',
+            'title': title,
+            'thumb_url': thumb_url,
+            'thumb_width': 512,
+            'thumb_height': 512,
+        })[:-1]
+
+    def render(self, uuid, description, text, button):
+        """Returns the article as json, button should come from get_button_json"""
+        return (
+            f'{self.head},"id":{json.dumps(uuid)},"description":{json.dumps(description)},'
+            f'"input_message_content":{{"message_text":{json.dumps(text)},"parse_mode":"HTML"}},'
+            f'"reply_markup":{{"inline_keyboard":[[{button}]]}}}}'
+        )
+
+
+def get_button_json(text, callback_data=None, url=None):
+    """Returns an inline keyboard button serialized as json"""
+    button = {'text': text}
+    if callback_data is not None:
+        button['callback_data'] = callback_data
+    if url is not None:
+        button['url'] = url
+    return json.dumps(button)
+
+
+def answer_inline_query(bot, inline_query_id, results, **kwargs):
+    """
+    Answers an inline query with results that are already serialized (see ArticleTemplate)
+    the Bot API accepts the results array as a json string, like the library does for reply_markup
+    """
+    data = {'inline_query_id': inline_query_id, 'results': '[' + ','.join(results) + ']'}
+    data.update(kwargs)
+    return bot.request.post(f'{bot.base_url}/answerInlineQuery', data)
 
 
 def get_single_buttton_inline_keyboard(text, callback_data=None, url=None, switch_inline_query=None):
     """Returns a single button InlineKeyboardMarkup"""
+    # imported here so that the tools importing util (through database) don't load telegram
+    from telegram import InlineKeyboardMarkup, InlineKeyboardButton
+
     return InlineKeyboardMarkup([[InlineKeyboardButton(
         text=text,
         callback_data=callback_data,